@@ -0,0 +1,227 @@
+import os
+import json
+import uuid
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from llama_index.core.agent import FunctionCallingAgentWorker
+from llama_index.core.agent.function_calling.step import get_function_by_name
+from llama_index.core.agent.types import Task, TaskStep, TaskStepOutput
+from llama_index.core.agent.utils import add_user_step_to_memory
+from llama_index.core.base.llms.types import ChatMessage, ChatResponse, MessageRole
+from llama_index.core.callbacks import CBEventType, EventPayload, trace_method
+from llama_index.core.chat_engine.types import AgentChatResponse
+from llama_index.core.llms.function_calling import ToolSelection
+from llama_index.core.tools import QueryEngineTool, ToolOutput
+from llama_index.core.tools.calling import call_tool_with_selection
+
+from answer_cache import normalize_question
+from embeddings import get_embed_model
+from streaming import OnDelta
+from tracing import llm_token_usage, span
+
+# Tool calls running at once in the process, the calls of one agent step run in parallel up to it
+AGENT_TOOL_CONCURRENCY = int(os.environ.get('FICO_AGENT_TOOL_CONCURRENCY', 4))
+
+_tool_executor = ThreadPoolExecutor(max_workers=AGENT_TOOL_CONCURRENCY, thread_name_prefix="fico-tool")
+
+class StreamingFunctionCallingAgentWorker(FunctionCallingAgentWorker):
+    """Function calling agent worker that streams its answer to `on_delta` while it is generated.
+
+    Steps that select tools run as plain `chat_with_tools` calls. Once tool results are
+    in memory the next response is streamed; if the model asks for more tools instead
+    of answering, the partial text is discarded and the tool calls of the streamed
+    response are run.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self.on_delta: Optional[OnDelta] = None
+
+    def _stream_anthropic(self, tool_dicts: List[dict], chat_history: List[ChatMessage], on_delta: OnDelta) -> ChatResponse:
+        from llama_index.llms.anthropic.utils import messages_to_anthropic_messages
+
+        # The integration's stream_chat only yields text, its client's stream also assembles the tool_use blocks
+        anthropic_messages, system_prompt = messages_to_anthropic_messages(chat_history)
+        with self._llm._client.messages.stream(messages=anthropic_messages, system=system_prompt, tools=tool_dicts,
+                                               **self._llm._get_all_kwargs()) as stream:
+            for text in stream.text_stream:
+                on_delta(text)
+            message = stream.get_final_message()
+        content, tool_calls = self._llm._get_content_and_tool_calls(message)
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=content,
+                                                additional_kwargs={"tool_calls": tool_calls}),
+                            raw=dict(message))
+
+    def _stream_chat_with_tools(self, tools, chat_history: List[ChatMessage], on_delta: OnDelta) -> ChatResponse:
+        tool_dicts = [
+            {
+                "name": tool.metadata.name,
+                "description": tool.metadata.description,
+                "input_schema": tool.metadata.get_parameters_dict(),
+            }
+            for tool in tools
+        ]
+        if hasattr(getattr(self._llm, "_client", None), "messages"):
+            response = self._stream_anthropic(tool_dicts, chat_history, on_delta)
+        else:
+            kwargs = {"tools": tool_dicts} if tool_dicts else {}
+            response = ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=""))
+            for response in self._llm.stream_chat(chat_history, **kwargs):
+                on_delta(response.delta or "")
+            response.message.additional_kwargs.setdefault("tool_calls", [])
+
+        tool_calls = response.message.additional_kwargs["tool_calls"]
+        if tool_calls:
+            # The text before a tool call is not the answer
+            on_delta(None)
+            if not self.allow_parallel_tool_calls:
+                del tool_calls[1:]
+        return response
+
+    def _chat_with_tools(self, tools, task: Task) -> ChatResponse:
+        messages = self.get_all_messages(task)
+        on_delta = self.on_delta
+        if on_delta is not None and task.extra_state["n_function_calls"] > 0:
+            with span("agent.llm", streamed=True) as llm_span:
+                response = self._stream_chat_with_tools(tools, messages, on_delta)
+                llm_span.set(**llm_token_usage(messages, response))
+            return response
+
+        with span("agent.llm") as llm_span:
+            response = self._llm.chat_with_tools(
+                tools=tools,
+                user_msg=None,
+                chat_history=messages,
+                verbose=self._verbose,
+                allow_parallel_tool_calls=self.allow_parallel_tool_calls,
+            )
+            llm_span.set(**llm_token_usage(messages, response))
+        return response
+
+    def _call_function(self, tools, tool_call, memory, sources, verbose: bool = False) -> bool:
+        with span(f"tool.{tool_call.tool_name}"):
+            return super()._call_function(tools, tool_call, memory, sources, verbose=verbose)
+
+    def _run_tool(self, tools, tool_call: ToolSelection) -> ToolOutput:
+        tool = get_function_by_name(tools, tool_call.tool_name)
+        with span(f"tool.{tool_call.tool_name}", parallel=True), self.callback_manager.event(
+            CBEventType.FUNCTION_CALL,
+            payload={EventPayload.FUNCTION_CALL: json.dumps(tool_call.tool_kwargs), EventPayload.TOOL: tool.metadata},
+        ) as event:
+            tool_output = call_tool_with_selection(tool_call, tools, verbose=False)
+            event.on_end(payload={EventPayload.FUNCTION_OUTPUT: str(tool_output)})
+        return tool_output
+
+    def _prefetch_query_embeddings(self, tools, tool_calls: List[ToolSelection]):
+        # Questions to query engine tools (and their answer cache lookups) are embedded in one batch
+        tools_by_name = {tool.metadata.name: tool for tool in tools}
+        queries = [str(tool_call.tool_kwargs.get("input", next(iter(tool_call.tool_kwargs.values()))))
+                   for tool_call in tool_calls
+                   if isinstance(tools_by_name.get(tool_call.tool_name), QueryEngineTool) and tool_call.tool_kwargs]
+        if len(queries) > 1:
+            with span("agent.prefetch_embeddings", queries=len(queries)):
+                get_embed_model().prefetch_query_embeddings(queries + [normalize_question(query) for query in queries])
+
+    def _call_functions(self, tools, tool_calls: List[ToolSelection], memory, sources):
+        """Runs the tool calls of a step at once and records their outputs in the order the model made them"""
+        self._prefetch_query_embeddings(tools, tool_calls)
+        futures = {}
+        for tool_call in tool_calls:
+            # The same call twice in one step runs once
+            key = (tool_call.tool_name, json.dumps(tool_call.tool_kwargs, sort_keys=True))
+            if key not in futures:
+                futures[key] = _tool_executor.submit(contextvars.copy_context().run, self._run_tool, tools, tool_call)
+
+        for tool_call in tool_calls:
+            tool_output = futures[(tool_call.tool_name, json.dumps(tool_call.tool_kwargs, sort_keys=True))].result()
+            if self._verbose:
+                print("=== Calling Function ===")
+                print(f"Calling function: {tool_call.tool_name} with args: {json.dumps(tool_call.tool_kwargs)}")
+                print("=== Function Output ===")
+                print(tool_output.content)
+            sources.append(tool_output)
+            memory.put(ChatMessage(content=str(tool_output), role=MessageRole.TOOL,
+                                   additional_kwargs={"name": tool_call.tool_name, "tool_call_id": tool_call.tool_id}))
+
+    @trace_method("run_step")
+    def run_step(self, step: TaskStep, task: Task, **kwargs: Any) -> TaskStepOutput:
+        """Run step."""
+        if step.input is not None:
+            add_user_step_to_memory(
+                step, task.extra_state["new_memory"], verbose=self._verbose
+            )
+        tools = self.get_tools(task.input)
+
+        # get response and tool call (if exists)
+        response = self._chat_with_tools(tools, task)
+        tool_calls = self._llm.get_tool_calls_from_response(
+            response, error_on_no_tool_call=False
+        )
+
+        if self._verbose and response.message.content:
+            print("=== LLM Response ===")
+            print(str(response.message.content))
+
+        if not self.allow_parallel_tool_calls and len(tool_calls) > 1:
+            raise ValueError(
+                "Parallel tool calls not supported for synchronous function calling agent"
+            )
+
+        # call all tools, gather responses
+        task.extra_state["new_memory"].put(response.message)
+        if (
+            len(tool_calls) == 0
+            or task.extra_state["n_function_calls"] >= self._max_function_calls
+        ):
+            # we are done
+            is_done = True
+            new_steps = []
+        else:
+            is_done = False
+            tool_calls_ = tool_calls
+            if len(tool_calls) > 1 and not get_function_by_name(tools, tool_calls[0].tool_name).metadata.return_direct:
+                # Independent calls run in parallel, the step takes about as long as the slowest
+                self._call_functions(tools, tool_calls, task.extra_state["new_memory"], task.extra_state["sources"])
+                task.extra_state["n_function_calls"] += len(tool_calls)
+                tool_calls_ = []
+            for i, tool_call in enumerate(tool_calls_):
+                return_direct = self._call_function(
+                    tools,
+                    tool_call,
+                    task.extra_state["new_memory"],
+                    task.extra_state["sources"],
+                    verbose=self._verbose,
+                )
+
+                task.extra_state["n_function_calls"] += 1
+
+                # check if any of the tools return directly -- only works if there is one tool call
+                if i == 0 and return_direct:
+                    is_done = True
+                    response = task.extra_state["sources"][-1].content
+                    break
+
+            new_steps = (
+                [
+                    step.get_next_step(
+                        step_id=str(uuid.uuid4()),
+                        # NOTE: input is unused
+                        input=None,
+                    )
+                ]
+                if not is_done
+                else []
+            )
+
+        agent_response = AgentChatResponse(
+            response=str(response), sources=task.extra_state["sources"]
+        )
+
+        return TaskStepOutput(
+            output=agent_response,
+            task_step=step,
+            is_last=is_done,
+            next_steps=new_steps,
+        )
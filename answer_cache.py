@@ -0,0 +1,204 @@
+import os
+import re
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from llama_index.core.base.base_query_engine import BaseQueryEngine
+from llama_index.core.schema import QueryBundle
+
+from phi.utils.log import logger
+
+ANSWER_CACHE_MAX_ENTRIES = int(os.environ.get('FICO_ANSWER_CACHE_MAX_ENTRIES', 2048))
+ANSWER_CACHE_TTL = float(os.environ.get('FICO_ANSWER_CACHE_TTL', 24 * 60 * 60))
+# Cosine similarity above which a differently worded question reuses an answer, 1 or more disables semantic hits
+ANSWER_CACHE_SIMILARITY = float(os.environ.get('FICO_ANSWER_CACHE_SIMILARITY', 0.95))
+
+Embed = Callable[[str], List[float]]
+
+def normalize_question(question: str) -> str:
+    return " ".join(re.findall(r"[\w.%]+", question.lower())).strip(". ")
+
+def _numbers(normalized: str) -> frozenset:
+    # Questions about different years or amounts must not share answers however similar they read
+    return frozenset(re.findall(r"\d+(?:\.\d+)?", normalized))
+
+def data_version(*parts: str) -> str:
+    """Stamp of the data an answer was derived from"""
+    return hashlib.sha256("|".join(parts).encode()).hexdigest()[:16]
+
+class _Answer:
+    __slots__ = ("question", "numbers", "embedding", "answer", "seconds", "ttl", "created_at")
+
+    def __init__(self, question: str, embedding: Optional[np.ndarray], answer: Any, seconds: float, ttl: float):
+        self.question = question
+        self.numbers = _numbers(question)
+        self.embedding = embedding
+        self.answer = answer
+        self.seconds = seconds
+        self.ttl = ttl
+        self.created_at = time.time()
+
+class AnswerCache:
+    """Process-wide cache of agent and query engine answers.
+
+    Answers are keyed by ticker, tool and the version stamp of the data behind the
+    tool. A question is a hit when its normalized text matches, or when its embedding
+    is within `similarity` of a cached question for the same key and both mention the
+    same numbers. Entries expire after `ttl` seconds, or sooner when the answer used
+    live data, and are dropped when their section is refreshed (`invalidate`).
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES, ttl: float = ANSWER_CACHE_TTL,
+                 similarity: float = ANSWER_CACHE_SIMILARITY, embed: Optional[Embed] = None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.similarity = similarity
+        self._embed = embed
+        # (ticker, tool, version) -> normalized question -> answer, least recently used first
+        self._entries: "OrderedDict[Tuple[str, str, str], OrderedDict[str, _Answer]]" = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {"exact_hits": 0, "semantic_hits": 0, "misses": 0, "seconds_saved": 0.0, "evictions": 0}
+
+    def _embedding(self, question: str) -> Optional[np.ndarray]:
+        if self.similarity >= 1:
+            return None
+        if self._embed is None:
+            from embeddings import get_embed_model
+
+            self._embed = get_embed_model().get_query_embedding
+        try:
+            vector = np.asarray(self._embed(question), dtype=np.float32)
+        except Exception as e:
+            logger.warning(f"Could not embed question for the answer cache: {e}")
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+
+    def _answers(self, key: Tuple[str, str, str]) -> "Optional[OrderedDict[str, _Answer]]":
+        # Called with the lock held
+        answers = self._entries.get(key)
+        if answers is None:
+            return None
+        self._entries.move_to_end(key)
+        now = time.time()
+        for question in [question for question, answer in answers.items() if now - answer.created_at > answer.ttl]:
+            del answers[question]
+            self._size -= 1
+        if not answers:
+            del self._entries[key]
+            return None
+        return answers
+
+    def _lookup(self, key: Tuple[str, str, str], question: str) -> Optional[_Answer]:
+        with self._lock:
+            answers = self._answers(key)
+            answer = answers.get(question) if answers is not None else None
+            if answer is not None:
+                answers.move_to_end(question)
+            return answer
+
+    def _lookup_similar(self, key: Tuple[str, str, str], question: str, embedding: np.ndarray) -> Optional[_Answer]:
+        numbers = _numbers(question)
+        with self._lock:
+            answers = self._answers(key)
+            candidates = [answer for answer in (answers or {}).values()
+                          if answer.embedding is not None and answer.numbers == numbers]
+        if not candidates:
+            return None
+        scores = np.stack([answer.embedding for answer in candidates]) @ embedding
+        best = int(np.argmax(scores))
+        return candidates[best] if scores[best] >= self.similarity else None
+
+    def _put(self, key: Tuple[str, str, str], question: str, embedding: Optional[np.ndarray], answer: Any, seconds: float,
+             ttl: float):
+        with self._lock:
+            answers = self._entries.setdefault(key, OrderedDict())
+            self._entries.move_to_end(key)
+            if question not in answers:
+                self._size += 1
+            answers[question] = _Answer(question, embedding, answer, seconds, ttl)
+            while self._size > self.max_entries and self._entries:
+                oldest_key, oldest = next(iter(self._entries.items()))
+                oldest.popitem(last=False)
+                self._size -= 1
+                self._stats["evictions"] += 1
+                if not oldest:
+                    del self._entries[oldest_key]
+
+    def get_or_compute(self, ticker: str, tool: str, version: str, question: str,
+                       compute: Callable[[], Any], ttl: Optional[Callable[[Any], Optional[float]]] = None) -> Tuple[Any, bool]:
+        """Returns the cached answer to `question` or computes and caches it, and whether it was a hit.
+
+        `ttl` is called with a computed answer and returns how long it may be served,
+        None for the cache's lifetime and 0 to not cache it.
+        """
+        key = (ticker, tool, version)
+        normalized = normalize_question(question)
+        embedding = None
+        cached, kind = self._lookup(key, normalized), "exact"
+        if cached is None:
+            embedding = self._embedding(normalized)
+            if embedding is not None:
+                cached, kind = self._lookup_similar(key, normalized, embedding), "semantic"
+
+        if cached is not None:
+            with self._lock:
+                self._stats[f"{kind}_hits"] += 1
+                self._stats["seconds_saved"] += cached.seconds
+            logger.debug(f"Answer cache {kind} hit for {ticker}/{tool}: {question!r} -> {cached.question!r}")
+            return cached.answer, True
+
+        with self._lock:
+            self._stats["misses"] += 1
+        start = time.perf_counter()
+        answer = compute()
+        seconds = time.perf_counter() - start
+        answer_ttl = ttl(answer) if ttl is not None else None
+        answer_ttl = self.ttl if answer_ttl is None else min(answer_ttl, self.ttl)
+        if answer_ttl > 0:
+            self._put(key, normalized, embedding, answer, seconds, answer_ttl)
+        return answer, False
+
+    def invalidate(self, ticker: str, tool: Optional[str] = None):
+        """Drops the answers of a ticker's tool (all its tools when `tool` is None)"""
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == ticker and (tool is None or key[1] == tool)]:
+                self._size -= len(self._entries.pop(key))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = {**self._stats, "entries": self._size}
+        lookups = stats["exact_hits"] + stats["semantic_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["semantic_hits"]) / lookups if lookups else 0.0
+        return stats
+
+answer_cache = AnswerCache()
+
+class CachedQueryEngine(BaseQueryEngine):
+    """Query engine that answers repeated questions from `answer_cache`"""
+
+    def __init__(self, query_engine: BaseQueryEngine, ticker: str, tool: str, version: str,
+                 cache: AnswerCache = answer_cache):
+        super().__init__(callback_manager=query_engine.callback_manager)
+        self.query_engine = query_engine
+        self.ticker = ticker
+        self.tool = tool
+        self.version = version
+        self.cache = cache
+
+    def _get_prompt_modules(self) -> Dict[str, Any]:
+        return {"query_engine": self.query_engine}
+
+    def _query(self, query_bundle: QueryBundle):
+        response, _ = self.cache.get_or_compute(self.ticker, self.tool, self.version, query_bundle.query_str,
+                                                lambda: self.query_engine.query(query_bundle))
+        return response
+
+    async def _aquery(self, query_bundle: QueryBundle):
+        return self._query(query_bundle)
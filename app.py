@@ -1,20 +1,24 @@
 import streamlit as st
 
 import os
+import time
+import uuid
+import hashlib
 from typing import List
-import datetime
 
-import yfinance as yf
-from duckduckgo_search import DDGS
-
-from llama_index.llms.groq import Groq
-from llama_index.core.base.llms.types import MessageRole, ChatMessage
+import startup
 
 from phi.utils.log import logger
 
-from assistant import Assistant
+from tracing import Trace
+
+# The report and chat modules are imported when first needed, the first page renders without them
+startup.record("app imports", startup.PROCESS_START, time.perf_counter() - startup.PROCESS_START)
+# Preloads the report and chat modules in the background when FICO_WARM_UP is set
+startup.warm_up()
 
-GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
+# How often a running report job is polled for its stage when nothing else changes
+JOB_POLL_SECONDS = 0.5
 
 st.set_page_config(
     page_title="FICO",
@@ -28,10 +32,20 @@ def clear_cache():
         
 def restart_assistant():
     logger.debug("---*--- Restarting Assistant ---*---")
-    st.session_state["research_assistant"] = None
+    if "session_id" in st.session_state:
+        from jobs import jobs
+        from registry import registry
+
+        if st.session_state.get("report_job") is not None:
+            jobs.cancel(st.session_state["report_job"], st.session_state["session_id"])
+        registry.release(st.session_state["session_id"])
     clear_cache()
     st.rerun()
 
+def show_latency_breakdown(label: str, trace: Trace):
+    st.sidebar.markdown(f"**{label}** ({trace.duration:.1f}s)")
+    st.sidebar.table(trace.breakdown())
+
 def main():
 
     # Get ticker for report
@@ -49,10 +63,6 @@ def main():
 
     annual_report_tools = st.sidebar.checkbox("Annual Report", value=False)
 
-    # Ticker object
-    ticker = yf.Ticker(ticker_to_research)
-    stock_name = ticker_to_research.lower().replace(".", "_")
-
     if annual_report_tools:
         # Add PDFs to knowledge base
         if "file_uploader_key" not in st.session_state:
@@ -62,278 +72,196 @@ def main():
             "Add a PDF :page_facing_up:", type="pdf", key=st.session_state["file_uploader_key"]
         )
     
-    # Get the assistant
-    research_assistant: Assistant
-    if "research_assistant" not in st.session_state or st.session_state["research_assistant"] is None:
-        research_assistant = Assistant(ticker=ticker_to_research)
-        st.session_state["research_assistant"] = research_assistant
-    else:
-        research_assistant = st.session_state["research_assistant"]
+    # Keys the session's assistant in the registry
+    if "session_id" not in st.session_state:
+        st.session_state["session_id"] = uuid.uuid4().hex
 
     # -*- Generate Research Report
-    generate_report = st.sidebar.button("Generate Report")
-
-    if "report_generated" not in st.session_state:
-        st.session_state["report_generated"] = False
+    report_requested = st.sidebar.button("Generate Report")
+
+    if report_requested or st.session_state.get("report_job") is not None:
+        with startup.timed("report and chat modules"):
+            from jobs import CANCELLED, DONE, QUEUED, jobs
+            from pipeline import DEFAULT_SOURCES, report_job
+            from registry import registry
+
+        if report_requested:
+            st.session_state["report_ticker"] = ticker_to_research
+        # The session researches the ticker of its last report, a new ticker is picked up by the next report
+        report_ticker = st.session_state.get("report_ticker", ticker_to_research)
+        stock_name = report_ticker.lower().replace(".", "_")
+
+        # Assistants live in the process-wide registry, sharing the indexes and tools of a ticker between sessions
+        research_assistant, created = registry.assistant(st.session_state["session_id"], report_ticker)
+        # Evicted while the session was idle, its tools and agent are rebuilt, the report itself is kept
+        rebuild = created and not report_requested and bool(st.session_state.get("final_report"))
+
+        if report_requested or rebuild:
+            if st.session_state.get("report_job") is not None:
+                # A new request replaces the job this session was following
+                jobs.cancel(st.session_state["report_job"], st.session_state["session_id"])
+            sources = [name for name, enabled in zip(DEFAULT_SOURCES, [get_company_info, get_company_news,
+                                                                      get_analyst_recommendations, get_upgrades_downgrades]) if enabled]
+            build_document_tool = None
+            pdf_hash = None
+            if annual_report_tools:
+                if uploaded_file is None:
+                    st.error("Please upload the Annual Report PDF or uncheck the box to disable this feature.")
+                    st.stop()
+                pdf_bytes = uploaded_file.getvalue()
+                pdf_hash = hashlib.sha256(pdf_bytes).hexdigest()
+                description=f"""Provides Annual Report about {stock_name}
+                    Use a detailed plain text question as input to the tool."""
+
+                def build_document_tool(on_progress, pdf_bytes=pdf_bytes, pdf_name=uploaded_file.name):
+                    # The job outlives this run of the script, it keeps its own copy of the upload
+                    path_pdf = os.path.join('data', f"{uuid.uuid4().hex}-{pdf_name}")
+                    with open(path_pdf, 'wb') as f:
+                        f.write(pdf_bytes)
+                    try:
+                        return research_assistant.create_query_engine_tool_from_document(path_pdf, stock_name+"_annualreport", description,
+                                                                                         on_progress=on_progress)
+                    finally:
+                        os.remove(path_pdf)
+
+            # Identical requests on the same shared ticker state share one job, a rebuild only needs the tools
+            job_key = (report_ticker, tuple(sources), pdf_hash, research_assistant.state.key, not rebuild)
+            job = jobs.submit(job_key, f"{'tools' if rebuild else 'report'} {report_ticker}",
+                              report_job(report_ticker, sources, build_tool=research_assistant.create_query_engine_tool_from_md,
+                                         build_document_tool=build_document_tool, write_report=not rebuild,
+                                         drop_tool=research_assistant.remove_tool),
+                              subscriber=st.session_state["session_id"], trace=Trace("report", ticker=report_ticker))
+            st.session_state["report_job"] = job.id
+            st.session_state["agent_created"] = False
+            if not rebuild:
+                st.session_state["final_report"] = ""
+
+        job = jobs.get(st.session_state.get("report_job"))
+        final_report = st.session_state.get("final_report", "")
 
-    if generate_report or st.session_state["report_generated"]:
-        report_input = ""
-        if "report_input" not in st.session_state:
-            st.session_state.report_input = ""
-        else:
-            report_input = st.session_state.report_input
         with st.status("Generating Reports", expanded=True) as status:
-            with st.container():
-                if report_input == "":
-                    if annual_report_tools:
-                        if uploaded_file is not None:
-                            alert = st.sidebar.info("Processing PDF...", icon="🧠")
-                            rag_name = uploaded_file.name.split(".")[0]
-                            path_pdf = os.path.join('data', uploaded_file.name)
-                            with open(path_pdf, 'wb') as f: 
-                                f.write(uploaded_file.getbuffer())
-
-                            if f"{rag_name}_uploaded" not in st.session_state or not st.session_state[f"{rag_name}_uploaded"]:
-                                description=f"""Provides Annual Report about {stock_name}
-                                    Use a detailed plain text question as input to the tool."""
-                                
-                                if not research_assistant.create_query_engine_tool_from_document(path_pdf, stock_name+"_annualreport", description):
-                                    st.sidebar.error("Could not read PDF")
-                                    st.session_state[f"{rag_name}_uploaded"] = True
-                                else:
-                                    st.session_state[f"{rag_name}_uploaded"] = False
-
-                                os.remove(path_pdf)
-                            alert.empty()
-                        else:
-                            st.error("Please upload the Annual Report PDF or uncheck the box to disable this feature.")
-                            st.stop()
-
-                    if get_company_info:
-                        company_info_full = ticker.info
-                        company_info_md = "## Company Info\n\n"
-                        if company_info_full:
-                            company_info_cleaned = {
-                                "Name": company_info_full.get("shortName"),
-                                "Symbol": company_info_full.get("symbol"),
-                                "Current Stock Price": f"{company_info_full.get('regularMarketPrice', company_info_full.get('currentPrice'))} {company_info_full.get('currency', 'USD')}",
-                                "Market Cap": f"{company_info_full.get('marketCap', company_info_full.get('enterpriseValue'))} {company_info_full.get('currency', 'USD')}",
-                                "Sector": company_info_full.get("sector"),
-                                "Industry": company_info_full.get("industry"),
-                                "Address": company_info_full.get("address1"),
-                                "City": company_info_full.get("city"),
-                                "State": company_info_full.get("state"),
-                                "Zip": company_info_full.get("zip"),
-                                "Country": company_info_full.get("country"),
-                                "EPS": company_info_full.get("trailingEps"),
-                                "P/E Ratio": company_info_full.get("trailingPE"),
-                                "52 Week Low": company_info_full.get("fiftyTwoWeekLow"),
-                                "52 Week High": company_info_full.get("fiftyTwoWeekHigh"),
-                                "50 Day Average": company_info_full.get("fiftyDayAverage"),
-                                "200 Day Average": company_info_full.get("twoHundredDayAverage"),
-                                "Website": company_info_full.get("website"),
-                                "Summary": company_info_full.get("longBusinessSummary"),
-                                "Analyst Recommendation": company_info_full.get("recommendationKey"),
-                                "Number Of Analyst Opinions": company_info_full.get("numberOfAnalystOpinions"),
-                                "Employees": company_info_full.get("fullTimeEmployees"),
-                                "Total Cash": company_info_full.get("totalCash"),
-                                "Free Cash flow": company_info_full.get("freeCashflow"),
-                                "Operating Cash flow": company_info_full.get("operatingCashflow"),
-                                "EBITDA": company_info_full.get("ebitda"),
-                                "Revenue Growth": company_info_full.get("revenueGrowth"),
-                                "Gross Margins": company_info_full.get("grossMargins"),
-                                "Ebitda Margins": company_info_full.get("ebitdaMargins"),
-                            }
-                            for key, value in company_info_cleaned.items():
-                                if value:
-                                    company_info_md += f"  - {key}: {value}\n\n"
-                            report_input += "This section contains information about the company.\n\n"
-                        
-                            description = f"""Provides current company information about {stock_name}.
-                                Use a detailed plain text question as input to the tool."""
-                            research_assistant.create_query_engine_tool_from_md(company_info_md, stock_name+"_company_info", description)
-                        else:
-                            company_info_md += "No information found for this company.\n"
-                        
-                        report_input += company_info_md
-                        report_input += "---\n"
-                    if get_company_news:
-                        ddgs = DDGS()
-                        company_news = ddgs.news(keywords=ticker_to_research+" stocks", max_results=5)
-                        company_news_md = "## Company News\n\n\n"
-                        if len(company_news) > 0:
-                            for news_item in company_news:
-                                company_news_md += f"#### {news_item['title']}\n\n"
-                                if "date" in news_item:
-                                    company_news_md += f"  - Date: {news_item['date']}\n\n"
-                                if "url" in news_item:
-                                    company_news_md += f"  - Link: {news_item['url']}\n\n"
-                                if "source" in news_item:
-                                    company_news_md += f"  - Source: {news_item['source']}\n\n"
-                                if "body" in news_item:
-                                    company_news_md += f"{news_item['body']}"
-                                company_news_md += "\n\n"
-                                report_input += "This section contains the most recent news articles about the company.\n\n"
-                        
-                                description = f"""Provides 5 current news about {stock_name}.
-                                    No input is required."""
-                                research_assistant.create_query_engine_tool_from_md(company_news_md, stock_name+"_company_news", description)
-                        else:
-                            company_news_md += "No news found for this company.\n"
-                                
-                        report_input += company_news_md
-                        report_input += "---\n"
-                            
-                    if get_analyst_recommendations:
-                        analyst_recommendations = ticker.recommendations
-                        report_input += "## Analyst Recommendations\n\n"
-                        if not analyst_recommendations.empty:
-                            analyst_recommendations_md = analyst_recommendations.to_markdown()
-                            report_input += "This table outlines the most recent analyst recommendations for the stock.\n\n"
-                            report_input += f"{analyst_recommendations_md}\n"
-
-                            description = f"""Provides analyst recommendation about {stock_name}.
-                                No input is required."""
-                            research_assistant.create_query_engine_tool_from_md(analyst_recommendations_md, stock_name+"_analyst_recommendations", description)
-                        else:
-                            report_input += "No analyst recommendations found for this stock.\n"
-                        report_input += "---\n"
-                        
-                    if get_upgrades_downgrades:
-                        upgrades_downgrades = ticker.upgrades_downgrades[0:20]
-                        report_input += "## Upgrades/Downgrades\n\n"
-                        if not upgrades_downgrades.empty:
-                            upgrades_downgrades_md = upgrades_downgrades.to_markdown()
-                            report_input += "This table outlines the most recent upgrades and downgrades for the stock.\n\n"
-                            report_input += f"{upgrades_downgrades_md}\n"
-
-                            description = f"""Provides upgrades and downgrades of {stock_name}.
-                                No input is required."""
-                            research_assistant.create_query_engine_tool_from_md(upgrades_downgrades_md, stock_name+"_upgrades_downgrades_md", description)
-                        else:
-                            report_input += "No upgrades or downgrades found for this stock.\n"
-                        report_input += "---\n"
-                    
-                    st.session_state.report_input = report_input
-
-                final_report = ""
-                if "final_report" not in st.session_state:
-                    st.session_state.final_report = ""
+            final_report_container = st.empty()
+            if job is not None and not job.done:
+                # The job runs in the background, this run only shows its progress and can be interrupted at any time
+                if st.sidebar.button("Cancel Report"):
+                    jobs.cancel(job.id, st.session_state["session_id"])
+                    # A job other sessions wait for keeps running, this session stops following it either way
+                    st.session_state.pop("report_job")
+                    job = None
+                    st.info("Report cancelled.")
                 else:
-                    final_report = st.session_state.final_report
-
-                final_report_container = st.empty()
-                
-                if final_report == "":
-                    report_format = """
-                        <report_format>
-                        ## [Company Name]: Investment Report
-
-                        ### **Overview**
-                        {give a brief introduction of the company and why the user should read this report}
-                        {make this section engaging and create a hook for the reader}
-
-                        ### Core Metrics
-                        {provide a summary of core metrics and show the latest data}
-                        - Current price: {current price}
-                        - 52-week high: {52-week high}
-                        - 52-week low: {52-week low}
-                        - Market Cap: {Market Cap} in billions
-                        - P/E Ratio: {P/E Ratio}
-                        - Earnings per Share: {EPS}
-                        - 50-day average: {50-day average}
-                        - 200-day average: {200-day average}
-                        - Analyst Recommendations: {buy, hold, sell} (number of analysts)
-
-                        ### Financial Performance
-                        {provide a detailed analysis of the company's financial performance}
-
-                        ### Growth Prospects
-                        {analyze the company's growth prospects and future potential}
-
-                        ### News and Updates
-                        {summarize relevant news that can impact the stock price}
-
-                        ### Upgrades and Downgrades
-                        {share 2 upgrades or downgrades including the firm, and what they upgraded/downgraded to}
-                        {this should be a paragraph not a table}
-
-                        ### [Summary]
-                        {give a summary of the report and what are the key takeaways}
-
-                        ### [Recommendation]
-                        {provide a recommendation on the stock along with a thorough reasoning}
-
-                        Report generated on: {Month Date, Year (hh:mm AM/PM)}
-                        </report_format>
-                    """
-                    
-                    system_prompt = f"""You are a Senior Investment Analyst for Goldman Sachs tasked with producing a research report for a very important client.
-                    You will be provided with a stock and information from junior researchers.
-                    Carefully read the research and generate a final - Goldman Sachs worthy investment report.
-                    Make your report engaging, informative, and well-structured.
-                    When you share numbers, make sure to include the units (e.g., millions/billions) and currency.
-                    REMEMBER: This report is for a very important client, so the quality of the report is important.
-                    Make sure your recommendations are well-supported and backed by data.
-                    Make sure your report is properly formatted and follows the <report_format> provided below.
-                    If you don't have enough information for a section, you can leave it blank.
-                    {report_format}
-                    Do not include Goldman Sachs in your report.
-                    Current datetime is: {datetime.datetime.now().strftime('%B %d, %Y, %I:%M %p')}
-                    """
-
-                    input_message = [ChatMessage(role=MessageRole.SYSTEM, content=system_prompt),
-                                    ChatMessage(role=MessageRole.SYSTEM, content=report_input),
-                                    ChatMessage(role=MessageRole.USER, content=f"Please generate a report about: {ticker_to_research}\n\n\n")]
-                    
-                    llm_groq = Groq(model="llama3-70b-8192", api_key=GROQ_API_KEY)
-                    final_report = llm_groq.chat(input_message).message.content
-                    st.session_state.final_report = final_report
-
-                st.session_state["report_generated"] = True
+                    stage_container = st.empty()
+                    for job in job.updates(timeout=JOB_POLL_SECONDS):
+                        stage_container.caption("Waiting for a free worker..." if job.status == QUEUED else job.stage)
+                        if job.text and not final_report:
+                            final_report_container.markdown(job.text)
+                    stage_container.empty()
+
+            if job is not None and job.status == DONE and not st.session_state.get("agent_created"):
+                result = job.result
+                for warning in result.warnings:
+                    st.warning(warning)
+                st.session_state["source_timings"] = {name: source.total_seconds for name, source in result.source_results.items()}
+                if result.report:
+                    # A rebuild's trace only covers the tools, the panel keeps the report's
+                    st.session_state["report_trace"] = job.trace
+                if not final_report:
+                    final_report = result.report
+                    st.session_state["final_report"] = final_report
+                research_assistant.create_agent()
+                st.session_state["agent_created"] = True
+            elif job is not None and job.status == CANCELLED:
+                st.info("Report cancelled.")
+            elif job is not None and job.error is not None:
+                st.error(f"Could not generate the report: {job.error}")
+
+            if final_report:
                 final_report_container.markdown(final_report)
-
-                if "agent_created" not in st.session_state or not st.session_state["agent_created"]:
-                    research_assistant.create_agent()
-                    st.session_state["agent_created"] = True
-
-            status.update(label="Generating Reports", state="complete", expanded=True)
-
-        # Load existing messages
-        assistant_chat_history = research_assistant.get_chat_history()
-        if len(assistant_chat_history) > 0:
-            logger.debug("Loading chat history")
-            st.session_state["messages"] = assistant_chat_history
-        else:
-            logger.debug("No chat history found")
-            st.session_state["messages"] = [{"role": "assistant", "content": f"Ask me questions about {ticker_to_research}..."}]
+            status.update(label="Generating Reports", state="complete" if job is None or job.done else "running", expanded=True)
+
+        if st.session_state.get("agent_created"):
+            # Load existing messages
+            assistant_chat_history = research_assistant.get_chat_history()
+            if len(assistant_chat_history) > 0:
+                logger.debug("Loading chat history")
+                st.session_state["messages"] = assistant_chat_history
+            else:
+                logger.debug("No chat history found")
+                st.session_state["messages"] = [{"role": "assistant", "content": f"Ask me questions about {report_ticker}..."}]
+
+            # An answer still streaming from an interrupted run is not in the agent history yet
+            chat_stream = st.session_state.get("chat_stream")
+            if chat_stream is not None:
+                if chat_stream.done:
+                    st.session_state["chat_stream"] = None
+                else:
+                    st.session_state["messages"].append({"role": "user", "content": chat_stream.prompt})
         
-        # Prompt for user input
-        if prompt := st.chat_input():
-            st.session_state["messages"].append({"role": "user", "content": prompt})
-
-        # Display existing chat messages
-        for message in st.session_state["messages"]:
-            if message["role"] == "system":
-                continue
-            with st.chat_message(message["role"]):
-                st.write(message["content"])
-
-        # If last message is from a user, generate a new response
-        last_message = st.session_state["messages"][-1]
-        if last_message.get("role") == "user":
-            question = last_message["content"]
-            with st.chat_message("assistant"):
-                response = ""
-                resp_container = st.empty()
-                response = research_assistant.agent.chat(question)
-                response = str(response).split(":")[-1].strip()
-                resp_container.markdown(response)
-                st.session_state["messages"].append({"role": "assistant", "content": response})
+            # Prompt for user input
+            if prompt := st.chat_input():
+                st.session_state["messages"].append({"role": "user", "content": prompt})
+
+            # Display existing chat messages
+            for message in st.session_state["messages"]:
+                if message["role"] == "system":
+                    continue
+                with st.chat_message(message["role"]):
+                    st.write(message["content"])
+
+            # If last message is from a user, generate a new response
+            last_message = st.session_state["messages"][-1]
+            if last_message.get("role") == "user":
+                question = last_message["content"]
+                with st.chat_message("assistant"):
+                    resp_container = st.empty()
+                    chat_stream = st.session_state.get("chat_stream")
+                    if chat_stream is None or chat_stream.prompt != question:
+                        if chat_stream is not None:
+                            # The agent handles one question at a time
+                            chat_stream.wait()
+                        chat_stream = research_assistant.stream_chat(question)
+                        st.session_state["chat_stream"] = chat_stream
+
+                    for response in chat_stream:
+                        resp_container.markdown(response)
+                    st.session_state["chat_stream"] = None
+                    st.session_state["chat_trace"] = chat_stream.trace
+
+                    if chat_stream.error is not None:
+                        resp_container.error(f"Could not answer: {chat_stream.error}")
+                    else:
+                        st.session_state["messages"].append({"role": "assistant", "content": chat_stream.result})
 
     st.sidebar.markdown("---")
+    if st.sidebar.checkbox("Latency Breakdown", value=False):
+        if st.session_state.get("report_trace") is not None:
+            show_latency_breakdown("Report", st.session_state["report_trace"])
+        if st.session_state.get("chat_trace") is not None:
+            show_latency_breakdown("Last answer", st.session_state["chat_trace"])
+        from answer_cache import answer_cache
+
+        cache_stats = answer_cache.stats()
+        st.sidebar.caption(f"Answer cache: {cache_stats['hit_rate']:.0%} hit rate, "
+                           f"{cache_stats['seconds_saved']:.1f}s saved")
+
+    if st.sidebar.checkbox("Startup Timing", value=False):
+        st.sidebar.table([{"step": row["step"], "at (s)": f"{row['at']:.2f}", "seconds": f"{row['seconds']:.2f}",
+                           "thread": row["thread"]} for row in startup.timings()])
+
+    if st.sidebar.checkbox("Memory Usage", value=False):
+        from registry import registry
+
+        usage = registry.usage(st.session_state["session_id"])
+        st.sidebar.caption(f"{usage['total_mb']:.1f} MB held by {len(usage['tickers'])} tickers, "
+                           f"{usage['sessions_evicted']} idle sessions evicted")
+        st.sidebar.table({ticker: {"sessions": row["sessions"], "MB": f"{row['mb']:.1f}"} for ticker, row in usage["tickers"].items()})
+        for row in usage["sessions"].values():
+            st.sidebar.caption(f"This session: {row['mb']:.2f} MB of chat history")
+
     if st.sidebar.button("New Run"):
         restart_assistant()
 
+    startup.record("first render", startup.PROCESS_START, time.perf_counter() - startup.PROCESS_START)
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,77 +1,326 @@
 import os
+import re
+import uuid
+from functools import cached_property
+from typing import List, Optional
 
+import numpy as np
 from dotenv import load_dotenv
 
-from llama_index.core import Settings, VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core import Settings, StorageContext, VectorStoreIndex, SimpleDirectoryReader
+from llama_index.core.query_engine import RetrieverQueryEngine
+from llama_index.core.response_synthesizers import get_response_synthesizer
 from llama_index.core.tools import QueryEngineTool, ToolMetadata, FunctionTool
-from llama_index.core.agent import FunctionCallingAgentWorker
 from llama_index.core.schema import Document
-from llama_index.core.base.llms.types import MessageRole
-from llama_index.llms.anthropic import Anthropic
+from llama_index.core.base.llms.types import ChatMessage, MessageRole
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters
+from phi.utils.log import logger
 
-from llama_parse import LlamaParse
+from agent import StreamingFunctionCallingAgentWorker
+from answer_cache import CachedQueryEngine, answer_cache, data_version, normalize_question
+from document_cache import DocumentCache
+from embeddings import embedding_service, get_embed_model
+from financial_series import changes_table, price_history_table, ratios_table, rolling_table
+from ingestion import PDF_BACKEND, OnProgress, PdfIngestionError, get_page_parser, ingest_pdf, tag_documents
+from llm_tracing import llm_span_callbacks
+from market_data import fetch_price_history
+from startup import lazy_callable
+from streaming import ChatStream
+from ttl_cache import MARKET_DATA_TTLS
+from tracing import Trace, span
+from vector_store import VECTOR_STORE, open_vector_store
 
 load_dotenv()
 
+# Imported when the first assistant needs its LLM or PDF parser
+Anthropic = lazy_callable("llama_index.llms.anthropic", "Anthropic")
+LlamaParse = lazy_callable("llama_parse", "LlamaParse")
+
 LLAMA_CLOUD_API_KEY = os.environ.get('LLAMAPARSE_API_KEY')
 CLAUDE_API_KEY = os.environ.get('CLAUDE_API_KEY')
+# Sections up to this size are served to the agent directly instead of through a vector index
+SMALL_SECTION_MAX_CHARS = int(os.environ.get('FICO_SMALL_SECTION_MAX_CHARS', 8000))
+# streaming indexes a PDF page range by page range, batch parses the whole file before embedding
+INGESTION_MODE = os.environ.get('FICO_INGESTION', "streaming")
+
+# yfinance history arguments accepted by the price history tool, interval -> periods per year
+HISTORY_PERIODS = ["1mo", "3mo", "6mo", "1y", "2y", "5y", "10y", "ytd", "max"]
+HISTORY_INTERVALS = {"1d": 252, "1wk": 52, "1mo": 12, "3mo": 4}
+HISTORY_MAX_ROWS = 60
+# Tools reading live market data outside the data versions, name -> seconds an answer using them stays cached
+LIVE_TOOL_TTLS = {"price_history": MARKET_DATA_TTLS["history"][0]}
+
+# Query engines hand their callback manager to their LLM, this one records the LLM calls with their tokens
+synthesis_callbacks = llm_span_callbacks("llm.synthesis")
+
+LOOKUP_STOPWORDS = {"what", "which", "when", "where", "who", "how", "the", "and", "for", "are", "was", "were",
+                    "about", "from", "with", "that", "this", "have", "has", "give", "show", "tell", "list",
+                    "latest", "recent", "stock", "stocks", "company", "please"}
+
+def section_lookup(md: str, query: str = "") -> str:
+    """Returns a small markdown section, narrowed to the matching table rows when the query names any"""
+    lines = md.splitlines()
+    table_rows = [i for i, line in enumerate(lines) if line.startswith("|")]
+    terms = [term for term in re.findall(r"\w+", query.lower()) if len(term) > 2 and term not in LOOKUP_STOPWORDS]
+    if len(table_rows) <= 2 or not terms:
+        return md
+
+    header, body = lines[table_rows[0]:table_rows[0]+2], lines[table_rows[0]+2:table_rows[-1]+1]
+    matches = [row for row in body if any(term in row.lower() for term in terms)]
+    if not matches or len(matches) == len(body):
+        return md
+    return "\n".join(header + matches)
+
+def price_history_tool(ticker: str) -> FunctionTool:
+    """The price history tool of a ticker, bound to the ticker alone so sessions can share it"""
+    def price_history(period: str = "1y", interval: str = "1mo") -> str:
+        """Closing prices of the stock over period (1mo, 3mo, 6mo, 1y, 2y, 5y, 10y, ytd, max) sampled every interval (1d, 1wk, 1mo, 3mo), with period returns, CAGR, annualized volatility and max drawdown"""
+        if period not in HISTORY_PERIODS or interval not in HISTORY_INTERVALS:
+            return f"period must be one of {HISTORY_PERIODS} and interval one of {list(HISTORY_INTERVALS)}"
+        history = fetch_price_history(ticker, period, interval)
+        if history is None or history.empty:
+            return f"No price history found for {ticker}."
+
+        closes = history["Close"].dropna()
+        labels = [date.strftime("%Y-%m-%d") for date in closes.index]
+        step = max(1, int(np.ceil(len(closes) / HISTORY_MAX_ROWS)))
+        # Keep the table short for the agent context by sampling every step-th close, ending on the latest one
+        rows = np.arange(len(closes) - 1, -1, -step)[::-1]
+        return price_history_table(closes.to_numpy()[rows], [labels[i] for i in rows], HISTORY_INTERVALS[interval] / step)
+
+    return FunctionTool.from_defaults(fn=price_history)
+
+class TickerState:
+    """Indexes and tools of a ticker, built once and used read-only by every session researching it"""
+
+    def __init__(self):
+        self.tools = {}
+        self.query_engines = {}
+        # tool name -> stamp of the data behind it, part of the answer cache keys
+        self.data_versions = {}
+        # tool name -> size of a small section served without an index
+        self.section_chars = {}
+        # tool name -> hash of the annual report behind it
+        self.documents = {}
+        self.information_included = ""
+        # Tells this build of the ticker's tools from one made after it was evicted
+        self.key = uuid.uuid4().hex
 
 class Assistant:
-    def __init__(self, ticker: str):
+    def __init__(self, ticker: str, state: Optional[TickerState] = None):
         self.ticker = ticker
         self.stock_name = ticker.lower().replace(".", "_")
+        # Shared with the other sessions of the ticker when given, the agent and its chat history are not
+        self.state = state if state is not None else TickerState()
 
-        self.llm = Anthropic(model="claude-3-haiku-20240307", api_key=CLAUDE_API_KEY)
-        self.parser = LlamaParse(api_key=LLAMA_CLOUD_API_KEY, result_type="markdown")
+        # Shared by all assistants in the process, loaded once and batched across sessions
+        Settings.embed_model = get_embed_model()
 
-        self.file_extractor = {".pdf": self.parser}
+        # Clients and tools are built the first time they are needed
+        self.agent = None
+        self.agent_version = ""
 
-        Settings.llm = self.llm
-        Settings.embed_model = "local:BAAI/bge-small-en-v1.5"
-        
+    @cached_property
+    def llm(self):
+        llm = Anthropic(model="claude-3-haiku-20240307", api_key=CLAUDE_API_KEY)
+        Settings.llm = llm
+        return llm
+
+    @cached_property
+    def synthesis_llm(self):
+        # Answers the query engines inside tools and the annual report summary, its calls are traced through callbacks
+        return Anthropic(model="claude-3-haiku-20240307", api_key=CLAUDE_API_KEY, callback_manager=synthesis_callbacks)
+
+    def synthesis_query_engine(self, index: VectorStoreIndex, **retriever_kwargs):
+        synthesizer = get_response_synthesizer(llm=self.synthesis_llm, callback_manager=synthesis_callbacks,
+                                               response_mode="compact")
+        return RetrieverQueryEngine(index.as_retriever(**retriever_kwargs), response_synthesizer=synthesizer,
+                                    callback_manager=synthesis_callbacks)
+
+    @cached_property
+    def parser(self):
+        return LlamaParse(api_key=LLAMA_CLOUD_API_KEY, result_type="markdown")
+
+    @cached_property
+    def page_parser(self):
+        return get_page_parser(PDF_BACKEND, self.parser if PDF_BACKEND == "llamaparse" else None)
+
+    @cached_property
+    def file_extractor(self):
+        return {".pdf": self.parser} if PDF_BACKEND == "llamaparse" else {}
+
+    @cached_property
+    def document_cache(self) -> DocumentCache:
+        return DocumentCache(embed_model=embedding_service.embedding_id, parser_version=self.page_parser.version)
+
+    def add_base_tools(self):
+        if "evolution_tool" in self.tools:
+            return
         evolution_tool = FunctionTool.from_defaults(fn=self.evolution)
         evolution_perc_tool = FunctionTool.from_defaults(fn=self.evolution_perc)
         cagr_tool = FunctionTool.from_defaults(fn=self.cagr)
         pe_tool = FunctionTool.from_defaults(fn=self.price_earning_ratio)
-        self.tools = {"evolution_tool": evolution_tool, 
-                      "evolution_perc_tool": evolution_perc_tool, 
-                      "cagr_tool": cagr_tool, 
-                      "pe_tool": pe_tool}
-        self.query_engines = {}
+        self.tools.update({"evolution_tool": evolution_tool, 
+                           "evolution_perc_tool": evolution_perc_tool, 
+                           "cagr_tool": cagr_tool, 
+                           "pe_tool": pe_tool,
+                           "growth_series_tool": FunctionTool.from_defaults(fn=self.growth_series),
+                           "ratio_series_tool": FunctionTool.from_defaults(fn=self.ratio_series),
+                           "rolling_average_tool": FunctionTool.from_defaults(fn=self.rolling_average_series),
+                           "price_history_tool": price_history_tool(self.ticker)})
 
-    def create_query_engine_tool_from_document(self, file_path: str, tool_name: str, tool_description: str):
-        dir_reader = SimpleDirectoryReader(input_files=[file_path], file_extractor=self.file_extractor)
-        documents = dir_reader.load_data(show_progress=True)
+    @property
+    def tools(self):
+        return self.state.tools
 
-        if documents:
-            # Index the documents in a vectorStore
-            vector_index = VectorStoreIndex.from_documents(documents)
-            query_engine_ = vector_index.as_query_engine(response_mode="compact")
+    @property
+    def query_engines(self):
+        return self.state.query_engines
 
-            query = "Summarize all information included in the documents? write in bullet points."
-            self.information_included = query_engine_.query(query).response
+    @property
+    def data_versions(self):
+        return self.state.data_versions
 
-            #Create the Query Engine Tool over the RAG pipeline
-            query_engine_tool_ = QueryEngineTool(
-                query_engine=query_engine_,
-                metadata=ToolMetadata(
-                    name=tool_name,
-                    description=tool_description,
-                ),
-            )
+    @property
+    def information_included(self) -> str:
+        return self.state.information_included
 
-            self.tools[tool_name] = query_engine_tool_
-            self.query_engines[tool_name] = query_engine_
+    @information_included.setter
+    def information_included(self, value: str):
+        self.state.information_included = value
 
-            return True
+    def create_query_engine_tool_from_document(self, file_path: str, tool_name: str, tool_description: str,
+                                               on_progress: Optional[OnProgress] = None):
+        store = storage_context = source_metadata = None
+        with span("annual_report.cache") as cache_span:
+            content_hash = self.document_cache.file_hash(file_path)
+            if self.state.documents.get(tool_name) == content_hash and tool_name in self.tools:
+                # Another session of the ticker already loaded this report
+                cache_span.set(hit=True, shared=True)
+                return True
+            if VECTOR_STORE == "mmap":
+                # All annual reports of the ticker share one store on disk, shared by every session and process
+                store = open_vector_store(self.ticker, "annualreport", embedding_service.embedding_id)
+                source = data_version(content_hash, self.page_parser.version)
+                summary = store.sources().get(source)
+                cached_index = (VectorStoreIndex.from_vector_store(store), summary) if summary is not None else None
+            else:
+                cached_index = self.document_cache.get_index(content_hash)
+            cache_span.set(hit=cached_index is not None)
+
+        if cached_index is not None:
+            vector_index, self.information_included = cached_index
+            query_engine_ = self.synthesis_query_engine(vector_index)
         else:
-            return False
+            if store is not None:
+                # Drop what an interrupted run left of this report before adding it again
+                store.delete_where("fico_source", source)
+                storage_context = StorageContext.from_defaults(vector_store=store)
+                source_metadata = {"fico_source": source}
+
+            documents = self.document_cache.get_documents(content_hash)
+            with span("annual_report.ingest", mode=INGESTION_MODE if documents is None else "cached_documents"):
+                if documents is None and INGESTION_MODE == "streaming":
+                    # Parse, chunk and embed page ranges as they come instead of loading the whole PDF first
+                    # Kept so a new embedding model or backend re-indexes without parsing the PDF again
+                    try:
+                        with self.document_cache.document_ranges(content_hash) as put_range:
+                            vector_index = ingest_pdf(file_path, self.page_parser, on_progress=on_progress,
+                                                      storage_context=storage_context, metadata=source_metadata,
+                                                      on_range=put_range)
+                    except PdfIngestionError as e:
+                        logger.warning(f"Could not read PDF {file_path}: {e}")
+                        return False
+                    if vector_index is None:
+                        return False
+                else:
+                    if documents is None:
+                        dir_reader = SimpleDirectoryReader(input_files=[file_path], file_extractor=self.file_extractor)
+                        try:
+                            documents = dir_reader.load_data(show_progress=True)
+                        except Exception as e:
+                            logger.warning(f"Could not read PDF {file_path}: {e}")
+                            return False
+                        if documents:
+                            self.document_cache.put_documents(content_hash, documents)
+
+                    if not documents:
+                        return False
+                    if source_metadata:
+                        tag_documents(documents, source_metadata)
+
+                    # Index the documents in a vectorStore
+                    vector_index = VectorStoreIndex.from_documents(documents, storage_context=storage_context)
+
+            query_engine_ = self.synthesis_query_engine(vector_index)
+
+            with span("annual_report.summary"):
+                query = "Summarize all information included in the documents? write in bullet points."
+                summary_engine = query_engine_
+                if store is not None:
+                    summary_engine = self.synthesis_query_engine(
+                        vector_index, filters=MetadataFilters(filters=[MetadataFilter(key="fico_source", value=source)]))
+                self.information_included = summary_engine.query(query).response
+
+            if store is not None:
+                store.add_source(source, self.information_included)
+            else:
+                self.document_cache.put_index(content_hash, vector_index, self.information_included)
+
+        if store is not None:
+            # The tool searches every report added to the store so far
+            version = data_version(embedding_service.embedding_id, *sorted(store.sources()))
+        else:
+            version = data_version(content_hash, self.page_parser.version, embedding_service.embedding_id)
+        self.set_data_version(tool_name, version)
+        query_engine_ = CachedQueryEngine(query_engine_, self.ticker, tool_name, version)
+
+        #Create the Query Engine Tool over the RAG pipeline
+        query_engine_tool_ = QueryEngineTool(
+            query_engine=query_engine_,
+            metadata=ToolMetadata(
+                name=tool_name,
+                description=tool_description,
+            ),
+        )
+
+        self.tools[tool_name] = query_engine_tool_
+        self.query_engines[tool_name] = query_engine_
+        self.state.documents[tool_name] = content_hash
+
+        return True
     
-    def create_query_engine_tool_from_md(self, md: str, tool_name: str, tool_description: str):
+    def set_data_version(self, tool_name: str, version: str):
+        """Records the data behind a tool, dropping cached answers about the data it replaces"""
+        previous = self.data_versions.get(tool_name)
+        if previous is not None and previous != version:
+            answer_cache.invalidate(self.ticker, tool_name)
+            answer_cache.invalidate(self.ticker, "agent")
+        self.data_versions[tool_name] = version
+
+    def create_query_engine_tool_from_md(self, md: str, tool_name: str, tool_description: str) -> bool:
+        """Registers the tool of a market data section, returns False when the same one was already there"""
+        version = data_version(md)
+        if self.data_versions.get(tool_name) == version and tool_name in self.tools:
+            # Built from the same data by another session of the ticker
+            return False
+        self.set_data_version(tool_name, version)
+
+        if len(md) <= SMALL_SECTION_MAX_CHARS:
+            # Small sections fit in the agent context as they are, skip embedding and synthesis
+            def lookup_section(query: str = "") -> str:
+                return section_lookup(md, query)
+
+            self.tools[tool_name] = FunctionTool.from_defaults(fn=lookup_section, name=tool_name, description=tool_description)
+            self.query_engines.pop(tool_name, None)
+            self.state.section_chars[tool_name] = len(md)
+            self.agent = None
+            return True
+
         doc_ = Document.from_dict({'text': md})
         index_ = VectorStoreIndex.from_documents([doc_])
         
-        query_engine_ = index_.as_query_engine(response_mode="compact")
+        query_engine_ = CachedQueryEngine(self.synthesis_query_engine(index_), self.ticker, tool_name, version)
 
         query_engine_tool_ = QueryEngineTool(
             query_engine=query_engine_,
@@ -83,10 +332,20 @@ class Assistant:
             
         self.tools[tool_name] = query_engine_tool_
         self.query_engines[tool_name] = query_engine_
+        self.state.section_chars.pop(tool_name, None)
 
         self.agent = None
-    
+        return True
+
+    def remove_tool(self, tool_name: str):
+        self.tools.pop(tool_name, None)
+        self.query_engines.pop(tool_name, None)
+        self.state.section_chars.pop(tool_name, None)
+        self.data_versions.pop(tool_name, None)
+        self.agent = None
+
     def create_agent(self):
+        self.add_base_tools()
         system_prompt = f"""You are a usefull asstistant for financial analysis. Answer the question related to that company. 
             Use the {self.stock_name+"_upgrades_downgrades_md"} tool to get upgrades and downgrades of the stocks.
             Carefully read the information and provide a clear and concise answer to the user.
@@ -96,7 +355,11 @@ class Assistant:
             - evolution tool: to get the evolution from value b to value a. use number for input value a and b.
             - evolution perc tool: to get the evolution in percentage from value b to value a. use number for input value a and b.
             - cagr tool: to get the compound annual growth rate CAGR from value b to value a over n period. use number for input value a and b and n.
-            - price_earning_ratio tool: to get the price per earning ratio is a ratio of the share price devided by the earning per share(EPS) value. use number for input price and eps."""
+            - price_earning_ratio tool: to get the price per earning ratio is a ratio of the share price devided by the earning per share(EPS) value. use number for input price and eps.
+            - growth_series tool: to get the change and change in percent of every period of a series (e.g. revenue of the last 5 years, oldest first) plus the total change and CAGR in one call. prefer it over calling evolution or cagr once per period.
+            - ratio_series tool: to divide two series period by period, e.g. margins or P/E for every year in one call.
+            - rolling_average_series tool: to get the trailing average of a series over a window of periods.
+            - price_history tool: to get the closing prices of the stock with period returns, CAGR, volatility and max drawdown."""
         if self.stock_name+"_company_info" in self.tools:
             system_prompt += f"""\n- {self.stock_name+"_company_info"} tool: to get current information of the stock or company like company name, current stock price, etc."""
         if self.stock_name+"_company_news" in self.tools:
@@ -108,28 +371,80 @@ class Assistant:
         if self.stock_name+"_annualreport" in self.tools:
             system_prompt += f"""\n- {self.stock_name+"_annualreport"} tool: to get information about annual report. this is the information included in the annual report:\n{self.information_included}"""
             
-        agent_worker = FunctionCallingAgentWorker.from_tools(
-                list(self.tools.values()), verbose=True, llm=self.llm,
-                system_prompt=system_prompt
-            )
+        with span("agent.create", tools=len(self.tools)):
+            self.agent_worker = StreamingFunctionCallingAgentWorker.from_tools(
+                    list(self.tools.values()), verbose=True, llm=self.llm,
+                    system_prompt=system_prompt
+                )
+
+            self.agent = self.agent_worker.as_agent()
+        self.agent_version = data_version(*(f"{name}={version}" for name, version in sorted(self.data_versions.items())))
 
-        self.agent = agent_worker.as_agent()
+    def stream_chat(self, question: str) -> ChatStream:
+        # Tools the answer was derived from, those reading live data limit how long it is cached
+        used_tools = set()
+
+        def answer(on_delta):
+            self.agent_worker.on_delta = on_delta
+            try:
+                chat_response = self.agent.chat(question)
+            finally:
+                self.agent_worker.on_delta = None
+            used_tools.update(source.tool_name for source in chat_response.sources)
+            return str(chat_response).removeprefix(f"{MessageRole.ASSISTANT.value}: ").strip()
+
+        def answer_ttl(response):
+            ttls = [LIVE_TOOL_TTLS[tool] for tool in used_tools if tool in LIVE_TOOL_TTLS]
+            return min(ttls) if ttls else None
+
+        def produce(on_delta):
+            # Follow-up questions depend on the conversation so far, which is part of the key
+            earlier_questions = [normalize_question(str(chat.content)) for chat in self.agent.chat_history if chat.role == MessageRole.USER]
+            version = data_version(self.agent_version, *earlier_questions)
+            response, hit = answer_cache.get_or_compute(self.ticker, "agent", version, question, lambda: answer(on_delta),
+                                                        ttl=answer_ttl)
+            if hit:
+                self.agent.memory.put(ChatMessage(role=MessageRole.USER, content=question))
+                self.agent.memory.put(ChatMessage(role=MessageRole.ASSISTANT, content=response))
+            logger.debug(f"Answer cache: {answer_cache.stats()}")
+            return response
+
+        return ChatStream("agent_chat", question, produce, trace=Trace("chat", ticker=self.ticker))
 
     def get_chat_history(self):
         return [{"role": chat.role.value, "content": chat.content} for chat in self.agent.chat_history if chat.role in [MessageRole.USER, MessageRole.ASSISTANT] and len(chat.additional_kwargs.get('tool_calls', [])) == 0]
     
-    def evolution(self, a: float, b: float) -> float:
+    @staticmethod
+    def evolution(a: float, b: float) -> float:
         """Evolution from value b to value a"""
         return f"{a-b}"
 
-    def evolution_perc(self, a: float, b: float) -> float:
+    @staticmethod
+    def evolution_perc(a: float, b: float) -> float:
         """Evolution in percentage from value b to value a"""
         return f"{round(100*(a/b-1),0)}%"
 
-    def cagr(self, a: float, b: float, n: int) -> float:
+    @staticmethod
+    def cagr(a: float, b: float, n: int) -> float:
         """Compound annual growth rate CAGR from value b to value a over n period"""
         return f"{round(100*((a/b)**(1/n)-1),0)}%"
 
-    def price_earning_ratio(self, price: float, eps: float) -> float:
+    @staticmethod
+    def price_earning_ratio(price: float, eps: float) -> float:
         """Price per earning ratio is a ratio of the share price devided by the earning per share(EPS) value"""
-        return price/eps
\ No newline at end of file
+        return price/eps
+
+    @staticmethod
+    def growth_series(values: List[float], labels: Optional[List[str]] = None, periods_per_year: float = 1) -> str:
+        """Change and change in percent of every period of a series of values ordered oldest first (e.g. revenue per year), with the total change and CAGR. labels name the periods (e.g. years), periods_per_year is 4 for quarterly values"""
+        return changes_table(values, labels, periods_per_year)
+
+    @staticmethod
+    def ratio_series(numerators: List[float], denominators: List[float], labels: Optional[List[str]] = None) -> str:
+        """Ratio numerator / denominator of two series period by period, e.g. net income / revenue for the net margin or price / EPS for the P/E ratio of every year"""
+        return ratios_table(numerators, denominators, labels)
+
+    @staticmethod
+    def rolling_average_series(values: List[float], window: int, labels: Optional[List[str]] = None) -> str:
+        """Trailing average of a series over window periods and every value relative to it"""
+        return rolling_table(values, window, labels)
\ No newline at end of file
@@ -0,0 +1,134 @@
+"""Generate reports for a watchlist without the Streamlit UI.
+
+    python batch_report.py watchlist.txt --output-dir reports --concurrency 4
+
+The watchlist has one ticker per line (blank lines and `#` comments are ignored).
+Each report is written to `<output-dir>/<TICKER>.md` and its timings appended to
+`<output-dir>/timings.jsonl`. Finished tickers are recorded in
+`<output-dir>/progress.json`, so rerunning the same command after a crash only
+processes the tickers that are left.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, List, Optional
+
+from phi.utils.log import logger
+
+from market_data import RateLimiter, rate_limiters
+from pipeline import DEFAULT_SOURCES, run_report
+
+# Calls per minute for each upstream provider
+DEFAULT_RATE_LIMITS = {"yfinance": 120, "ddgs": 20, "groq": 30}
+
+def read_watchlist(path: str) -> List[str]:
+    tickers = []
+    with open(path) as f:
+        for line in f:
+            ticker = line.split("#")[0].strip()
+            if ticker and ticker not in tickers:
+                tickers.append(ticker)
+    return tickers
+
+def parse_rate_limits(values: List[str]) -> Dict[str, float]:
+    rate_limits = {}
+    for value in values:
+        provider, _, rate = value.partition("=")
+        if not rate:
+            raise argparse.ArgumentTypeError(f"Expected PROVIDER=PER_MINUTE, got {value}")
+        rate_limits[provider] = float(rate)
+    return rate_limits
+
+def _write_atomic(path: str, content: str):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+class Checkpoint:
+    """Progress of a batch run, saved after every ticker"""
+
+    def __init__(self, path: str, reset: bool = False):
+        self.path = path
+        self.progress: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if not reset and os.path.exists(path):
+            with open(path) as f:
+                self.progress = json.load(f)
+
+    def is_done(self, ticker: str) -> bool:
+        return self.progress.get(ticker, {}).get("status") == "done"
+
+    def mark(self, ticker: str, status: str, **info):
+        with self._lock:
+            self.progress[ticker] = {"status": status, "updated": time.time(), **info}
+            _write_atomic(self.path, json.dumps(self.progress, indent=2))
+
+def run_batch(tickers: List[str], output_dir: str, concurrency: int = 4, sources: List[str] = DEFAULT_SOURCES,
+              restart: bool = False, llm=None) -> Dict[str, dict]:
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = Checkpoint(os.path.join(output_dir, "progress.json"), reset=restart)
+    pending = [ticker for ticker in tickers if not checkpoint.is_done(ticker)]
+    logger.info(f"{len(tickers) - len(pending)} of {len(tickers)} tickers already done, {len(pending)} to go")
+
+    timings_lock = threading.Lock()
+    # Own pool for the gathering stage so queued tickers do not eat into the per-source timeouts
+    gather_executor = ThreadPoolExecutor(max_workers=concurrency * len(sources), thread_name_prefix="fico-batch-gather")
+
+    def run(ticker: str):
+        start = time.perf_counter()
+        result = run_report(ticker, sources, llm=llm, executor=gather_executor)
+        report_path = os.path.join(output_dir, ticker.replace("/", "_") + ".md")
+        _write_atomic(report_path, result.report)
+
+        timings = {**result.timings(), "total_seconds": time.perf_counter() - start}
+        with timings_lock:
+            with open(os.path.join(output_dir, "timings.jsonl"), 'a') as f:
+                f.write(json.dumps(timings) + "\n")
+        checkpoint.mark(ticker, "done", report=report_path, seconds=timings["total_seconds"])
+
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="fico-batch") as pool:
+            futures = {pool.submit(run, ticker): ticker for ticker in pending}
+            for i, future in enumerate(as_completed(futures), start=1):
+                ticker = futures[future]
+                try:
+                    future.result()
+                    logger.info(f"[{i}/{len(pending)}] {ticker} done")
+                except Exception as e:
+                    logger.error(f"[{i}/{len(pending)}] {ticker} failed: {e}")
+                    checkpoint.mark(ticker, "failed", error=str(e))
+    finally:
+        gather_executor.shutdown(wait=False)
+
+    return checkpoint.progress
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Generate FICO reports for a watchlist of tickers.")
+    parser.add_argument("watchlist", help="File with one ticker per line")
+    parser.add_argument("--output-dir", default="reports", help="Where reports, timings and progress are written")
+    parser.add_argument("--concurrency", type=int, default=4, help="Tickers processed at the same time")
+    parser.add_argument("--sources", nargs="+", default=DEFAULT_SOURCES, choices=DEFAULT_SOURCES)
+    parser.add_argument("--rate-limit", action="append", default=[], metavar="PROVIDER=PER_MINUTE",
+                        help=f"Upstream calls per minute, defaults: {DEFAULT_RATE_LIMITS}")
+    parser.add_argument("--restart", action="store_true", help="Ignore saved progress and redo every ticker")
+    args = parser.parse_args(argv)
+
+    for provider, rate in {**DEFAULT_RATE_LIMITS, **parse_rate_limits(args.rate_limit)}.items():
+        rate_limiters[provider] = RateLimiter(rate)
+
+    tickers = read_watchlist(args.watchlist)
+    progress = run_batch(tickers, args.output_dir, args.concurrency, args.sources, args.restart)
+
+    failed = [ticker for ticker in tickers if progress.get(ticker, {}).get("status") != "done"]
+    if failed:
+        logger.error(f"{len(failed)} tickers failed: {', '.join(failed)}")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+"""Offline benchmarks of the report and chat flows against stand-in providers.
+
+    python -m benchmarks.run --repeat 3
+    python -m benchmarks.run --compare benchmarks/results/<previous run>.json
+
+Results are written as JSON with one entry per scenario (median, min and max
+seconds over the repeats plus peak traced memory), so runs from two commits
+can be compared with `--compare`.
+"""
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import statistics
+import tempfile
+import tracemalloc
+import contextlib
+import subprocess
+from typing import Callable, Dict, List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stubs import StubConfig, stub_providers, text, markdown_table, write_pdf
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+MD_SIZES = [2000, 8000, 32000, 128000]
+PDF_PAGES = [5, 20, 80]
+QUESTIONS = ["What is the latest news about the company?", "Summarize the analyst recommendations.",
+             "How did revenue change according to the annual report?"]
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(RESULTS_DIR), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def measure(run: Callable[[int], Optional[Dict[str, float]]], repeat: int, memory: bool = True) -> Dict[str, object]:
+    """Times `run(i)` `repeat` times, then runs it once more under tracemalloc for the memory peak.
+
+    `run` may return extra per-run metrics (e.g. time to first token), which are reported as medians.
+    """
+    seconds = []
+    extras: Dict[str, List[float]] = {}
+    for i in range(repeat):
+        start = time.perf_counter()
+        extra = run(i) or {}
+        seconds.append(time.perf_counter() - start)
+        for key, value in extra.items():
+            if value is not None:
+                extras.setdefault(key, []).append(value)
+
+    result: Dict[str, object] = {"seconds": statistics.median(seconds), "min_seconds": min(seconds),
+                                 "max_seconds": max(seconds), "runs": len(seconds)}
+    result.update({key: statistics.median(values) for key, values in extras.items()})
+    if memory:
+        tracemalloc.start()
+        try:
+            run(repeat)
+            result["peak_memory_mb"] = tracemalloc.get_traced_memory()[1] / 1024**2
+        finally:
+            tracemalloc.stop()
+    return result
+
+def md_section(chars: int, seed) -> str:
+    """Markdown resembling a market data section: a short text followed by a table"""
+    return f"{text(min(chars // 4, 2000), seed)}\n\n{markdown_table(max(1, (chars - min(chars // 4, 2000)) // 45), seed)}"
+
+def bench_md_tools(cache_dir: str, repeat: int, memory: bool) -> Dict[str, object]:
+    from assistant import Assistant
+
+    results = {}
+    for chars in MD_SIZES:
+        def run(i, chars=chars):
+            assistant = Assistant(ticker="BENCH.JK")
+            assistant.create_query_engine_tool_from_md(md_section(chars, (chars, i)), "bench_jk_section", "Benchmark section")
+        results[f"md_tool.{chars}_chars"] = measure(run, repeat, memory)
+    return results
+
+def bench_document_tools(cache_dir: str, repeat: int, memory: bool) -> Dict[str, object]:
+    import vector_store
+    from assistant import Assistant
+    from document_cache import DocumentCache
+    from embeddings import embedding_service
+
+    def assistant_with_cache(document_cache_dir: str) -> Assistant:
+        # The mmap vector store lives next to the document cache, a cold run finds neither
+        vector_store.VECTOR_STORE_DIR = os.path.join(document_cache_dir, "vectors")
+        assistant = Assistant(ticker="BENCH.JK")
+        assistant.document_cache = DocumentCache(embed_model=embedding_service.embedding_id,
+                                                 parser_version=assistant.page_parser.version,
+                                                 cache_dir=document_cache_dir)
+        return assistant
+
+    results = {}
+    vector_store_dir = vector_store.VECTOR_STORE_DIR
+    try:
+        for pages in PDF_PAGES:
+            pdf_path = os.path.join(cache_dir, f"report-{pages}.pdf")
+            write_pdf(pdf_path, pages)
+
+            def cold(i, pdf_path=pdf_path):
+                assistant = assistant_with_cache(tempfile.mkdtemp(dir=cache_dir))
+                assert assistant.create_query_engine_tool_from_document(pdf_path, "bench_jk_annualreport", "Annual report")
+
+            warm_cache_dir = tempfile.mkdtemp(dir=cache_dir)
+            assistant_with_cache(warm_cache_dir).create_query_engine_tool_from_document(pdf_path, "bench_jk_annualreport",
+                                                                                        "Annual report")
+
+            def warm(i, pdf_path=pdf_path, warm_cache_dir=warm_cache_dir):
+                assistant = assistant_with_cache(warm_cache_dir)
+                assert assistant.create_query_engine_tool_from_document(pdf_path, "bench_jk_annualreport", "Annual report")
+
+            results[f"document_tool.{pages}_pages.cold"] = measure(cold, repeat, memory)
+            results[f"document_tool.{pages}_pages.cached"] = measure(warm, repeat, memory)
+    finally:
+        vector_store.VECTOR_STORE_DIR = vector_store_dir
+    return results
+
+def bench_report(cache_dir: str, repeat: int, memory: bool) -> Dict[str, object]:
+    from pipeline import gather, generate_report, get_report_llm
+    from market_data import report_input_from_results
+    from streaming import ChatStream
+
+    def run(i):
+        # A new ticker per run so the market data cache does not hide fetch latency
+        ticker = f"REPORT{i}.JK"
+        start = time.perf_counter()
+        report_input = report_input_from_results(gather(ticker).results())
+        gather_seconds = time.perf_counter() - start
+        llm = get_report_llm()
+        stream = ChatStream("report", ticker, lambda on_delta: generate_report(ticker, report_input, llm=llm,
+                                                                                 on_delta=on_delta))
+        stream.wait()
+        if stream.error is not None:
+            raise stream.error
+        return {"gather_seconds": gather_seconds, "time_to_first_token": stream.stats.time_to_first_token}
+
+    return {"report": measure(run, repeat, memory)}
+
+def bench_agent(cache_dir: str, repeat: int, memory: bool) -> Dict[str, object]:
+    from assistant import Assistant
+    from pipeline import gather
+
+    assistant = Assistant(ticker="AGENT.JK")
+    gather("AGENT.JK", build_tool=assistant.create_query_engine_tool_from_md).results()
+    assistant.create_agent()
+
+    def run(i):
+        stream = assistant.stream_chat(QUESTIONS[i % len(QUESTIONS)])
+        stream.wait()
+        if stream.error is not None:
+            raise stream.error
+        return {"time_to_first_token": stream.stats.time_to_first_token}
+
+    return {"agent_turn": measure(run, repeat, memory)}
+
+SUITES = {
+    "md_tools": bench_md_tools,
+    "document_tools": bench_document_tools,
+    "report": bench_report,
+    "agent": bench_agent,
+}
+
+def compare(current: Dict[str, object], baseline: Dict[str, object]) -> str:
+    lines = [f"{'scenario':<40} {'baseline':>10} {'current':>10} {'change':>8}"]
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            lines.append(f"{name:<40} {'-':>10} {result['seconds']:>9.3f}s {'new':>8}")
+            continue
+        change = (result["seconds"] - base["seconds"]) / base["seconds"] if base["seconds"] else 0.0
+        lines.append(f"{name:<40} {base['seconds']:>9.3f}s {result['seconds']:>9.3f}s {change:>+8.1%}")
+    return "\n".join(lines)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark FICO offline against stand-in providers")
+    parser.add_argument("--suite", action="append", choices=sorted(SUITES), help="Suites to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per scenario")
+    parser.add_argument("--latency-scale", type=float, default=1.0,
+                        help="Multiplies all stand-in latencies, 0 measures FICO's own overhead only")
+    parser.add_argument("--payload-scale", type=float, default=1.0, help="Multiplies stand-in payload sizes")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the extra tracemalloc run per scenario")
+    parser.add_argument("--output", help="Results file (default: benchmarks/results/<time>-<commit>.json)")
+    parser.add_argument("--compare", help="Earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    config = StubConfig().scaled(latency=args.latency_scale, payload=args.payload_scale)
+    results: Dict[str, object] = {}
+    with tempfile.TemporaryDirectory() as cache_dir, stub_providers(config):
+        for name in args.suite or list(SUITES):
+            print(f"Running {name}...", file=sys.stderr)
+            # The agent prints its tool calls, keep the output to the results
+            with contextlib.redirect_stdout(io.StringIO()):
+                results.update(SUITES[name](cache_dir, args.repeat, not args.no_memory))
+
+        from embeddings import embedding_service
+        embedding_stats = embedding_service.stats()
+
+    output = {
+        "commit": git_commit(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "latency_scale": args.latency_scale,
+        "payload_scale": args.payload_scale,
+        "repeat": args.repeat,
+        "embedding": embedding_stats,
+        "results": results,
+    }
+    output_path = args.output or os.path.join(RESULTS_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{output['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(output, f, indent=2)
+
+    for name, result in results.items():
+        memory = f", peak {result['peak_memory_mb']:.1f} MB" if "peak_memory_mb" in result else ""
+        print(f"{name:<40} {result['seconds']:.3f}s (min {result['min_seconds']:.3f}s, max {result['max_seconds']:.3f}s{memory})")
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(output, json.load(f)))
+    print(f"Results written to {output_path}", file=sys.stderr)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,333 @@
+import time
+import zlib
+import random
+import contextlib
+from dataclasses import dataclass, field
+from types import SimpleNamespace
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from llama_index.core.base.llms.types import (ChatMessage, ChatResponse, CompletionResponse, LLMMetadata,
+                                              MessageRole)
+from llama_index.core.llms.callbacks import llm_chat_callback
+from llama_index.core.llms.function_calling import FunctionCallingLLM
+from llama_index.core.llms.llm import ToolSelection
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import Document
+
+WORDS = ("revenue", "growth", "margin", "capital", "dividend", "segment", "loan", "deposit", "asset", "liability",
+         "customer", "digital", "branch", "credit", "risk", "income", "expense", "quarter", "annual", "strategy")
+
+@dataclass
+class LLMProfile:
+    first_token_seconds: float
+    tokens_per_second: float
+    completion_tokens: int
+
+@dataclass
+class StubConfig:
+    """Latency (seconds) and payload sizes of the stand-in providers"""
+
+    yfinance_seconds: float = 0.4
+    ddgs_seconds: float = 0.8
+    llamaparse_seconds_per_page: float = 0.3
+    news_items: int = 5
+    news_body_chars: int = 600
+    summary_chars: int = 2000
+    recommendation_rows: int = 4
+    upgrade_rows: int = 60
+    page_chars: int = 3000
+    embed_dim: int = 384
+    embed_seconds_per_text: float = 0.002
+    report_llm: LLMProfile = field(default_factory=lambda: LLMProfile(0.4, 250.0, 900))
+    agent_llm: LLMProfile = field(default_factory=lambda: LLMProfile(0.6, 120.0, 150))
+    # Tools the agent stand-in calls before answering each question
+    agent_tool_calls: int = 1
+
+    def scaled(self, latency: float = 1.0, payload: float = 1.0) -> "StubConfig":
+        def llm(profile: LLMProfile) -> LLMProfile:
+            return LLMProfile(profile.first_token_seconds * latency,
+                              profile.tokens_per_second / latency if latency else 0.0,
+                              max(1, int(profile.completion_tokens * payload)))
+
+        return StubConfig(
+            yfinance_seconds=self.yfinance_seconds * latency,
+            ddgs_seconds=self.ddgs_seconds * latency,
+            llamaparse_seconds_per_page=self.llamaparse_seconds_per_page * latency,
+            news_items=self.news_items,
+            news_body_chars=int(self.news_body_chars * payload),
+            summary_chars=int(self.summary_chars * payload),
+            recommendation_rows=self.recommendation_rows,
+            upgrade_rows=max(1, int(self.upgrade_rows * payload)),
+            page_chars=int(self.page_chars * payload),
+            embed_dim=self.embed_dim,
+            embed_seconds_per_text=self.embed_seconds_per_text * latency,
+            report_llm=llm(self.report_llm),
+            agent_llm=llm(self.agent_llm),
+            agent_tool_calls=self.agent_tool_calls,
+        )
+
+def text(chars: int, seed: Any = 0) -> str:
+    """Deterministic filler text of about `chars` characters"""
+    rng = random.Random(str(seed))
+    words = []
+    size = 0
+    while size < chars:
+        word = rng.choice(WORDS) if rng.random() > 0.15 else f"{rng.uniform(1, 9999):,.1f}"
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+def markdown_table(rows: int, seed: Any = 0) -> str:
+    rng = random.Random(str(seed))
+    lines = ["| Item | 2022 | 2023 | Change |", "|---|---|---|---|"]
+    for i in range(rows):
+        a, b = rng.uniform(100, 99999), rng.uniform(100, 99999)
+        lines.append(f"| {rng.choice(WORDS)} {i} | {a:,.0f} | {b:,.0f} | {(b - a) / a:.1%} |")
+    return "\n".join(lines)
+
+class StubTicker:
+    def __init__(self, ticker_symbol: str, config: StubConfig):
+        self.ticker_symbol = ticker_symbol
+        self.config = config
+
+    @property
+    def info(self) -> dict:
+        time.sleep(self.config.yfinance_seconds)
+        return {"shortName": f"{self.ticker_symbol} Corp", "symbol": self.ticker_symbol, "currency": "USD",
+                "currentPrice": 101.5, "marketCap": 1.2e11, "sector": "Financial Services", "industry": "Banks",
+                "country": "Indonesia", "trailingEps": 4.2, "trailingPE": 24.1, "recommendationKey": "buy",
+                "numberOfAnalystOpinions": 21, "ebitda": 3.4e10, "revenueGrowth": 0.12,
+                "longBusinessSummary": text(self.config.summary_chars, self.ticker_symbol)}
+
+    @property
+    def fast_info(self):
+        time.sleep(self.config.yfinance_seconds)
+        return SimpleNamespace(last_price=101.7, market_cap=1.21e11, year_low=80.2, year_high=112.9,
+                               fifty_day_average=99.4, two_hundred_day_average=95.8)
+
+    @property
+    def recommendations(self) -> pd.DataFrame:
+        time.sleep(self.config.yfinance_seconds)
+        rng = random.Random(self.ticker_symbol)
+        return pd.DataFrame([{"period": f"-{i}m", "strongBuy": rng.randint(0, 10), "buy": rng.randint(0, 15),
+                              "hold": rng.randint(0, 10), "sell": rng.randint(0, 5), "strongSell": rng.randint(0, 3)}
+                             for i in range(self.config.recommendation_rows)])
+
+    @property
+    def upgrades_downgrades(self) -> pd.DataFrame:
+        time.sleep(self.config.yfinance_seconds)
+        rng = random.Random(self.ticker_symbol)
+        grades = ["Buy", "Hold", "Sell", "Overweight", "Neutral", "Underweight"]
+        rows = [{"Firm": f"Firm {rng.randint(1, 40)}", "ToGrade": rng.choice(grades), "FromGrade": rng.choice(grades),
+                 "Action": rng.choice(["up", "down", "main", "init"])} for _ in range(self.config.upgrade_rows)]
+        index = pd.date_range(end="2024-05-01", periods=len(rows), freq="W")[::-1]
+        return pd.DataFrame(rows, index=pd.Index(index, name="GradeDate"))
+
+    def history(self, period: str = "1y", interval: str = "1mo") -> pd.DataFrame:
+        time.sleep(self.config.yfinance_seconds)
+        freq, days_per_row = {"1d": ("B", 365 / 252), "1wk": ("W", 7), "1mo": ("MS", 30.4), "3mo": ("QS", 91.3)}.get(interval, ("MS", 30.4))
+        days = {"1mo": 30, "3mo": 91, "6mo": 182, "1y": 365, "2y": 730, "5y": 1826, "10y": 3652}.get(period, 365)
+        index = pd.date_range(end="2024-05-01", periods=max(2, int(days / days_per_row)), freq=freq)
+        rng = np.random.default_rng(zlib.crc32(self.ticker_symbol.encode()))
+        closes = 100 * np.exp(np.cumsum(rng.normal(0.005, 0.05, len(index))))
+        return pd.DataFrame({"Open": closes, "High": closes * 1.02, "Low": closes * 0.98, "Close": closes,
+                             "Volume": rng.integers(1e5, 1e7, len(index))}, index=pd.Index(index, name="Date"))
+
+class StubYFinance:
+    def __init__(self, config: StubConfig):
+        self.config = config
+
+    def Ticker(self, ticker_symbol: str) -> StubTicker:
+        return StubTicker(ticker_symbol, self.config)
+
+class StubDDGS:
+    config = StubConfig()
+
+    def news(self, keywords: str, max_results: int = 5) -> List[dict]:
+        time.sleep(self.config.ddgs_seconds)
+        return [{"title": f"{keywords} headline {i}", "date": "2024-05-01T08:00:00", "url": f"https://example.com/{i}",
+                 "source": "Example News", "body": text(self.config.news_body_chars, f"{keywords}-{i}")}
+                for i in range(min(max_results, self.config.news_items))]
+
+class StubLlamaParse:
+    """Returns synthetic markdown pages for a PDF after a per-page delay"""
+
+    def __init__(self, config: StubConfig, result_type: str = "markdown", **kwargs: Any):
+        self.config = config
+        self.result_type = result_type
+
+    def load_data(self, file_path, extra_info: Optional[dict] = None) -> List[Document]:
+        from pypdf import PdfReader
+
+        pages = len(PdfReader(str(file_path)).pages)
+        time.sleep(self.config.llamaparse_seconds_per_page * pages)
+        body = []
+        for page in range(pages):
+            body.append(f"## Section {page + 1}\n\n{text(self.config.page_chars * 2 // 3, (file_path, page))}\n\n"
+                        f"{markdown_table(max(1, self.config.page_chars // 120), (file_path, page))}\n")
+        return [Document(text="\n---\n".join(body), metadata=extra_info or {})]
+
+class StubSentenceTransformer:
+    """Stand-in for the SentenceTransformer behind `embedding_service`"""
+
+    def __init__(self, config: StubConfig):
+        self.config = config
+
+    def encode(self, texts: List[str], batch_size: int = 32, normalize_embeddings: bool = True,
+               convert_to_numpy: bool = True, **kwargs: Any) -> np.ndarray:
+        time.sleep(self.config.embed_seconds_per_text * len(texts))
+        vectors = np.empty((len(texts), self.config.embed_dim), dtype=np.float32)
+        for i, text_ in enumerate(texts):
+            vectors[i] = np.random.default_rng(zlib.crc32(text_.encode())).standard_normal(self.config.embed_dim)
+        return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def write_pdf(path: str, pages: int):
+    """Blank PDF with `pages` pages; the LlamaParse stand-in generates the text"""
+    from pypdf import PdfWriter
+
+    writer = PdfWriter()
+    for _ in range(pages):
+        writer.add_blank_page(width=595, height=842)
+    with open(path, 'wb') as f:
+        writer.write(f)
+
+class StubLLM(FunctionCallingLLM):
+    """Function calling LLM that answers with filler text at a configured speed.
+
+    Chat turns without tool results select tools (up to `tool_calls` of them, those
+    taking a text argument), turns after tool results answer.
+    """
+
+    _profile: LLMProfile = PrivateAttr()
+    _tool_calls: int = PrivateAttr()
+
+    def __init__(self, profile: LLMProfile, tool_calls: int = 1, **kwargs: Any):
+        super().__init__(**kwargs)
+        self._profile = profile
+        self._tool_calls = tool_calls
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "StubLLM"
+
+    @property
+    def metadata(self) -> LLMMetadata:
+        return LLMMetadata(context_window=200000, num_output=4096, is_chat_model=True,
+                           is_function_calling_model=True, model_name="stub")
+
+    def _tokens(self, seed: Any) -> List[str]:
+        return text(self._profile.completion_tokens * 7, seed).split(" ")[:self._profile.completion_tokens]
+
+    def _stream(self, seed: Any):
+        time.sleep(self._profile.first_token_seconds)
+        delay = 1.0 / self._profile.tokens_per_second if self._profile.tokens_per_second else 0.0
+        for i, token in enumerate(self._tokens(seed)):
+            if delay:
+                time.sleep(delay)
+            yield token if i == 0 else " " + token
+
+    def _select_tools(self, tools: Sequence[Any], chat_history: List[ChatMessage]) -> List[dict]:
+        if not tools or not chat_history or chat_history[-1].role != MessageRole.USER:
+            return []
+        question = str(chat_history[-1].content or "")
+        tool_calls = []
+        for tool in tools:
+            properties = tool.metadata.get_parameters_dict().get("properties", {})
+            if not any(schema.get("type") == "string" for schema in properties.values()):
+                continue
+            tool_input = {name: question for name, schema in properties.items() if schema.get("type") == "string"}
+            tool_calls.append({"id": f"toolu_{len(tool_calls)}", "name": tool.metadata.name, "input": tool_input,
+                               "type": "tool_use"})
+            if len(tool_calls) >= self._tool_calls:
+                break
+        return tool_calls
+
+    @llm_chat_callback()
+    def chat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        content = "".join(self._stream(messages[-1].content if messages else ""))
+        return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=content,
+                                                additional_kwargs={"tool_calls": []}))
+
+    @llm_chat_callback()
+    def stream_chat(self, messages: Sequence[ChatMessage], tools: Optional[List[dict]] = None, **kwargs: Any):
+        def gen():
+            content = ""
+            for delta in self._stream(messages[-1].content if messages else ""):
+                content += delta
+                yield ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content=content), delta=delta)
+        return gen()
+
+    def chat_with_tools(self, tools: Sequence[Any], user_msg=None, chat_history: Optional[List[ChatMessage]] = None,
+                        verbose: bool = False, allow_parallel_tool_calls: bool = False, **kwargs: Any) -> ChatResponse:
+        chat_history = list(chat_history or [])
+        if user_msg is not None:
+            chat_history.append(user_msg if isinstance(user_msg, ChatMessage)
+                                else ChatMessage(role=MessageRole.USER, content=user_msg))
+        tool_calls = self._select_tools(tools, chat_history)
+        if tool_calls:
+            time.sleep(self._profile.first_token_seconds)
+            return ChatResponse(message=ChatMessage(role=MessageRole.ASSISTANT, content="",
+                                                    additional_kwargs={"tool_calls": tool_calls}))
+        return self.chat(chat_history)
+
+    def get_tool_calls_from_response(self, response, error_on_no_tool_call: bool = True,
+                                     **kwargs: Any) -> List[ToolSelection]:
+        tool_calls = response.message.additional_kwargs.get("tool_calls", [])
+        if not tool_calls and error_on_no_tool_call:
+            raise ValueError("Expected at least one tool call")
+        return [ToolSelection(tool_id=tool_call["id"], tool_name=tool_call["name"], tool_kwargs=tool_call["input"])
+                for tool_call in tool_calls]
+
+    def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return CompletionResponse(text="".join(self._stream(prompt)))
+
+    def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        def gen():
+            content = ""
+            for delta in self._stream(prompt):
+                content += delta
+                yield CompletionResponse(text=content, delta=delta)
+        return gen()
+
+    async def achat(self, messages: Sequence[ChatMessage], **kwargs: Any) -> ChatResponse:
+        return self.chat(messages, **kwargs)
+
+    async def acomplete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+        return self.complete(prompt, formatted, **kwargs)
+
+    async def astream_chat(self, messages: Sequence[ChatMessage], **kwargs: Any):
+        raise NotImplementedError("StubLLM does not stream asynchronously")
+
+    async def astream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any):
+        raise NotImplementedError("StubLLM does not stream asynchronously")
+
+@contextlib.contextmanager
+def stub_providers(config: StubConfig):
+    """Routes yfinance, DDGS, LlamaParse, Groq, Anthropic and the embedding model to the stand-ins"""
+    import assistant
+    import market_data
+    import pipeline
+    from embeddings import embedding_service
+
+    StubDDGS.config = config
+    patches = [
+        (market_data, "yf", StubYFinance(config)),
+        (market_data, "DDGS", StubDDGS),
+        (assistant, "LlamaParse", lambda **kwargs: StubLlamaParse(config, **kwargs)),
+        (assistant, "Anthropic", lambda callback_manager=None, **kwargs: StubLLM(config.agent_llm, tool_calls=config.agent_tool_calls,
+                                                                                callback_manager=callback_manager)),
+        (pipeline, "Groq", lambda **kwargs: StubLLM(config.report_llm)),
+        (embedding_service, "_model", StubSentenceTransformer(config)),
+        (embedding_service, "backend", "stub"),
+    ]
+    originals = [(target, name, getattr(target, name)) for target, name, _ in patches]
+    for target, name, value in patches:
+        setattr(target, name, value)
+    try:
+        yield config
+    finally:
+        for target, name, value in originals:
+            setattr(target, name, value)
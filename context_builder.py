@@ -0,0 +1,284 @@
+import os
+import re
+import math
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+from phi.utils.log import logger
+
+from tracing import count_tokens, span
+
+# Market data tokens in the report prompt, the report model has 8192 for the prompt and the report together
+REPORT_CONTEXT_TOKENS = int(os.environ.get('FICO_REPORT_CONTEXT_TOKENS', 3000))
+# Word overlap (Jaccard) above which two news titles with the same numbers are the same story
+NEWS_DUPLICATE_SIMILARITY = float(os.environ.get('FICO_NEWS_DUPLICATE_SIMILARITY', 0.7))
+# A news body cut shorter than this is left out
+MIN_BODY_TOKENS = 12
+
+# Share of the budget of each source, what a source does not need goes to the others
+SECTION_SHARES = {"company_info": 0.3, "company_news": 0.35, "analyst_recommendations": 0.1, "upgrades_downgrades": 0.25}
+DEFAULT_SHARE = 0.2
+
+# Word prefixes of what the report sections discuss (financial performance, growth prospects, analyst views)
+REPORT_TERMS = ["revenue", "sales", "profit", "earning", "income", "margin", "eps", "loss", "quarter", "cash", "debt",
+                "loan", "deposit", "dividend", "growth", "grow", "expan", "launch", "acqui", "merger", "invest",
+                "outlook", "guidance", "forecast", "target", "upgrade", "downgrade", "rating", "analyst", "outperform",
+                "underperform", "overweight", "underweight", "buyback", "record", "strateg"]
+
+# (label, info keys tried in order), core metrics of the report first
+INFO_FIELDS = [
+    ("Name", ["shortName", "longName"]),
+    ("Symbol", ["symbol"]),
+    ("Current Price", ["regularMarketPrice", "currentPrice"]),
+    ("Market Cap", ["marketCap", "enterpriseValue"]),
+    ("52 Week Low", ["fiftyTwoWeekLow"]),
+    ("52 Week High", ["fiftyTwoWeekHigh"]),
+    ("P/E Ratio", ["trailingPE"]),
+    ("EPS", ["trailingEps"]),
+    ("50 Day Average", ["fiftyDayAverage"]),
+    ("200 Day Average", ["twoHundredDayAverage"]),
+    ("Analyst Recommendation", ["recommendationKey"]),
+    ("Number Of Analyst Opinions", ["numberOfAnalystOpinions"]),
+    ("Revenue Growth", ["revenueGrowth"]),
+    ("Gross Margins", ["grossMargins"]),
+    ("Ebitda Margins", ["ebitdaMargins"]),
+    ("EBITDA", ["ebitda"]),
+    ("Free Cash flow", ["freeCashflow"]),
+    ("Operating Cash flow", ["operatingCashflow"]),
+    ("Total Cash", ["totalCash"]),
+    ("Sector", ["sector"]),
+    ("Industry", ["industry"]),
+    ("Country", ["country"]),
+    ("Employees", ["fullTimeEmployees"]),
+]
+MONEY_FIELDS = {"Current Price", "Market Cap", "52 Week Low", "52 Week High", "50 Day Average", "200 Day Average",
+                "EBITDA", "Free Cash flow", "Operating Cash flow", "Total Cash"}
+PERCENT_FIELDS = {"Revenue Growth", "Gross Margins", "Ebitda Margins"}
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"[a-z0-9]+", text.lower())
+
+def relevance(text: str) -> int:
+    """Number of report section terms the text mentions"""
+    words = _words(text)
+    return sum(1 for term in REPORT_TERMS if any(word.startswith(term) for word in words))
+
+def _number(value: Any) -> str:
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, float) and math.isnan(value):
+        return "n/a"
+    for scale, suffix in ((1e12, "T"), (1e9, "B"), (1e6, "M")):
+        if abs(value) >= scale:
+            return f"{value / scale:,.2f}{suffix}"
+    return f"{value:,}" if isinstance(value, int) else f"{value:,.2f}"
+
+def _sentences(text: str) -> List[str]:
+    return [sentence for sentence in re.split(r"(?<=[.!?])\s+", text.strip()) if sentence]
+
+def fit(lines: Sequence[str], budget: int, order: Optional[Sequence[int]] = None) -> List[str]:
+    """The lines that fit in `budget` tokens, taken in `order` (default as given) and returned as given"""
+    kept, used = set(), 0
+    for i in (order if order is not None else range(len(lines))):
+        tokens = count_tokens(lines[i]) + 1
+        if used + tokens <= budget:
+            kept.add(i)
+            used += tokens
+    return [lines[i] for i in sorted(kept)]
+
+def truncate(text: str, budget: int) -> str:
+    """`text` cut at a word boundary to at most `budget` tokens, empty when not even a word fits"""
+    if count_tokens(text) <= budget:
+        return text
+    words = text.split()
+    low, high = 0, len(words)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if count_tokens(" ".join(words[:middle]) + " ...") <= budget:
+            low = middle
+        else:
+            high = middle - 1
+    return " ".join(words[:low]) + " ..." if low else ""
+
+def _by_relevance(texts: Sequence[str]) -> List[int]:
+    # Most relevant first, the original order among equals
+    return sorted(range(len(texts)), key=lambda i: -relevance(texts[i]))
+
+def company_info_context(info: dict, budget: int) -> str:
+    currency = info.get("currency", "USD")
+    lines = []
+    for label, keys in INFO_FIELDS:
+        value = next((info[key] for key in keys if info.get(key) not in (None, "")), None)
+        if value is None:
+            continue
+        if label in PERCENT_FIELDS and isinstance(value, (int, float)):
+            lines.append(f"{label}: {value * 100:.1f}%")
+        else:
+            lines.append(f"{label}: {_number(value)}" + (f" {currency}" if label in MONEY_FIELDS else ""))
+    lines = fit(lines, budget)
+
+    # The business summary gets what the metrics leave, its sentences most relevant to the report first
+    sentences = _sentences(info.get("longBusinessSummary") or "")
+    remaining = budget - sum(count_tokens(line) + 1 for line in lines) - 2
+    order = _by_relevance(sentences)
+    summary = fit(sentences, remaining, order)
+    if not summary and sentences:
+        summary = [truncate(sentences[order[0]], remaining)]
+    if any(summary):
+        lines.append("Summary: " + " ".join(summary))
+    return "\n".join(lines)
+
+def dedup_news(news: List[dict]) -> List[dict]:
+    """Drops news with the URL or nearly the title of an earlier item, titles with different numbers stay apart"""
+    kept = []
+    for item in news:
+        words = set(_words(item.get("title", "")))
+        numbers = {word for word in words if word.isdigit()}
+        duplicate = False
+        for other, other_words in kept:
+            if item.get("url") and item.get("url") == other.get("url"):
+                duplicate = True
+            elif words and numbers == {word for word in other_words if word.isdigit()}:
+                duplicate = len(words & other_words) / len(words | other_words) >= NEWS_DUPLICATE_SIMILARITY
+            if duplicate:
+                break
+        if not duplicate:
+            kept.append((item, words))
+    return [item for item, _ in kept]
+
+def company_news_context(news: List[dict], budget: int) -> str:
+    news = dedup_news(news)
+    # Most relevant first, the latest first among equals
+    news.sort(key=lambda item: (relevance(f"{item.get('title', '')} {item.get('body', '')}"), str(item.get("date", ""))),
+              reverse=True)
+    titles, left = [], budget
+    for item in news:
+        title = "- " + " ".join(part for part in (str(item.get("date", ""))[:10], item.get("title", "")) if part)
+        title += f" ({item['source']})" if item.get("source") else ""
+        if count_tokens(title) + 1 > left:
+            break
+        titles.append(title)
+        left -= count_tokens(title) + 1
+    news = news[:len(titles)]
+
+    # Titles first, then the bodies share what is left, each cut to its part
+    bodies = {i: count_tokens(item["body"]) + 2 for i, item in enumerate(news) if item.get("body")}
+    body_budgets = allocate(bodies, left, {}) if left > 0 else {}
+    lines = []
+    for i, title in enumerate(titles):
+        body = truncate(news[i]["body"], body_budgets[i] - 2) if body_budgets.get(i, 0) >= MIN_BODY_TOKENS else ""
+        lines.append(f"{title}: {body}" if body else title)
+    return "\n".join(lines)
+
+def table_lines(table) -> List[str]:
+    """One line per row of a DataFrame, `label: column value, ...`, the index is the label when it is named"""
+    lines = []
+    for index, row in table.iterrows():
+        values = ", ".join(f"{column} {_number(value)}" for column, value in row.items()
+                           if value not in (None, "") and not (isinstance(value, float) and math.isnan(value)))
+        if table.index.name:
+            label = index.strftime("%Y-%m-%d") if hasattr(index, "strftime") else str(index)
+            values = f"{label}: {values}"
+        lines.append(f"- {values}")
+    return lines
+
+def analyst_recommendations_context(recommendations, budget: int) -> str:
+    return "\n".join(fit(table_lines(recommendations), budget))
+
+def upgrades_downgrades_context(upgrades_downgrades, budget: int) -> str:
+    # The latest grade of each firm, actual upgrades and downgrades before maintained or initiated ratings
+    if "Firm" in upgrades_downgrades.columns:
+        upgrades_downgrades = upgrades_downgrades[~upgrades_downgrades["Firm"].duplicated()]
+    lines = table_lines(upgrades_downgrades)
+    actions = list(upgrades_downgrades["Action"]) if "Action" in upgrades_downgrades.columns else [""] * len(lines)
+    order = sorted(range(len(lines)), key=lambda i: actions[i] not in ("up", "down"))
+    return "\n".join(fit(lines, budget, order))
+
+def _has_data(data) -> bool:
+    if data is None or getattr(data, "empty", False):
+        return False
+    return len(data) > 0 if isinstance(data, (dict, list)) else True
+
+def _section(title: str, render: Callable[[Any, int], str], data) -> Callable[[int], str]:
+    header = f"## {title}\n\n"
+    return lambda budget: f"{header}{render(data, budget - count_tokens(header) - 1)}\n"
+
+# source name -> (section title, renders the fetched data in at most budget tokens)
+SECTIONS: Dict[str, tuple] = {
+    "company_info": ("Company Info", company_info_context),
+    "company_news": ("Company News", company_news_context),
+    "analyst_recommendations": ("Analyst Recommendations", analyst_recommendations_context),
+    "upgrades_downgrades": ("Upgrades/Downgrades", upgrades_downgrades_context),
+}
+
+def allocate(needs: Dict[str, int], total: int, shares: Dict[str, float] = SECTION_SHARES) -> Dict[str, int]:
+    """Splits `total` tokens by share, sections needing less than their share pass the rest to the others"""
+    budgets, remaining, left = {}, dict(needs), total
+    while remaining:
+        weight = sum(shares.get(name, DEFAULT_SHARE) for name in remaining)
+        fair = {name: left * shares.get(name, DEFAULT_SHARE) / weight for name in remaining}
+        satisfied = [name for name in remaining if remaining[name] <= fair[name]]
+        if not satisfied:
+            budgets.update({name: int(share) for name, share in fair.items()})
+            break
+        for name in satisfied:
+            budgets[name] = remaining.pop(name)
+            left -= budgets[name]
+    return budgets
+
+@dataclass
+class ContextSection:
+    name: str
+    text: str
+    tokens: int
+    budget: int
+    # Tokens of the section as it was before compression
+    source_tokens: int
+
+@dataclass
+class ReportContext:
+    sections: List[ContextSection]
+    budget: int
+
+    @property
+    def text(self) -> str:
+        return "".join(section.text + "---\n" for section in self.sections)
+
+    @property
+    def tokens(self) -> int:
+        return sum(section.tokens for section in self.sections)
+
+    def usage(self) -> Dict[str, Dict[str, int]]:
+        return {section.name: {"tokens": section.tokens, "budget": section.budget, "source_tokens": section.source_tokens}
+                for section in self.sections}
+
+def build_report_context(results: Dict[str, Any], max_tokens: int = REPORT_CONTEXT_TOKENS) -> ReportContext:
+    """Compact report input from gathered `SourceResult`s within `max_tokens`.
+
+    Sources with fetched data are rendered as compact text (duplicate news removed,
+    tables as one line per row, content most relevant to the report kept first),
+    the others fall back to their markdown, cut to their budget.
+    """
+    with span("report.context", budget=max_tokens) as context_span:
+        renders: Dict[str, Callable[[int], str]] = {}
+        for name, result in results.items():
+            title, render = SECTIONS.get(name, (None, None))
+            if render is not None and _has_data(getattr(result, "data", None)):
+                renders[name] = _section(title, render, result.data)
+            else:
+                renders[name] = lambda budget, md=result.report_md: "\n".join(fit(md.splitlines(), budget)) + "\n"
+
+        needs = {name: count_tokens(render(max_tokens)) for name, render in renders.items()}
+        budgets = allocate(needs, max_tokens)
+        sections = []
+        for name, render in renders.items():
+            text = render(budgets[name]) if budgets[name] < needs[name] else render(max_tokens)
+            sections.append(ContextSection(name=name, text=text, tokens=count_tokens(text), budget=budgets[name],
+                                           source_tokens=count_tokens(results[name].report_md)))
+
+        context = ReportContext(sections=sections, budget=max_tokens)
+        source_tokens = sum(section.source_tokens for section in sections)
+        context_span.set(tokens=context.tokens, source_tokens=source_tokens)
+    logger.info(f"Report context: {context.tokens} of {max_tokens} tokens (from {source_tokens}), "
+                + ", ".join(f"{section.name} {section.tokens}/{section.budget}" for section in sections))
+    return context
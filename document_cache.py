@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+from importlib import metadata
+from typing import Callable, Iterator, List, Optional, Tuple
+
+from llama_index.core import StorageContext, VectorStoreIndex, load_index_from_storage
+from llama_index.core.schema import Document
+
+from phi.utils.log import logger
+
+CACHE_DIR = os.environ.get('FICO_CACHE_DIR', os.path.join('data', 'cache'))
+CACHE_MAX_BYTES = int(os.environ.get('FICO_CACHE_MAX_BYTES', 2 * 1024**3))
+
+def package_version(name: str) -> str:
+    try:
+        return metadata.version(name)
+    except metadata.PackageNotFoundError:
+        return "unknown"
+
+PARSER_VERSION = f"llama_parse-{package_version('llama_parse')}-markdown"
+
+class DocumentCache:
+    """Content-addressed on-disk cache for parsed and indexed documents.
+
+    Parsed documents are keyed by the file hash and parser version, indexes and
+    their summary additionally by the embedding model. Entries are evicted least
+    recently used first once the cache grows over `max_bytes`.
+    """
+
+    def __init__(self, embed_model: str, parser_version: str = PARSER_VERSION,
+                 cache_dir: str = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES):
+        self.embed_model = embed_model
+        self.parser_version = parser_version
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def file_hash(file_path: str) -> str:
+        digest = hashlib.sha256()
+        with open(file_path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def _key(self, kind: str, *parts: str) -> str:
+        return f"{kind}-" + hashlib.sha256("|".join(parts).encode()).hexdigest()[:32]
+
+    def _documents_key(self, content_hash: str) -> str:
+        return self._key("documents", content_hash, self.parser_version)
+
+    def _index_key(self, content_hash: str) -> str:
+        return self._key("index", content_hash, self.parser_version, self.embed_model)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key)
+
+    def _touch(self, key: str):
+        meta_path = os.path.join(self._entry_path(key), 'meta.json')
+        try:
+            with open(meta_path) as f:
+                meta = json.load(f)
+            meta["last_access"] = time.time()
+            with open(meta_path, 'w') as f:
+                json.dump(meta, f)
+        except (OSError, ValueError):
+            pass
+
+    def _commit(self, key: str, tmp_path: str):
+        size = sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(tmp_path) for name in names)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as f:
+            json.dump({"size": size, "created": time.time(), "last_access": time.time()}, f)
+
+        with self._lock:
+            path = self._entry_path(key)
+            if os.path.exists(path):
+                shutil.rmtree(path, ignore_errors=True)
+            os.replace(tmp_path, path)
+            self._evict(keep=key)
+
+    def _new_entry(self, key: str) -> str:
+        tmp_path = self._entry_path(f".tmp-{key}-{os.getpid()}-{threading.get_ident()}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        return tmp_path
+
+    def _evict(self, keep: Optional[str] = None):
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            if key.startswith('.'):
+                continue
+            try:
+                with open(os.path.join(self._entry_path(key), 'meta.json')) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            entries.append((meta.get("last_access", 0), meta.get("size", 0), key))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            logger.debug(f"Evicting document cache entry {key}")
+            shutil.rmtree(self._entry_path(key), ignore_errors=True)
+            total -= size
+
+    def size(self) -> int:
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            total += sum(os.path.getsize(os.path.join(root, name)) for name in names)
+        return total
+
+    def get_documents(self, content_hash: str) -> Optional[List[Document]]:
+        key = self._documents_key(content_hash)
+        path = self._entry_path(key)
+        try:
+            # One documents.json, or one file per page range written by document_ranges
+            names = sorted(name for name in os.listdir(path) if name.startswith('documents') and name.endswith('.json'))
+            documents = []
+            for name in names:
+                with open(os.path.join(path, name)) as f:
+                    documents.extend(Document.from_dict(doc) for doc in json.load(f))
+        except (OSError, ValueError):
+            return None
+        self._touch(key)
+        return documents
+
+    def put_documents(self, content_hash: str, documents: List[Document]):
+        key = self._documents_key(content_hash)
+        tmp_path = self._new_entry(key)
+        with open(os.path.join(tmp_path, 'documents.json'), 'w') as f:
+            json.dump([doc.to_dict() for doc in documents], f)
+        self._commit(key, tmp_path)
+
+    @contextmanager
+    def document_ranges(self, content_hash: str) -> Iterator[Callable[[int, List[Document]], None]]:
+        """Yields a function writing the documents of the page range starting at a page as they are parsed.
+
+        The entry is committed when the block exits and discarded if it raises.
+        """
+        key = self._documents_key(content_hash)
+        tmp_path = self._new_entry(key)
+
+        def put_range(start: int, documents: List[Document]):
+            with open(os.path.join(tmp_path, f'documents-{start:06d}.json'), 'w') as f:
+                json.dump([doc.to_dict() for doc in documents], f)
+
+        try:
+            yield put_range
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        self._commit(key, tmp_path)
+
+    def get_index(self, content_hash: str) -> Optional[Tuple[VectorStoreIndex, str]]:
+        key = self._index_key(content_hash)
+        path = self._entry_path(key)
+        try:
+            with open(os.path.join(path, 'summary.txt')) as f:
+                summary = f.read()
+            storage_context = StorageContext.from_defaults(persist_dir=os.path.join(path, 'index'))
+            index = load_index_from_storage(storage_context)
+        except (OSError, ValueError) as e:
+            if os.path.exists(path):
+                logger.warning(f"Could not load cached index {key}: {e}")
+            return None
+        self._touch(key)
+        return index, summary
+
+    def put_index(self, content_hash: str, index: VectorStoreIndex, summary: str):
+        key = self._index_key(content_hash)
+        tmp_path = self._new_entry(key)
+        index.storage_context.persist(persist_dir=os.path.join(tmp_path, 'index'))
+        with open(os.path.join(tmp_path, 'summary.txt'), 'w') as f:
+            f.write(summary)
+        self._commit(key, tmp_path)
@@ -0,0 +1,237 @@
+import os
+import time
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.base.embeddings.base import BaseEmbedding
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.utils import get_cache_dir
+
+from phi.utils.log import logger
+
+EMBED_MODEL_NAME = os.environ.get('FICO_EMBED_MODEL', "BAAI/bge-small-en-v1.5")
+# torch, onnx (needs sentence-transformers>=3.2 and optimum[onnxruntime]) or int8 (dynamically quantized torch on CPU)
+EMBED_BACKEND = os.environ.get('FICO_EMBED_BACKEND', "torch")
+EMBED_BATCH_SIZE = int(os.environ.get('FICO_EMBED_BATCH_SIZE', 64))
+EMBED_MAX_WAIT_MS = float(os.environ.get('FICO_EMBED_MAX_WAIT_MS', 10))
+# Query embeddings kept for repeated and prefetched questions
+QUERY_EMBEDDING_CACHE_SIZE = 1024
+
+# The instructions llama_index's HuggingFace embedding prepends, kept here since importing that package loads torch
+_BGE_MODELS = tuple(f"BAAI/bge-{size}-{language}{version}" for size in ("small", "base", "large")
+                    for language in ("en", "zh") for version in ("", "-v1.5"))
+_INSTRUCTOR_MODELS = tuple(f"{org}/instructor-{size}" for org in ("hku-nlp", "hkunlp") for size in ("base", "large", "xl"))
+
+def format_query(query: str, model_name: str) -> str:
+    instruction = ""
+    if model_name in _INSTRUCTOR_MODELS:
+        instruction = "Represent the question for retrieving supporting documents: "
+    elif model_name in _BGE_MODELS:
+        instruction = "为这个句子生成表示以用于检索相关文章：" if "zh" in model_name else "Represent this question for searching relevant passages: "
+    return f"{instruction} {query}".strip()
+
+def format_text(text: str, model_name: str) -> str:
+    instruction = "Represent the document for retrieval: " if model_name in _INSTRUCTOR_MODELS else ""
+    return f"{instruction} {text}".strip()
+
+class _Request:
+    __slots__ = ("texts", "future", "enqueued_at")
+
+    def __init__(self, texts: List[str]):
+        self.texts = texts
+        self.future = Future()
+        self.enqueued_at = time.perf_counter()
+
+class EmbeddingService:
+    """Process-wide embedding model that merges concurrent requests into micro-batches.
+
+    The model is loaded once, on first use or `warm_up`. Callers on any thread submit
+    texts to a queue; a single worker thread drains it into batches of up to
+    `max_batch_size` texts, waiting at most `max_wait_ms` for more requests to arrive.
+    """
+
+    def __init__(self, model_name: str = EMBED_MODEL_NAME, backend: str = EMBED_BACKEND,
+                 max_batch_size: int = EMBED_BATCH_SIZE, max_wait_ms: float = EMBED_MAX_WAIT_MS):
+        self.model_name = model_name
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._model = None
+        self._load_lock = threading.Lock()
+        self._queue: "queue.Queue[_Request]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        self._stats_lock = threading.Lock()
+        self._stats = {"requests": 0, "texts": 0, "batches": 0, "max_batch": 0,
+                       "encode_seconds": 0.0, "queue_wait_seconds": 0.0, "load_seconds": 0.0}
+
+    @property
+    def embedding_id(self) -> str:
+        """Identifies the vectors this service produces, for cache keys"""
+        return f"{self.model_name}:{self.backend}"
+
+    def _load_model(self):
+        from sentence_transformers import SentenceTransformer
+
+        start = time.perf_counter()
+        cache_folder = get_cache_dir()
+        model = None
+        if self.backend == "onnx":
+            try:
+                model = SentenceTransformer(self.model_name, backend="onnx", cache_folder=cache_folder)
+            except Exception as e:
+                logger.warning(f"Could not load ONNX embedding backend, falling back to torch: {e}")
+                self.backend = "torch"
+        if model is None:
+            model = SentenceTransformer(self.model_name, cache_folder=cache_folder,
+                                        device="cpu" if self.backend == "int8" else None)
+        if self.backend == "int8":
+            import torch
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+        with self._stats_lock:
+            self._stats["load_seconds"] = time.perf_counter() - start
+        logger.debug(f"Loaded embedding model {self.embedding_id} in {time.perf_counter() - start:.2f}s")
+        return model
+
+    @property
+    def model(self):
+        if self._model is None:
+            with self._load_lock:
+                if self._model is None:
+                    self._model = self._load_model()
+        return self._model
+
+    def warm_up(self):
+        self.embed(["warm up"])
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            with self._load_lock:
+                if self._worker is None or not self._worker.is_alive():
+                    self._worker = threading.Thread(target=self._run, name="fico-embedding", daemon=True)
+                    self._worker.start()
+
+    def _next_batch(self) -> List[_Request]:
+        batch = [self._queue.get()]
+        size = len(batch[0].texts)
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while size < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                request = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            batch.append(request)
+            size += len(request.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            texts = [text for request in batch for text in request.texts]
+            start = time.perf_counter()
+            try:
+                embeddings = self.model.encode(texts, batch_size=self.max_batch_size,
+                                               normalize_embeddings=True, convert_to_numpy=True).tolist()
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                continue
+            elapsed = time.perf_counter() - start
+
+            offset = 0
+            for request in batch:
+                request.future.set_result(embeddings[offset:offset+len(request.texts)])
+                offset += len(request.texts)
+
+            with self._stats_lock:
+                self._stats["requests"] += len(batch)
+                self._stats["texts"] += len(texts)
+                self._stats["batches"] += 1
+                self._stats["max_batch"] = max(self._stats["max_batch"], len(texts))
+                self._stats["encode_seconds"] += elapsed
+                self._stats["queue_wait_seconds"] += sum(start - request.enqueued_at for request in batch)
+
+    def embed(self, texts: List[str]) -> List[List[float]]:
+        if not texts:
+            return []
+        self._ensure_worker()
+        request = _Request(list(texts))
+        self._queue.put(request)
+        return request.future.result()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats["backend"] = self.backend
+        stats["mean_batch"] = stats["texts"] / stats["batches"] if stats["batches"] else 0.0
+        stats["texts_per_second"] = stats["texts"] / stats["encode_seconds"] if stats["encode_seconds"] else 0.0
+        return stats
+
+class SharedEmbedding(BaseEmbedding):
+    """LlamaIndex embedding model backed by the shared `EmbeddingService`"""
+
+    _service: EmbeddingService = PrivateAttr()
+    _query_cache: "OrderedDict[str, List[float]]" = PrivateAttr()
+    _query_lock: threading.Lock = PrivateAttr()
+
+    def __init__(self, service: EmbeddingService, **kwargs: Any):
+        super().__init__(model_name=service.model_name, embed_batch_size=service.max_batch_size, **kwargs)
+        self._service = service
+        self._query_cache = OrderedDict()
+        self._query_lock = threading.Lock()
+
+    def _cache_queries(self, texts: List[str], embeddings: List[List[float]]):
+        with self._query_lock:
+            for text, embedding in zip(texts, embeddings):
+                self._query_cache[text] = embedding
+                self._query_cache.move_to_end(text)
+            while len(self._query_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+
+    def prefetch_query_embeddings(self, queries: List[str]):
+        """Embeds queries in one batch ahead of their retrievals, which then find them cached"""
+        texts = [format_query(query, self.model_name) for query in dict.fromkeys(queries)]
+        with self._query_lock:
+            missing = [text for text in texts if text not in self._query_cache]
+        if missing:
+            self._cache_queries(missing, self._service.embed(missing))
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "SharedEmbedding"
+
+    def _get_query_embedding(self, query: str) -> List[float]:
+        text = format_query(query, self.model_name)
+        with self._query_lock:
+            embedding = self._query_cache.get(text)
+            if embedding is not None:
+                self._query_cache.move_to_end(text)
+                return embedding
+        embedding = self._service.embed([text])[0]
+        self._cache_queries([text], [embedding])
+        return embedding
+
+    def _get_text_embedding(self, text: str) -> List[float]:
+        return self._service.embed([format_text(text, self.model_name)])[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[List[float]]:
+        return self._service.embed([format_text(text, self.model_name) for text in texts])
+
+    async def _aget_query_embedding(self, query: str) -> List[float]:
+        return self._get_query_embedding(query)
+
+    async def _aget_text_embedding(self, text: str) -> List[float]:
+        return self._get_text_embedding(text)
+
+embedding_service = EmbeddingService()
+_embed_model: Optional[SharedEmbedding] = None
+
+def get_embed_model() -> SharedEmbedding:
+    global _embed_model
+    if _embed_model is None:
+        _embed_model = SharedEmbedding(embedding_service)
+    return _embed_model
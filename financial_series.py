@@ -0,0 +1,98 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+def _labels(labels: Optional[Sequence[str]], n: int) -> List[str]:
+    if labels is not None and len(labels) == n:
+        return [str(label) for label in labels]
+    return [f"t{i}" for i in range(n)]
+
+def _fmt(value: float, suffix: str = "") -> str:
+    return "n/a" if value is None or not np.isfinite(value) else f"{value:,.2f}{suffix}"
+
+def _table(header: List[str], rows: List[List[str]]) -> str:
+    lines = ["| " + " | ".join(header) + " |", "|" + "---|" * len(header)]
+    lines += ["| " + " | ".join(row) + " |" for row in rows]
+    return "\n".join(lines)
+
+def period_changes(values: Sequence[float]) -> np.ndarray:
+    """Change, percent change and log return of each period against the previous one, shape (n-1, 3)"""
+    x = np.asarray(values, dtype=float)
+    previous, current = x[:-1], x[1:]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct = np.where(previous != 0, (current / previous - 1) * 100, np.nan)
+        log_return = np.where((previous > 0) & (current > 0), np.log(current / previous), np.nan)
+    return np.column_stack([current - previous, pct, log_return])
+
+def cagr(first: float, last: float, periods: float) -> float:
+    """Compound growth rate per period in percent, NaN when undefined (non-positive values)"""
+    if periods <= 0 or first <= 0 or last <= 0:
+        return float("nan")
+    return ((last / first) ** (1 / periods) - 1) * 100
+
+def rolling_mean(values: Sequence[float], window: int) -> np.ndarray:
+    """Trailing mean over `window` periods, NaN until the window is full"""
+    x = np.asarray(values, dtype=float)
+    out = np.full(x.shape, np.nan)
+    if 0 < window <= len(x):
+        cumsum = np.cumsum(np.insert(x, 0, 0.0))
+        out[window - 1:] = (cumsum[window:] - cumsum[:-window]) / window
+    return out
+
+def max_drawdown(values: Sequence[float]) -> float:
+    """Largest peak to trough fall in percent"""
+    x = np.asarray(values, dtype=float)
+    if len(x) == 0:
+        return float("nan")
+    peaks = np.maximum.accumulate(x)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        drawdowns = np.where(peaks > 0, x / peaks - 1, np.nan)
+    return float(np.nanmin(drawdowns) * 100) if np.isfinite(drawdowns).any() else float("nan")
+
+def changes_table(values: Sequence[float], labels: Optional[Sequence[str]] = None,
+                  periods_per_year: float = 1) -> str:
+    x = np.asarray(values, dtype=float)
+    if len(x) < 2:
+        return "At least two values are needed."
+    names = _labels(labels, len(x))
+    changes = period_changes(x)
+    rows = [[names[0], _fmt(x[0]), "", ""]]
+    rows += [[names[i + 1], _fmt(x[i + 1]), _fmt(change), _fmt(pct, "%")] for i, (change, pct, _) in enumerate(changes)]
+    years = (len(x) - 1) / periods_per_year
+    summary = (f"Total change from {names[0]} to {names[-1]}: {_fmt(x[-1] - x[0])} "
+               f"({_fmt((x[-1] / x[0] - 1) * 100 if x[0] else float('nan'), '%')}), "
+               f"CAGR over {years:.3g} years: {_fmt(cagr(x[0], x[-1], years), '%')}")
+    return _table(["Period", "Value", "Change", "Change %"], rows) + "\n\n" + summary
+
+def ratios_table(numerators: Sequence[float], denominators: Sequence[float],
+                 labels: Optional[Sequence[str]] = None) -> str:
+    a = np.asarray(numerators, dtype=float)
+    b = np.asarray(denominators, dtype=float)
+    if len(a) != len(b):
+        return f"Numerators ({len(a)}) and denominators ({len(b)}) must have the same length."
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.where(b != 0, a / b, np.nan)
+    names = _labels(labels, len(a))
+    rows = [[names[i], _fmt(a[i]), _fmt(b[i]), _fmt(ratios[i])] for i in range(len(a))]
+    return _table(["Period", "Numerator", "Denominator", "Ratio"], rows)
+
+def rolling_table(values: Sequence[float], window: int, labels: Optional[Sequence[str]] = None) -> str:
+    x = np.asarray(values, dtype=float)
+    if window < 1 or window > len(x):
+        return f"The window must be between 1 and the number of values ({len(x)})."
+    means = rolling_mean(x, window)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.where(means != 0, x / means, np.nan)
+    names = _labels(labels, len(x))
+    rows = [[names[i], _fmt(x[i]), _fmt(means[i]), _fmt(ratios[i])] for i in range(len(x))]
+    return _table(["Period", "Value", f"{window}-period average", "Value / average"], rows)
+
+def price_history_table(closes: Sequence[float], labels: Sequence[str], periods_per_year: float) -> str:
+    x = np.asarray(closes, dtype=float)
+    if len(x) < 2:
+        return "Not enough price history."
+    table = changes_table(x, labels, periods_per_year)
+    log_returns = period_changes(x)[:, 2]
+    volatility = np.nanstd(log_returns, ddof=1) * np.sqrt(periods_per_year) * 100 if len(x) > 2 else float("nan")
+    return (f"{table}\n\nAnnualized volatility: {_fmt(volatility, '%')}, max drawdown: {_fmt(max_drawdown(x), '%')}, "
+            f"high: {_fmt(np.nanmax(x))}, low: {_fmt(np.nanmin(x))}")
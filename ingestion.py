@@ -0,0 +1,210 @@
+import os
+import queue
+import tempfile
+import threading
+import contextvars
+from typing import Callable, Dict, List, Optional
+
+from llama_index.core import Settings, StorageContext, VectorStoreIndex
+from llama_index.core.schema import Document
+
+from phi.utils.log import logger
+
+from document_cache import package_version
+from tracing import span
+
+# llamaparse sends page ranges to LlamaParse, local extracts text with pypdf and works offline
+PDF_BACKEND = os.environ.get('FICO_PDF_BACKEND', "llamaparse")
+INGEST_PAGES_PER_RANGE = int(os.environ.get('FICO_INGEST_PAGES_PER_RANGE', 5))
+INGEST_QUEUE_SIZE = int(os.environ.get('FICO_INGEST_QUEUE_SIZE', 4))
+
+OnProgress = Callable[[int, int], None]
+# Called with the first page and documents of a page range once it is indexed
+OnRange = Callable[[int, List[Document]], None]
+
+class PdfIngestionError(Exception):
+    """A PDF that pypdf or the page parser could not read"""
+
+def page_count(file_path: str) -> int:
+    from pypdf import PdfReader
+    from pypdf.errors import PyPdfError
+
+    try:
+        return len(PdfReader(file_path).pages)
+    except (PyPdfError, ValueError) as e:
+        raise PdfIngestionError(f"Could not open {os.path.basename(file_path)}: {e}") from e
+
+class LocalPdfParser:
+    """Extracts the text layer of a page range with pypdf"""
+
+    parse_workers = 1
+
+    @property
+    def version(self) -> str:
+        return f"pypdf-{package_version('pypdf')}-text"
+
+    def parse(self, file_path: str, start: int, end: int) -> List[Document]:
+        from pypdf import PdfReader
+
+        reader = PdfReader(file_path)
+        documents = []
+        for page_number in range(start, end):
+            text = reader.pages[page_number].extract_text() or ""
+            if text.strip():
+                documents.append(Document(text=text, metadata={"file_name": os.path.basename(file_path),
+                                                               "page_label": str(page_number + 1)}))
+        return documents
+
+class LlamaParsePageParser:
+    """Sends a page range to LlamaParse as its own small PDF"""
+
+    parse_workers = 4
+
+    def __init__(self, parser):
+        self.parser = parser
+
+    @property
+    def version(self) -> str:
+        return f"llama_parse-{package_version('llama_parse')}-{self.parser.result_type}"
+
+    def parse(self, file_path: str, start: int, end: int) -> List[Document]:
+        from pypdf import PdfReader, PdfWriter
+
+        reader = PdfReader(file_path)
+        writer = PdfWriter()
+        for page_number in range(start, end):
+            writer.add_page(reader.pages[page_number])
+
+        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+            writer.write(f)
+            range_path = f.name
+        try:
+            documents = self.parser.load_data(range_path)
+        finally:
+            os.remove(range_path)
+
+        for document in documents:
+            document.metadata.update({"file_name": os.path.basename(file_path),
+                                      "page_label": f"{start + 1}-{end}"})
+        return documents
+
+def get_page_parser(backend: str = PDF_BACKEND, llama_parser=None):
+    if backend == "local":
+        return LocalPdfParser()
+    if backend == "llamaparse":
+        return LlamaParsePageParser(llama_parser)
+    raise ValueError(f"Unknown PDF backend {backend}")
+
+_DONE = object()
+
+def tag_documents(documents: List[Document], metadata: Dict[str, str]):
+    """Adds bookkeeping metadata to documents without showing it to the embedding model or LLM"""
+    for document in documents:
+        document.metadata.update(metadata)
+        document.excluded_embed_metadata_keys = list(set(document.excluded_embed_metadata_keys) | set(metadata))
+        document.excluded_llm_metadata_keys = list(set(document.excluded_llm_metadata_keys) | set(metadata))
+
+def ingest_pdf(file_path: str, page_parser, on_progress: Optional[OnProgress] = None,
+               pages_per_range: int = INGEST_PAGES_PER_RANGE, queue_size: int = INGEST_QUEUE_SIZE,
+               storage_context: Optional[StorageContext] = None,
+               metadata: Optional[Dict[str, str]] = None,
+               on_range: Optional[OnRange] = None) -> Optional[VectorStoreIndex]:
+    """Builds a vector index from a PDF while it is being parsed.
+
+    Page ranges are parsed by `page_parser.parse_workers` threads, chunked by another
+    thread and embedded and inserted on the calling thread, with bounded queues in
+    between so only a few ranges are held in memory at a time. `on_progress` is called
+    with (pages done, total pages) from the calling thread after each range is indexed.
+    Nodes go to the vector store of `storage_context` if given and carry `metadata`.
+    The parsed documents of each range are handed to `on_range` once it is indexed and
+    not kept after. Returns None when no text could be extracted and raises
+    PdfIngestionError when the file or one of its ranges cannot be read.
+    """
+    total_pages = page_count(file_path)
+    ranges: "queue.Queue" = queue.Queue()
+    for start in range(0, total_pages, pages_per_range):
+        ranges.put((start, min(start + pages_per_range, total_pages)))
+
+    parsed: "queue.Queue" = queue.Queue(maxsize=queue_size)
+    chunked: "queue.Queue" = queue.Queue(maxsize=queue_size)
+    stop = threading.Event()
+    parse_workers = max(1, min(page_parser.parse_workers, ranges.qsize()))
+
+    def put(q: "queue.Queue", item) -> bool:
+        while not stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def parse():
+        while not stop.is_set():
+            try:
+                start, end = ranges.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                with span("ingest.parse", pages=end - start):
+                    item = (start, end, page_parser.parse(file_path, start, end))
+            except Exception as e:
+                item = PdfIngestionError(f"Could not parse pages {start + 1}-{end}: {e}")
+                item.__cause__ = e
+            if not put(parsed, item):
+                return
+        put(parsed, _DONE)
+
+    def chunk():
+        remaining_workers = parse_workers
+        while remaining_workers and not stop.is_set():
+            try:
+                item = parsed.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if item is _DONE:
+                remaining_workers -= 1
+                continue
+            if not isinstance(item, Exception):
+                start, end, documents = item
+                if metadata:
+                    tag_documents(documents, metadata)
+                with span("ingest.chunk", pages=end - start):
+                    item = (start, end, documents,
+                            Settings.node_parser.get_nodes_from_documents(documents) if documents else [])
+            if not put(chunked, item):
+                return
+        put(chunked, _DONE)
+
+    threads = [threading.Thread(target=contextvars.copy_context().run, args=(parse,), name=f"fico-ingest-parse-{i}", daemon=True)
+               for i in range(parse_workers)]
+    threads.append(threading.Thread(target=contextvars.copy_context().run, args=(chunk,), name="fico-ingest-chunk", daemon=True))
+    for thread in threads:
+        thread.start()
+
+    index = VectorStoreIndex(nodes=[], storage_context=storage_context)
+    pages_done = 0
+    node_count = 0
+    try:
+        while True:
+            item = chunked.get()
+            if item is _DONE:
+                break
+            if isinstance(item, Exception):
+                raise item
+            start, end, documents, nodes = item
+            if nodes:
+                with span("ingest.embed", chunks=len(nodes)):
+                    index.insert_nodes(nodes)
+                node_count += len(nodes)
+            if on_range is not None:
+                on_range(start, documents)
+            pages_done += end - start
+            logger.debug(f"Indexed pages {start + 1}-{end} of {file_path} ({len(nodes)} chunks)")
+            if on_progress is not None:
+                on_progress(pages_done, total_pages)
+    finally:
+        # Lets the parse and chunk threads exit if indexing failed half way
+        stop.set()
+
+    return index if node_count else None
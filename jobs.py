@@ -0,0 +1,199 @@
+import os
+import time
+import uuid
+import threading
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Iterator, Optional, Set
+
+from phi.utils.log import logger
+
+from tracing import Trace, use_trace
+
+# Jobs running at once per process, the others wait in line
+JOBS_MAX_CONCURRENT = int(os.environ.get('FICO_JOBS_MAX_CONCURRENT', 4))
+# How long a finished job is kept for the sessions waiting on it to read its result
+JOBS_KEEP_SECONDS = float(os.environ.get('FICO_JOBS_KEEP_SECONDS', 10 * 60))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+FINISHED = (DONE, FAILED, CANCELLED)
+
+class JobCancelled(Exception):
+    pass
+
+class Job:
+    """Background work whose status, stage and partial text are polled by the UI.
+
+    The job function receives the job and reports through `update` and `on_delta`,
+    both of which raise `JobCancelled` once the job is cancelled so it stops at the
+    next checkpoint.
+    """
+
+    def __init__(self, key: Hashable, name: str, trace: Optional[Trace] = None):
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.name = name
+        self.trace = trace
+        self.status = QUEUED
+        self.stage = ""
+        self.progress: Optional[float] = None
+        self.text = ""
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.subscribers: Set[str] = set()
+        self._cancelled = threading.Event()
+        self._version = 0
+        self._cond = threading.Condition()
+
+    @property
+    def done(self) -> bool:
+        return self.status in FINISHED
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def _changed(self, **fields):
+        with self._cond:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self._version += 1
+            self._cond.notify_all()
+
+    def check_cancelled(self):
+        if self._cancelled.is_set():
+            raise JobCancelled(self.name)
+
+    def update(self, stage: Optional[str] = None, progress: Optional[float] = None):
+        self.check_cancelled()
+        self._changed(stage=self.stage if stage is None else stage, progress=progress)
+
+    def on_delta(self, delta: Optional[str]):
+        """Streams text like `ChatStream`: `None` discards the text so far"""
+        self.check_cancelled()
+        if delta is None or delta:
+            self._changed(text="" if delta is None else self.text + delta)
+
+    def cancel(self):
+        with self._cond:
+            self._cancelled.set()
+            if self.status == QUEUED:
+                # Never started, the executor skips it
+                self._changed(status=CANCELLED, finished=time.time())
+
+    def run(self, fn: Callable[["Job"], Any]):
+        with self._cond:
+            if self.cancelled:
+                return
+            self._changed(status=RUNNING, started=time.time())
+        outcome: Dict[str, Any] = {}
+        try:
+            with use_trace(self.trace):
+                outcome.update(result=fn(self), status=DONE)
+        except JobCancelled:
+            logger.info(f"Job {self.name} cancelled")
+            outcome.update(status=CANCELLED)
+        except BaseException as e:
+            logger.warning(f"Job {self.name} failed: {e}")
+            outcome.update(error=e, status=FAILED)
+        if self.trace is not None:
+            self.trace.finish()
+        self._changed(finished=time.time(), **outcome)
+
+    def updates(self, timeout: Optional[float] = None) -> Iterator["Job"]:
+        """Yields the job every time it changes, and at least every `timeout` seconds, until it finishes"""
+        version = -1
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._version != version, timeout)
+                version, done = self._version, self.done
+            yield self
+            if done:
+                return
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: self.done, timeout)
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._cond:
+            return {"id": self.id, "name": self.name, "status": self.status, "stage": self.stage,
+                    "progress": self.progress, "subscribers": len(self.subscribers),
+                    "seconds": (self.finished or time.time()) - (self.started or self.created)}
+
+class JobExecutor:
+    """Runs jobs on a bounded thread pool, identical requests share one job.
+
+    A job is identified by its key (e.g. ticker and report options). Submitting a key
+    whose job is still queued or running returns that job and subscribes the caller
+    to it, a finished job is never served to a new request. Finished jobs stay
+    readable by id for `keep_seconds`. A subscriber's cancel only cancels the job
+    once no one else is subscribed.
+    """
+
+    def __init__(self, max_workers: int = JOBS_MAX_CONCURRENT, keep_seconds: float = JOBS_KEEP_SECONDS):
+        self.keep_seconds = keep_seconds
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fico-job")
+        self._jobs: Dict[str, Job] = {}
+        self._by_key: Dict[Hashable, Job] = {}
+        self._lock = threading.Lock()
+        self._stats = {"submitted": 0, "shared": 0, "cancelled": 0}
+
+    def _prune(self):
+        # Called with the lock held
+        now = time.time()
+        for job in [job for job in self._jobs.values() if job.finished and now - job.finished > self.keep_seconds]:
+            del self._jobs[job.id]
+            if self._by_key.get(job.key) is job:
+                del self._by_key[job.key]
+
+    def submit(self, key: Hashable, name: str, fn: Callable[[Job], Any], subscriber: str,
+               trace: Optional[Trace] = None) -> Job:
+        with self._lock:
+            self._prune()
+            job = self._by_key.get(key)
+            if job is not None and job.status in (QUEUED, RUNNING) and not job.cancelled:
+                job.subscribers.add(subscriber)
+                self._stats["shared"] += 1
+                return job
+
+            job = Job(key, name, trace=trace)
+            job.subscribers.add(subscriber)
+            self._jobs[job.id] = job
+            self._by_key[key] = job
+            self._stats["submitted"] += 1
+        # Run in a copy of the caller's context, like the other background work
+        self._pool.submit(contextvars.copy_context().run, job.run, fn)
+        return job
+
+    def get(self, job_id: Optional[str]) -> Optional[Job]:
+        with self._lock:
+            return self._jobs.get(job_id) if job_id else None
+
+    def cancel(self, job_id: str, subscriber: str) -> bool:
+        """Unsubscribes from a job and cancels it when it was the last subscriber, returns whether it was cancelled"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or job.done:
+                return False
+            job.subscribers.discard(subscriber)
+            if job.subscribers:
+                return False
+            self._stats["cancelled"] += 1
+        job.cancel()
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            jobs = list(self._jobs.values())
+            stats = dict(self._stats)
+        return {**stats, **{status: sum(1 for job in jobs if job.status == status) for status in (QUEUED, RUNNING)}}
+
+jobs = JobExecutor()
@@ -0,0 +1,50 @@
+import threading
+from typing import Any, Dict, List, Optional
+
+from llama_index.core.callbacks import CallbackManager, CBEventType, EventPayload
+from llama_index.core.callbacks.base_handler import BaseCallbackHandler
+
+from tracing import current_trace, end_span, llm_token_usage, start_span
+
+class LLMSpanHandler(BaseCallbackHandler):
+    """Records every chat call of an LLM as a span with its token counts, under the span it was made in.
+
+    For LLMs called inside llama_index components, e.g. the response synthesizer of a
+    query engine, where the call itself cannot be wrapped in `span`.
+    """
+
+    def __init__(self, name: str):
+        super().__init__(event_starts_to_ignore=[], event_ends_to_ignore=[])
+        self.name = name
+        # event id -> span, messages and trace of a call in progress
+        self._calls: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+
+    def on_event_start(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                       event_id: str = "", parent_id: str = "", **kwargs: Any) -> str:
+        # Completions are made through chat by the chat models, only the chat call is counted
+        if event_type == CBEventType.LLM and payload and EventPayload.MESSAGES in payload:
+            with self._lock:
+                self._calls[event_id] = (start_span(self.name), payload[EventPayload.MESSAGES], current_trace())
+        return event_id
+
+    def on_event_end(self, event_type: CBEventType, payload: Optional[Dict[str, Any]] = None,
+                     event_id: str = "", **kwargs: Any) -> None:
+        with self._lock:
+            call = self._calls.pop(event_id, None)
+        if call is None:
+            return
+        current, messages, trace = call
+        response = (payload or {}).get(EventPayload.RESPONSE)
+        if response is not None:
+            current.set(**llm_token_usage(messages, response))
+        end_span(current, trace)
+
+    def start_trace(self, trace_id: Optional[str] = None) -> None:
+        pass
+
+    def end_trace(self, trace_id: Optional[str] = None, trace_map: Optional[Dict[str, List[str]]] = None) -> None:
+        pass
+
+def llm_span_callbacks(name: str) -> CallbackManager:
+    return CallbackManager([LLMSpanHandler(name)])
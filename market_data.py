@@ -0,0 +1,332 @@
+import time
+import threading
+import contextvars
+from concurrent.futures import Executor, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional
+
+from phi.utils.log import logger
+
+from context_builder import build_report_context
+from startup import LazyModule, lazy_callable
+from tracing import span
+from ttl_cache import market_cache
+
+# Imported on the first fetch
+yf = LazyModule("yfinance")
+DDGS = lazy_callable("duckduckgo_search", "DDGS")
+
+GATHER_MAX_WORKERS = 8
+
+# Seconds to wait for each source (fetch and index build) from when it starts running before giving up on it
+SOURCE_TIMEOUTS = {
+    "company_info": 30,
+    "company_news": 20,
+    "analyst_recommendations": 30,
+    "upgrades_downgrades": 30,
+}
+
+_executor = ThreadPoolExecutor(max_workers=GATHER_MAX_WORKERS, thread_name_prefix="fico-gather")
+
+class RateLimiter:
+    """Token bucket allowing `rate_per_minute` calls per minute, shared between threads"""
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self.interval = 60.0 / rate_per_minute
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) / self.interval)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) * self.interval
+            time.sleep(wait)
+
+# provider -> RateLimiter, applied to upstream calls only so cache hits are not throttled
+rate_limiters: Dict[str, RateLimiter] = {}
+
+def _limited(provider: str, fetch: Callable[[], object]) -> Callable[[], object]:
+    def call():
+        limiter = rate_limiters.get(provider)
+        if limiter is not None:
+            limiter.acquire()
+        return fetch()
+    return call
+
+@dataclass
+class SourceResult:
+    name: str
+    report_md: str = ""
+    tool_md: Optional[str] = None
+    error: Optional[str] = None
+    # The fetched data, rendered into the report context
+    data: Any = None
+    fetch_seconds: float = 0.0
+    index_seconds: float = 0.0
+    total_seconds: float = 0.0
+
+def _fetch_price_fields(ticker_symbol: str) -> dict:
+    fast_info = yf.Ticker(ticker_symbol).fast_info
+    return {
+        "regularMarketPrice": fast_info.last_price,
+        "currentPrice": fast_info.last_price,
+        "marketCap": fast_info.market_cap,
+        "fiftyTwoWeekLow": fast_info.year_low,
+        "fiftyTwoWeekHigh": fast_info.year_high,
+        "fiftyDayAverage": fast_info.fifty_day_average,
+        "twoHundredDayAverage": fast_info.two_hundred_day_average,
+    }
+
+def fetch_company_info(ticker_symbol: str) -> dict:
+    company_info = market_cache.get_or_fetch("info", ticker_symbol,
+                                              _limited("yfinance", lambda: yf.Ticker(ticker_symbol).info))
+    if not company_info:
+        return company_info
+
+    # Price fields go stale in seconds, the rest of the profile in hours
+    try:
+        price_fields = market_cache.get_or_fetch("price", ticker_symbol,
+                                                  _limited("yfinance", lambda: _fetch_price_fields(ticker_symbol)))
+    except Exception as e:
+        logger.warning(f"Could not refresh price fields for {ticker_symbol}: {e}")
+        price_fields = {}
+    return {**company_info, **{key: value for key, value in price_fields.items() if value is not None}}
+
+def fetch_company_news(ticker_symbol: str) -> List[dict]:
+    return market_cache.get_or_fetch("news", ticker_symbol,
+                                     _limited("ddgs", lambda: DDGS().news(keywords=ticker_symbol+" stocks", max_results=5)))
+
+def fetch_analyst_recommendations(ticker_symbol: str):
+    return market_cache.get_or_fetch("recommendations", ticker_symbol,
+                                     _limited("yfinance", lambda: yf.Ticker(ticker_symbol).recommendations))
+
+def fetch_upgrades_downgrades(ticker_symbol: str):
+    upgrades_downgrades = market_cache.get_or_fetch("upgrades_downgrades", ticker_symbol,
+                                                    _limited("yfinance", lambda: yf.Ticker(ticker_symbol).upgrades_downgrades))
+    return upgrades_downgrades[0:20]
+
+def fetch_price_history(ticker_symbol: str, period: str = "1y", interval: str = "1mo"):
+    return market_cache.get_or_fetch("history", f"{ticker_symbol}:{period}:{interval}",
+                                     _limited("yfinance", lambda: yf.Ticker(ticker_symbol).history(period=period, interval=interval)))
+
+def company_info_to_md(company_info_full: dict):
+    company_info_md = "## Company Info\n\n"
+    if not company_info_full:
+        return company_info_md + "No information found for this company.\n", None
+
+    company_info_cleaned = {
+        "Name": company_info_full.get("shortName"),
+        "Symbol": company_info_full.get("symbol"),
+        "Current Stock Price": f"{company_info_full.get('regularMarketPrice', company_info_full.get('currentPrice'))} {company_info_full.get('currency', 'USD')}",
+        "Market Cap": f"{company_info_full.get('marketCap', company_info_full.get('enterpriseValue'))} {company_info_full.get('currency', 'USD')}",
+        "Sector": company_info_full.get("sector"),
+        "Industry": company_info_full.get("industry"),
+        "Address": company_info_full.get("address1"),
+        "City": company_info_full.get("city"),
+        "State": company_info_full.get("state"),
+        "Zip": company_info_full.get("zip"),
+        "Country": company_info_full.get("country"),
+        "EPS": company_info_full.get("trailingEps"),
+        "P/E Ratio": company_info_full.get("trailingPE"),
+        "52 Week Low": company_info_full.get("fiftyTwoWeekLow"),
+        "52 Week High": company_info_full.get("fiftyTwoWeekHigh"),
+        "50 Day Average": company_info_full.get("fiftyDayAverage"),
+        "200 Day Average": company_info_full.get("twoHundredDayAverage"),
+        "Website": company_info_full.get("website"),
+        "Summary": company_info_full.get("longBusinessSummary"),
+        "Analyst Recommendation": company_info_full.get("recommendationKey"),
+        "Number Of Analyst Opinions": company_info_full.get("numberOfAnalystOpinions"),
+        "Employees": company_info_full.get("fullTimeEmployees"),
+        "Total Cash": company_info_full.get("totalCash"),
+        "Free Cash flow": company_info_full.get("freeCashflow"),
+        "Operating Cash flow": company_info_full.get("operatingCashflow"),
+        "EBITDA": company_info_full.get("ebitda"),
+        "Revenue Growth": company_info_full.get("revenueGrowth"),
+        "Gross Margins": company_info_full.get("grossMargins"),
+        "Ebitda Margins": company_info_full.get("ebitdaMargins"),
+    }
+    for key, value in company_info_cleaned.items():
+        if value:
+            company_info_md += f"  - {key}: {value}\n\n"
+
+    report_md = "This section contains information about the company.\n\n" + company_info_md
+    return report_md, company_info_md
+
+def company_news_to_md(company_news: List[dict]):
+    company_news_md = "## Company News\n\n\n"
+    if len(company_news) == 0:
+        return company_news_md + "No news found for this company.\n", None
+
+    for news_item in company_news:
+        company_news_md += f"#### {news_item['title']}\n\n"
+        if "date" in news_item:
+            company_news_md += f"  - Date: {news_item['date']}\n\n"
+        if "url" in news_item:
+            company_news_md += f"  - Link: {news_item['url']}\n\n"
+        if "source" in news_item:
+            company_news_md += f"  - Source: {news_item['source']}\n\n"
+        if "body" in news_item:
+            company_news_md += f"{news_item['body']}"
+        company_news_md += "\n\n"
+
+    report_md = "This section contains the most recent news articles about the company.\n\n" + company_news_md
+    return report_md, company_news_md
+
+def analyst_recommendations_to_md(analyst_recommendations):
+    report_md = "## Analyst Recommendations\n\n"
+    if analyst_recommendations.empty:
+        return report_md + "No analyst recommendations found for this stock.\n", None
+
+    analyst_recommendations_md = analyst_recommendations.to_markdown()
+    report_md += "This table outlines the most recent analyst recommendations for the stock.\n\n"
+    report_md += f"{analyst_recommendations_md}\n"
+    return report_md, analyst_recommendations_md
+
+def upgrades_downgrades_to_md(upgrades_downgrades):
+    report_md = "## Upgrades/Downgrades\n\n"
+    if upgrades_downgrades.empty:
+        return report_md + "No upgrades or downgrades found for this stock.\n", None
+
+    upgrades_downgrades_md = upgrades_downgrades.to_markdown()
+    report_md += "This table outlines the most recent upgrades and downgrades for the stock.\n\n"
+    report_md += f"{upgrades_downgrades_md}\n"
+    return report_md, upgrades_downgrades_md
+
+# name -> (fetch, to_md, section title, tool suffix, tool description)
+SOURCES = {
+    "company_info": (fetch_company_info, company_info_to_md, "Company Info", "_company_info",
+                     """Provides current company information about {stock_name}.
+                        Use a detailed plain text question as input to the tool."""),
+    "company_news": (fetch_company_news, company_news_to_md, "Company News", "_company_news",
+                     """Provides 5 current news about {stock_name}.
+                        No input is required."""),
+    "analyst_recommendations": (fetch_analyst_recommendations, analyst_recommendations_to_md,
+                                "Analyst Recommendations", "_analyst_recommendations",
+                                """Provides analyst recommendation about {stock_name}.
+                                    No input is required."""),
+    "upgrades_downgrades": (fetch_upgrades_downgrades, upgrades_downgrades_to_md,
+                            "Upgrades/Downgrades", "_upgrades_downgrades_md",
+                            """Provides upgrades and downgrades of {stock_name}.
+                                No input is required."""),
+}
+
+# (markdown, tool name, description) -> whether a new tool was registered
+BuildTool = Callable[[str, str, str], object]
+DropTool = Callable[[str], None]
+
+class GatherStage:
+    """Fetches market data sources and builds their tools concurrently.
+
+    Each source is fetched and indexed on a shared bounded thread pool. A source that
+    fails or runs past its timeout is reported in its `SourceResult` instead of
+    holding up the others; a timed out source does not keep its tool, one registered
+    while it timed out is dropped again with `drop_tool`.
+    A timeout counts from when its source starts running, not while it waits for a
+    worker behind other reports' sources.
+    """
+
+    def __init__(self, ticker_symbol: str, sources: List[str], build_tool: Optional[BuildTool] = None,
+                 timeouts: Optional[Dict[str, float]] = None, executor: Optional[Executor] = None,
+                 drop_tool: Optional[DropTool] = None):
+        self.ticker_symbol = ticker_symbol
+        self.stock_name = ticker_symbol.lower().replace(".", "_")
+        self.sources = sources
+        self.build_tool = build_tool
+        self.drop_tool = drop_tool
+        self.timeouts = {**SOURCE_TIMEOUTS, **(timeouts or {})}
+        self.executor = executor or _executor
+        self._futures = {}
+        self._cancelled = {name: threading.Event() for name in sources}
+        self._running = {name: threading.Event() for name in sources}
+        self._source_started: Dict[str, float] = {}
+        # Orders a source keeping its tool against results() giving up on it
+        self._outcome_locks = {name: threading.Lock() for name in sources}
+        self._kept: set = set()
+
+    def _run_source(self, name: str) -> SourceResult:
+        fetch, to_md, _, tool_suffix, description = SOURCES[name]
+        result = SourceResult(name=name)
+
+        start = self._source_started[name] = time.perf_counter()
+        self._running[name].set()
+        with span(f"fetch.{name}", ticker=self.ticker_symbol):
+            data = fetch(self.ticker_symbol)
+            result.report_md, result.tool_md = to_md(data)
+            result.data = data
+        result.fetch_seconds = time.perf_counter() - start
+
+        built = False
+        if result.tool_md is not None and self.build_tool is not None and not self._cancelled[name].is_set():
+            index_start = time.perf_counter()
+            with span(f"index.{name}", chars=len(result.tool_md)):
+                built = self.build_tool(result.tool_md, self.stock_name+tool_suffix, description.format(stock_name=self.stock_name))
+            result.index_seconds = time.perf_counter() - index_start
+
+        with self._outcome_locks[name]:
+            if self._cancelled[name].is_set():
+                # Timed out while the tool was built, it was reported without one
+                if built and self.drop_tool is not None:
+                    self.drop_tool(self.stock_name+tool_suffix)
+            else:
+                self._kept.add(name)
+        result.total_seconds = time.perf_counter() - start
+        return result
+
+    def start(self) -> "GatherStage":
+        self._started = time.perf_counter()
+        for name in self.sources:
+            # Run in a copy of the caller's context so spans land in its trace
+            self._futures[name] = self.executor.submit(contextvars.copy_context().run, self._run_source, name)
+        return self
+
+    def _wait_running(self, name: str):
+        # Queued behind other work the source has not used any of its time yet
+        while not self._running[name].wait(0.1):
+            if self._futures[name].done():
+                # Failed before running, e.g. the executor was shut down
+                self._futures[name].result()
+                return
+
+    def results(self) -> Dict[str, SourceResult]:
+        results = {}
+        for name in self.sources:
+            title = SOURCES[name][2]
+            try:
+                self._wait_running(name)
+                remaining = self.timeouts[name] - (time.perf_counter() - self._source_started[name])
+                results[name] = self._futures[name].result(timeout=max(remaining, 0))
+            except FutureTimeoutError:
+                with self._outcome_locks[name]:
+                    kept = name in self._kept
+                    if not kept:
+                        self._cancelled[name].set()
+                if kept:
+                    # Finished with its tool just as the time ran out
+                    results[name] = self._futures[name].result()
+                    continue
+                logger.warning(f"{name} for {self.ticker_symbol} timed out after {self.timeouts[name]}s")
+                results[name] = SourceResult(name=name, error="timeout", total_seconds=self.timeouts[name],
+                                             report_md=f"## {title}\n\nCould not retrieve {title.lower()} in time.\n")
+            except Exception as e:
+                logger.warning(f"{name} for {self.ticker_symbol} failed: {e}")
+                started = self._source_started.get(name)
+                results[name] = SourceResult(name=name, error=str(e),
+                                             total_seconds=time.perf_counter() - started if started is not None else 0.0,
+                                             report_md=f"## {title}\n\nCould not retrieve {title.lower()}.\n")
+
+        for result in results.values():
+            logger.debug(f"{result.name}: fetch {result.fetch_seconds:.2f}s, index {result.index_seconds:.2f}s, "
+                         f"total {result.total_seconds:.2f}s" + (f" ({result.error})" if result.error else ""))
+        logger.debug(f"Market data cache: {market_cache.stats()}")
+        return results
+
+def report_input_from_results(results: Dict[str, SourceResult]) -> str:
+    return build_report_context(results).text
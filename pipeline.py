@@ -0,0 +1,187 @@
+import os
+import time
+import datetime
+from concurrent.futures import Executor
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from llama_index.core.base.llms.types import MessageRole, ChatMessage
+
+from ingestion import OnProgress
+from jobs import Job
+from market_data import GatherStage, BuildTool, DropTool, SourceResult, rate_limiters, report_input_from_results
+from startup import lazy_callable
+from streaming import OnDelta, stream_llm_chat
+from tracing import count_tokens, llm_token_usage, span
+
+GROQ_API_KEY = os.environ.get('GROQ_API_KEY')
+REPORT_MODEL = "llama3-70b-8192"
+
+# Imported when the first report is generated
+Groq = lazy_callable("llama_index.llms.groq", "Groq")
+
+DEFAULT_SOURCES = ["company_info", "company_news", "analyst_recommendations", "upgrades_downgrades"]
+
+REPORT_FORMAT = """
+    <report_format>
+    ## [Company Name]: Investment Report
+
+    ### **Overview**
+    {give a brief introduction of the company and why the user should read this report}
+    {make this section engaging and create a hook for the reader}
+
+    ### Core Metrics
+    {provide a summary of core metrics and show the latest data}
+    - Current price: {current price}
+    - 52-week high: {52-week high}
+    - 52-week low: {52-week low}
+    - Market Cap: {Market Cap} in billions
+    - P/E Ratio: {P/E Ratio}
+    - Earnings per Share: {EPS}
+    - 50-day average: {50-day average}
+    - 200-day average: {200-day average}
+    - Analyst Recommendations: {buy, hold, sell} (number of analysts)
+
+    ### Financial Performance
+    {provide a detailed analysis of the company's financial performance}
+
+    ### Growth Prospects
+    {analyze the company's growth prospects and future potential}
+
+    ### News and Updates
+    {summarize relevant news that can impact the stock price}
+
+    ### Upgrades and Downgrades
+    {share 2 upgrades or downgrades including the firm, and what they upgraded/downgraded to}
+    {this should be a paragraph not a table}
+
+    ### [Summary]
+    {give a summary of the report and what are the key takeaways}
+
+    ### [Recommendation]
+    {provide a recommendation on the stock along with a thorough reasoning}
+
+    Report generated on: {Month Date, Year (hh:mm AM/PM)}
+    </report_format>
+"""
+
+@dataclass
+class ReportResult:
+    ticker: str
+    report: str
+    report_input: str
+    source_results: Dict[str, SourceResult] = field(default_factory=dict)
+    gather_seconds: float = 0.0
+    report_seconds: float = 0.0
+    warnings: List[str] = field(default_factory=list)
+
+    def timings(self) -> Dict[str, object]:
+        return {
+            "ticker": self.ticker,
+            "gather_seconds": self.gather_seconds,
+            "report_seconds": self.report_seconds,
+            "sources": {name: {"fetch_seconds": result.fetch_seconds, "index_seconds": result.index_seconds,
+                               "total_seconds": result.total_seconds, "error": result.error}
+                        for name, result in self.source_results.items()},
+        }
+
+def get_report_llm():
+    return Groq(model=REPORT_MODEL, api_key=GROQ_API_KEY)
+
+def build_report_messages(ticker_symbol: str, report_input: str) -> List[ChatMessage]:
+    system_prompt = f"""You are a Senior Investment Analyst for Goldman Sachs tasked with producing a research report for a very important client.
+    You will be provided with a stock and information from junior researchers.
+    Carefully read the research and generate a final - Goldman Sachs worthy investment report.
+    Make your report engaging, informative, and well-structured.
+    When you share numbers, make sure to include the units (e.g., millions/billions) and currency.
+    REMEMBER: This report is for a very important client, so the quality of the report is important.
+    Make sure your recommendations are well-supported and backed by data.
+    Make sure your report is properly formatted and follows the <report_format> provided below.
+    If you don't have enough information for a section, you can leave it blank.
+    {REPORT_FORMAT}
+    Do not include Goldman Sachs in your report.
+    Current datetime is: {datetime.datetime.now().strftime('%B %d, %Y, %I:%M %p')}
+    """
+
+    return [ChatMessage(role=MessageRole.SYSTEM, content=system_prompt),
+            ChatMessage(role=MessageRole.SYSTEM, content=report_input),
+            ChatMessage(role=MessageRole.USER, content=f"Please generate a report about: {ticker_symbol}\n\n\n")]
+
+def gather(ticker_symbol: str, sources: List[str] = DEFAULT_SOURCES, build_tool: Optional[BuildTool] = None,
+           timeouts: Optional[Dict[str, float]] = None, executor: Optional[Executor] = None,
+           drop_tool: Optional[DropTool] = None) -> GatherStage:
+    """Starts fetching `sources` in the background, collect them with `.results()`"""
+    return GatherStage(ticker_symbol, sources, build_tool, timeouts, executor=executor, drop_tool=drop_tool).start()
+
+def generate_report(ticker_symbol: str, report_input: str, llm=None, on_delta: Optional[OnDelta] = None) -> str:
+    llm = llm or get_report_llm()
+    messages = build_report_messages(ticker_symbol, report_input)
+    if "groq" in rate_limiters:
+        rate_limiters["groq"].acquire()
+    with span("report.llm", model=REPORT_MODEL) as llm_span:
+        if on_delta is not None:
+            report = stream_llm_chat(llm, messages, on_delta)
+            llm_span.set(prompt_tokens=sum(count_tokens(message.content) for message in messages),
+                         completion_tokens=count_tokens(report))
+        else:
+            response = llm.chat(messages)
+            report = response.message.content
+            llm_span.set(**llm_token_usage(messages, response))
+    return report
+
+def run_report(ticker_symbol: str, sources: List[str] = DEFAULT_SOURCES, llm=None,
+               timeouts: Optional[Dict[str, float]] = None, executor: Optional[Executor] = None) -> ReportResult:
+    """Gathers market data for a ticker and generates its report, without any UI"""
+    start = time.perf_counter()
+    source_results = gather(ticker_symbol, sources, timeouts=timeouts, executor=executor).results()
+    report_input = report_input_from_results(source_results)
+    gather_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    report = generate_report(ticker_symbol, report_input, llm=llm)
+
+    return ReportResult(ticker=ticker_symbol, report=report, report_input=report_input,
+                        source_results=source_results, gather_seconds=gather_seconds,
+                        report_seconds=time.perf_counter() - start)
+
+def report_job(ticker_symbol: str, sources: List[str] = DEFAULT_SOURCES, build_tool: Optional[BuildTool] = None,
+               build_document_tool: Optional[Callable[[OnProgress], bool]] = None,
+               write_report: bool = True, drop_tool: Optional[DropTool] = None) -> Callable[[Job], ReportResult]:
+    """The report as a background job: market data and its tools, the annual report tool, then the streamed report.
+
+    Without `write_report` the job only builds the tools, e.g. for a session whose report is kept but whose
+    assistant was evicted, and its result has an empty report.
+    """
+    def run(job: Job) -> ReportResult:
+        start = time.perf_counter()
+        job.update(stage="Fetching market data")
+        gathering = gather(ticker_symbol, sources, build_tool=build_tool, drop_tool=drop_tool)
+
+        warnings = []
+        if build_document_tool is not None:
+            job.update(stage="Processing the annual report")
+            def show_progress(pages_done: int, total_pages: int):
+                job.update(stage=f"Indexed {pages_done} of {total_pages} annual report pages",
+                           progress=pages_done / max(total_pages, 1))
+
+            if not build_document_tool(show_progress):
+                warnings.append("Could not read the annual report PDF")
+
+        source_results = gathering.results()
+        job.check_cancelled()
+        warnings += [f"Could not retrieve {result.name.replace('_', ' ')}: {result.error}"
+                     for result in source_results.values() if result.error]
+        report_input = report_input_from_results(source_results) if write_report else ""
+        gather_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        report = ""
+        if write_report:
+            job.update(stage="Writing the report")
+            report = generate_report(ticker_symbol, report_input, on_delta=job.on_delta)
+
+        return ReportResult(ticker=ticker_symbol, report=report, report_input=report_input,
+                            source_results=source_results, gather_seconds=gather_seconds,
+                            report_seconds=time.perf_counter() - start, warnings=warnings)
+
+    return run
@@ -0,0 +1,182 @@
+import os
+import time
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from phi.utils.log import logger
+
+from assistant import Assistant, TickerState
+
+# Sessions untouched for this long lose their assistant, tickers no session uses are dropped after it too
+ASSISTANT_IDLE_SECONDS = float(os.environ.get('FICO_ASSISTANT_IDLE_SECONDS', 30 * 60))
+# Above this estimate the least recently used tickers and sessions are evicted first, 0 disables the limit
+REGISTRY_MAX_MB = float(os.environ.get('FICO_REGISTRY_MAX_MB', 2048))
+
+# A Python float held in a list: the float object and its slot
+PY_FLOAT_BYTES = 32
+
+def query_engine_bytes(query_engine) -> int:
+    """Estimated memory of the index behind a query engine, its embeddings and node text"""
+    query_engine = getattr(query_engine, "query_engine", query_engine)
+    retriever = getattr(query_engine, "retriever", None)
+    vector_store = getattr(retriever, "_vector_store", None)
+    if vector_store is None:
+        return 0
+    if hasattr(vector_store, "memory_bytes"):
+        return vector_store.memory_bytes()
+
+    embedding_dict = getattr(getattr(vector_store, "data", None), "embedding_dict", None) or {}
+    size = sum(len(embedding) for embedding in embedding_dict.values()) * PY_FLOAT_BYTES
+    docstore = getattr(retriever, "_docstore", None)
+    if docstore is not None:
+        size += sum(len(node.get_content()) for node in docstore.docs.values())
+    return size
+
+def ticker_bytes(state: TickerState) -> int:
+    return (sum(query_engine_bytes(query_engine) for query_engine in list(state.query_engines.values()))
+            + sum(state.section_chars.values()) + len(state.information_included))
+
+def session_bytes(assistant: Assistant) -> int:
+    if assistant.agent is None:
+        return 0
+    return sum(len(str(chat.content or "")) for chat in assistant.agent.chat_history)
+
+class _Session:
+    __slots__ = ("assistant", "ticker", "last_access")
+
+    def __init__(self, assistant: Assistant, ticker: str):
+        self.assistant = assistant
+        self.ticker = ticker
+        self.last_access = time.time()
+
+class AssistantRegistry:
+    """Process-wide assistants of the app sessions.
+
+    Sessions researching the same ticker share one `TickerState` (indexes, query
+    engines and tools), each keeps its own agent and chat history. Sessions idle
+    for `idle_seconds` are evicted, tickers once no session has used them for as
+    long, and the least recently used of both while the memory estimate is above
+    `max_bytes`.
+    """
+
+    def __init__(self, idle_seconds: float = ASSISTANT_IDLE_SECONDS, max_bytes: int = int(REGISTRY_MAX_MB * 1024**2)):
+        self.idle_seconds = idle_seconds
+        self.max_bytes = max_bytes
+        self._sessions: Dict[str, _Session] = {}
+        self._tickers: Dict[str, TickerState] = {}
+        self._ticker_access: Dict[str, float] = {}
+        # ticker -> (data versions, bytes), recomputed when its tools change
+        self._ticker_bytes: Dict[str, Tuple[Tuple, int]] = {}
+        self._lock = threading.Lock()
+        self._stats = {"sessions_created": 0, "sessions_evicted": 0, "tickers_created": 0, "tickers_shared": 0,
+                       "tickers_evicted": 0}
+
+    def assistant(self, session_id: str, ticker: str) -> Tuple[Assistant, bool]:
+        """The assistant of a session and whether it was just created, on the ticker's shared state.
+
+        A session that switches ticker gets a new assistant on the new ticker's state.
+        """
+        self.evict()
+        with self._lock:
+            now = time.time()
+            session = self._sessions.get(session_id)
+            if session is None or session.ticker != ticker:
+                state = self._tickers.get(ticker)
+                if state is None:
+                    state = self._tickers[ticker] = TickerState()
+                    self._stats["tickers_created"] += 1
+                else:
+                    self._stats["tickers_shared"] += 1
+                session = self._sessions[session_id] = _Session(Assistant(ticker=ticker, state=state), ticker)
+                self._stats["sessions_created"] += 1
+                created = True
+            else:
+                created = False
+            session.last_access = now
+            self._ticker_access[session.ticker] = now
+            return session.assistant, created
+
+    def release(self, session_id: str):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def _ticker_size(self, ticker: str) -> int:
+        state = self._tickers[ticker]
+        key = tuple(sorted(state.data_versions.items()))
+        cached = self._ticker_bytes.get(ticker)
+        if cached is None or cached[0] != key:
+            cached = self._ticker_bytes[ticker] = (key, ticker_bytes(state))
+        return cached[1]
+
+    def _unused_tickers(self):
+        used = {session.ticker for session in self._sessions.values()}
+        return [ticker for ticker in self._tickers if ticker not in used]
+
+    def _drop_session(self, session_id: str):
+        self._sessions.pop(session_id)
+        self._stats["sessions_evicted"] += 1
+
+    def _drop_ticker(self, ticker: str):
+        del self._tickers[ticker]
+        self._ticker_access.pop(ticker, None)
+        self._ticker_bytes.pop(ticker, None)
+        self._stats["tickers_evicted"] += 1
+
+    def evict(self) -> int:
+        """Drops idle sessions and unused tickers, then the least recently used while over the memory limit"""
+        with self._lock:
+            evicted = 0
+            now = time.time()
+            for session_id in [session_id for session_id, session in self._sessions.items()
+                               if now - session.last_access > self.idle_seconds]:
+                self._drop_session(session_id)
+                evicted += 1
+            for ticker in self._unused_tickers():
+                if now - self._ticker_access.get(ticker, 0) > self.idle_seconds:
+                    self._drop_ticker(ticker)
+                    evicted += 1
+
+            if self.max_bytes:
+                total = (sum(self._ticker_size(ticker) for ticker in self._tickers)
+                         + sum(session_bytes(session.assistant) for session in self._sessions.values()))
+                while total > self.max_bytes:
+                    # Unused tickers and sessions alike, least recently used first
+                    candidates = [(self._ticker_access.get(ticker, 0), "ticker", ticker) for ticker in self._unused_tickers()]
+                    candidates += [(session.last_access, "session", session_id) for session_id, session in self._sessions.items()]
+                    if not candidates:
+                        break
+                    _, kind, key = min(candidates)
+                    if kind == "ticker":
+                        total -= self._ticker_size(key)
+                        self._drop_ticker(key)
+                    else:
+                        total -= session_bytes(self._sessions[key].assistant)
+                        self._drop_session(key)
+                    evicted += 1
+
+            if evicted:
+                logger.info(f"Evicted {evicted} idle assistants, {len(self._sessions)} sessions and {len(self._tickers)} tickers left")
+            return evicted
+
+    def usage(self, session_id: Optional[str] = None) -> Dict[str, Any]:
+        """Estimated memory of every ticker (shared indexes and tools) and session (chat history) in MB"""
+        with self._lock:
+            now = time.time()
+            sessions = {}
+            for key, session in self._sessions.items():
+                sessions[key] = {"ticker": session.ticker, "mb": session_bytes(session.assistant) / 1024**2,
+                                 "idle_seconds": now - session.last_access}
+            tickers = {}
+            for ticker, state in self._tickers.items():
+                tickers[ticker] = {"sessions": sum(1 for session in self._sessions.values() if session.ticker == ticker),
+                                   "tools": len(state.tools), "mb": self._ticker_size(ticker) / 1024**2,
+                                   "idle_seconds": now - self._ticker_access.get(ticker, now)}
+            stats = dict(self._stats)
+        return {
+            "tickers": tickers,
+            "sessions": sessions if session_id is None else {key: value for key, value in sessions.items() if key == session_id},
+            "total_mb": sum(ticker["mb"] for ticker in tickers.values()) + sum(session["mb"] for session in sessions.values()),
+            **stats,
+        }
+
+registry = AssistantRegistry()
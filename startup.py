@@ -0,0 +1,104 @@
+import os
+import sys
+import time
+import importlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+from phi.utils.log import logger
+
+# imports: preload the heavy modules in the background once the app starts, all: load the embedding model too
+WARM_UP = os.environ.get('FICO_WARM_UP', "")
+WARM_UP_MODULES = ["yfinance", "duckduckgo_search", "llama_index.core", "llama_index.llms.anthropic",
+                   "llama_index.llms.groq", "llama_parse", "assistant", "pipeline", "registry"]
+
+def _process_start() -> float:
+    """The perf_counter() reading at process creation, from /proc where there is one, else now"""
+    now = time.perf_counter()
+    try:
+        with open("/proc/self/stat") as f:
+            # starttime, in clock ticks since boot, is the 22nd field and the command name may hold spaces
+            started_ticks = int(f.read().rsplit(")", 1)[1].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return now - max(0.0, uptime - started_ticks / os.sysconf("SC_CLK_TCK"))
+    except (OSError, ValueError, IndexError):
+        return now
+
+# Taken from the process so the interpreter and streamlit starting up, before any app module runs, are counted too
+PROCESS_START = _process_start()
+
+# step -> when it started (seconds since PROCESS_START), how long it took and on which thread
+_timings: Dict[str, Dict[str, Any]] = {}
+_lock = threading.Lock()
+_warm_up_thread: Optional[threading.Thread] = None
+
+def record(step: str, started: float, seconds: float):
+    """Keeps the first timing of a step"""
+    with _lock:
+        _timings.setdefault(step, {"at": started - PROCESS_START, "seconds": seconds,
+                                   "thread": threading.current_thread().name})
+
+@contextmanager
+def timed(step: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(step, start, time.perf_counter() - start)
+
+def timings() -> List[Dict[str, Any]]:
+    """Startup steps in the order they started, a module's import time excludes modules loaded before it"""
+    with _lock:
+        rows = [{"step": step, **timing} for step, timing in _timings.items()]
+    return sorted(rows, key=lambda row: row["at"])
+
+def lazy_import(name: str):
+    loaded = name in sys.modules
+    start = time.perf_counter()
+    module = importlib.import_module(name)
+    if not loaded:
+        record(f"import {name}", start, time.perf_counter() - start)
+    return module
+
+class LazyModule:
+    """Stand-in for a module, imported on first attribute access"""
+
+    def __init__(self, name: str):
+        self._name = name
+
+    def __getattr__(self, attr: str):
+        return getattr(lazy_import(self._name), attr)
+
+def lazy_callable(module: str, attr: str) -> Callable[..., Any]:
+    """Stand-in for a class or function of `module`, imported on first call"""
+    def call(*args, **kwargs):
+        return getattr(lazy_import(module), attr)(*args, **kwargs)
+
+    call.__name__ = attr
+    return call
+
+def _warm_up(level: str):
+    with timed("warm up"):
+        for name in WARM_UP_MODULES:
+            try:
+                lazy_import(name)
+            except Exception as e:
+                logger.warning(f"Could not preload {name}: {e}")
+        if level == "all":
+            from embeddings import embedding_service
+
+            with timed("load embedding model"):
+                embedding_service.warm_up()
+
+def warm_up(level: str = WARM_UP) -> Optional[threading.Thread]:
+    """Starts preloading in a background thread, once per process, when `level` is imports or all"""
+    global _warm_up_thread
+    if level not in ("imports", "all"):
+        return None
+    with _lock:
+        if _warm_up_thread is None:
+            _warm_up_thread = threading.Thread(target=_warm_up, args=(level,), name="fico-warm-up", daemon=True)
+            _warm_up_thread.start()
+    return _warm_up_thread
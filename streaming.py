@@ -0,0 +1,138 @@
+import time
+import threading
+import contextvars
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional
+
+from llama_index.core.base.llms.types import ChatMessage
+
+from phi.utils.log import logger
+
+from tracing import Trace, count_tokens, span, use_trace
+
+# Last stream metrics of the process, newest last
+stream_metrics: deque = deque(maxlen=1000)
+
+OnDelta = Callable[[Optional[str]], None]
+
+class StreamStats:
+    def __init__(self, name: str):
+        self.name = name
+        self.started_at = time.perf_counter()
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.tokens = 0
+
+    def on_delta(self):
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def finish(self, text: str):
+        self.finished_at = time.perf_counter()
+        self.tokens = count_tokens(text)
+
+    @property
+    def time_to_first_token(self) -> Optional[float]:
+        return self.first_token_at - self.started_at if self.first_token_at is not None else None
+
+    @property
+    def tokens_per_second(self) -> Optional[float]:
+        if self.first_token_at is None or self.finished_at is None or self.finished_at <= self.first_token_at:
+            return None
+        return self.tokens / (self.finished_at - self.first_token_at)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "time_to_first_token": self.time_to_first_token,
+            "total_seconds": self.finished_at - self.started_at if self.finished_at is not None else None,
+            "tokens": self.tokens,
+            "tokens_per_second": self.tokens_per_second,
+        }
+
+class ChatStream:
+    """Runs a blocking LLM call on a background thread and exposes its text as it streams.
+
+    `produce` receives an `on_delta` callback to report new text (`None` discards the
+    text so far, e.g. an agent's remarks before it calls a tool) and returns the final
+    result. The call runs to completion even if nobody is reading, so a Streamlit
+    rerun can re-attach to it by iterating again.
+    """
+
+    def __init__(self, name: str, prompt: str, produce: Callable[[OnDelta], Any], trace: Optional[Trace] = None):
+        self.prompt = prompt
+        self.trace = trace
+        self.stats = StreamStats(name)
+        self.text = ""
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+        self.done = False
+        self._version = 0
+        self._cond = threading.Condition()
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run, produce), name=f"fico-stream-{name}", daemon=True)
+        self._thread.start()
+
+    def _on_delta(self, delta: Optional[str]):
+        with self._cond:
+            if delta is None:
+                self.text = ""
+            elif delta:
+                self.stats.on_delta()
+                self.text += delta
+            else:
+                return
+            self._version += 1
+            self._cond.notify_all()
+
+    def _run(self, produce: Callable[[OnDelta], Any]):
+        if self.trace is not None:
+            with use_trace(self.trace):
+                self._produce(produce)
+            self.trace.finish()
+        else:
+            self._produce(produce)
+
+    def _produce(self, produce: Callable[[OnDelta], Any]):
+        with span(f"{self.stats.name}.stream") as stream_span:
+            try:
+                result = produce(self._on_delta)
+            except BaseException as e:
+                logger.warning(f"{self.stats.name} stream failed: {e}")
+                result = None
+                with self._cond:
+                    self.error = e
+            with self._cond:
+                self.result = result
+                if self.error is None and isinstance(result, str):
+                    self.text = result
+                self.stats.finish(self.text)
+                stream_span.set(**{key: value for key, value in self.stats.to_dict().items() if key != "name"})
+                self.done = True
+                self._version += 1
+                self._cond.notify_all()
+
+        stream_metrics.append(self.stats.to_dict())
+        logger.debug(f"Stream metrics: {self.stats.to_dict()}")
+
+    def __iter__(self):
+        """Yields the full text so far every time it changes, until the call finishes"""
+        version = -1
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._version != version)
+                version, text, done = self._version, self.text, self.done
+            yield text
+            if done:
+                return
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        self._thread.join(timeout)
+        return self.done
+
+def stream_llm_chat(llm, messages: List[ChatMessage], on_delta: OnDelta) -> str:
+    content = ""
+    for response in llm.stream_chat(messages):
+        on_delta(response.delta or "")
+        content = response.message.content or ""
+    return content
@@ -0,0 +1,194 @@
+import os
+import json
+import time
+import uuid
+import threading
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+from phi.utils.log import logger
+
+# Finished traces are appended here as JSON lines, one span per line
+TRACE_FILE = os.environ.get('FICO_TRACE_FILE')
+# Prometheus text exposition of the process metrics, e.g. for the node_exporter textfile collector
+METRICS_FILE = os.environ.get('FICO_METRICS_FILE')
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar("fico_trace", default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar("fico_span", default=None)
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs", "thread")
+
+    def __init__(self, name: str, parent_id: Optional[str], attrs: Dict[str, Any]):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.attrs = attrs
+        self.thread = threading.current_thread().name
+
+    def set(self, **attrs: Any):
+        self.attrs.update(attrs)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {"span_id": self.span_id, "parent_id": self.parent_id, "name": self.name, "start": self.start,
+                "duration": self.duration, "thread": self.thread, **self.attrs}
+
+class Trace:
+    """Timing spans of one report or chat turn.
+
+    Spans opened with `span` while the trace is active (see `use_trace`) are recorded
+    here, including spans opened on other threads that run in a copy of the context.
+    """
+
+    def __init__(self, name: str, **attrs: Any):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self.end: Optional[float] = None
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span):
+        with self._lock:
+            self.spans.append(span)
+
+    def finish(self):
+        if self.end is not None:
+            return
+        self.end = time.time()
+        metrics.observe(f"{self.name}.total", self.end - self.start)
+        if TRACE_FILE:
+            with _export_lock, open(TRACE_FILE, 'a') as f:
+                f.write(self.to_jsonl())
+        if METRICS_FILE:
+            metrics.write(METRICS_FILE)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.time()) - self.start
+
+    def to_jsonl(self) -> str:
+        with self._lock:
+            spans = list(self.spans)
+        lines = [json.dumps({"trace_id": self.trace_id, "trace": self.name, **self.attrs, **span.to_dict()}, default=str)
+                 for span in spans]
+        return "".join(line + "\n" for line in lines)
+
+    def breakdown(self) -> List[Dict[str, Any]]:
+        """Total seconds per span name, slowest first"""
+        totals: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            total = totals.setdefault(span.name, {"stage": span.name, "seconds": 0.0, "calls": 0})
+            total["seconds"] += span.duration
+            total["calls"] += 1
+            for key in ("prompt_tokens", "completion_tokens"):
+                if key in span.attrs:
+                    total[key] = total.get(key, 0) + span.attrs[key]
+        return sorted(totals.values(), key=lambda total: total["seconds"], reverse=True)
+
+class Metrics:
+    """Process-wide span latency summaries and LLM token counters"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seconds: Dict[str, List[float]] = {}
+        self._tokens: Dict[tuple, int] = {}
+
+    def observe(self, name: str, seconds: float, attrs: Optional[Dict[str, Any]] = None):
+        with self._lock:
+            count_sum = self._seconds.setdefault(name, [0, 0.0])
+            count_sum[0] += 1
+            count_sum[1] += seconds
+            for kind in ("prompt", "completion"):
+                tokens = (attrs or {}).get(f"{kind}_tokens")
+                if tokens:
+                    self._tokens[(name, kind)] = self._tokens.get((name, kind), 0) + tokens
+
+    def prometheus_text(self) -> str:
+        with self._lock:
+            seconds = dict(self._seconds)
+            tokens = dict(self._tokens)
+        lines = ["# HELP fico_span_seconds Time spent in each stage.", "# TYPE fico_span_seconds summary"]
+        for name, (count, total) in sorted(seconds.items()):
+            lines.append(f'fico_span_seconds_count{{span="{name}"}} {count}')
+            lines.append(f'fico_span_seconds_sum{{span="{name}"}} {total:.6f}')
+        lines += ["# HELP fico_llm_tokens_total LLM tokens by stage.", "# TYPE fico_llm_tokens_total counter"]
+        for (name, kind), count in sorted(tokens.items()):
+            lines.append(f'fico_llm_tokens_total{{span="{name}",kind="{kind}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            f.write(self.prometheus_text())
+        os.replace(tmp_path, path)
+
+metrics = Metrics()
+_export_lock = threading.Lock()
+
+@contextmanager
+def use_trace(trace: Optional[Trace]):
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+def start_span(name: str, **attrs: Any) -> Span:
+    """A span under the current one that is not made current, for stages timed by callbacks"""
+    parent = _current_span.get()
+    return Span(name, parent.span_id if parent is not None else None, attrs)
+
+def end_span(current: Span, trace: Optional[Trace] = None):
+    current.end = time.time()
+    if trace is not None:
+        trace.add(current)
+    metrics.observe(current.name, current.duration, current.attrs)
+    logger.debug(f"{current.name}: {current.duration:.3f}s")
+
+@contextmanager
+def span(name: str, **attrs: Any):
+    """Times a stage into the active trace (if any) and the process metrics"""
+    current = start_span(name, **attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=repr(e))
+        raise
+    finally:
+        _current_span.reset(token)
+        end_span(current, _current_trace.get())
+
+def count_tokens(text: str) -> int:
+    if not text:
+        return 0
+    # Imported here so tracing stays cheap to import for the app's first render
+    from llama_index.core.utils import get_tokenizer
+
+    return len(get_tokenizer()(text))
+
+def llm_token_usage(messages, response) -> Dict[str, int]:
+    """Prompt and completion tokens of an LLM call, from the provider's usage report when it has one"""
+    usage = getattr(response, "raw", None)
+    usage = usage.get("usage") if isinstance(usage, dict) else None
+    if usage is not None:
+        prompt_tokens = getattr(usage, "input_tokens", None) or getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "output_tokens", None) or getattr(usage, "completion_tokens", None)
+        if prompt_tokens is not None and completion_tokens is not None:
+            return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens}
+    return {"prompt_tokens": sum(count_tokens(str(message.content or "")) for message in messages),
+            "completion_tokens": count_tokens(str(response.message.content or ""))}
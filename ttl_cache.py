@@ -0,0 +1,192 @@
+import os
+import time
+import pickle
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from phi.utils.log import logger
+
+# kind -> (seconds an entry is fresh, seconds a stale entry may still be served while it is refreshed)
+MARKET_DATA_TTLS = {
+    "price": (30, 5 * 60),
+    "info": (60 * 60, 6 * 60 * 60),
+    "news": (15 * 60, 60 * 60),
+    "recommendations": (6 * 60 * 60, 24 * 60 * 60),
+    "upgrades_downgrades": (6 * 60 * 60, 24 * 60 * 60),
+    "history": (15 * 60, 60 * 60),
+}
+
+MARKET_CACHE_DIR = os.environ.get('FICO_MARKET_CACHE_DIR')
+MARKET_CACHE_MAX_ENTRIES = int(os.environ.get('FICO_MARKET_CACHE_MAX_ENTRIES', 2048))
+MARKET_CACHE_MAX_BYTES = int(os.environ.get('FICO_MARKET_CACHE_MAX_BYTES', 256 * 1024**2))
+
+class _Entry:
+    __slots__ = ("value", "size", "fetched_at")
+
+    def __init__(self, value: Any, size: int, fetched_at: float):
+        self.value = value
+        self.size = size
+        self.fetched_at = fetched_at
+
+class TTLCache:
+    """Thread-safe process-level cache with per-kind TTLs and stale-while-revalidate.
+
+    A fresh entry is served directly. A stale entry within its stale window is served
+    while a single background refresh replaces it. Anything older is fetched inline,
+    with concurrent callers for the same key sharing one fetch. Entries are evicted
+    least recently used first to stay within the entry and byte budgets, and are
+    optionally mirrored to `disk_dir` so they survive restarts and are shared between
+    processes.
+    """
+
+    def __init__(self, ttls: Dict[str, Tuple[float, float]], max_entries: int = 1024,
+                 max_bytes: int = 64 * 1024**2, disk_dir: Optional[str] = None):
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self._entries: "OrderedDict[Tuple[str, str], _Entry]" = OrderedDict()
+        self._inflight: Dict[Tuple[str, str], Future] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._refresher = ThreadPoolExecutor(max_workers=2, thread_name_prefix="fico-cache-refresh")
+        self._stats = {"hits": 0, "stale_hits": 0, "misses": 0, "disk_hits": 0, "refreshes": 0,
+                       "errors": 0, "evictions": 0}
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, kind: str, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{kind}-{hashlib.sha1(key.encode()).hexdigest()}.pkl")
+
+    def _load_disk(self, kind: str, key: str) -> Optional[_Entry]:
+        if not self.disk_dir:
+            return None
+        try:
+            with open(self._disk_path(kind, key), 'rb') as f:
+                data = f.read()
+            fetched_at, value = pickle.loads(data)
+        except (OSError, pickle.UnpicklingError, EOFError, ValueError):
+            return None
+        return _Entry(value, len(data), fetched_at)
+
+    def _store_disk(self, kind: str, key: str, entry: _Entry, data: bytes):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(kind, key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}"
+        try:
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write {kind} cache entry for {key}: {e}")
+
+    def _put(self, kind: str, key: str, value: Any, fetched_at: float) -> _Entry:
+        data = pickle.dumps((fetched_at, value))
+        entry = _Entry(value, len(data), fetched_at)
+        with self._lock:
+            old = self._entries.pop((kind, key), None)
+            if old is not None:
+                self._bytes -= old.size
+            self._entries[(kind, key)] = entry
+            self._bytes += entry.size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size
+                self._stats["evictions"] += 1
+        self._store_disk(kind, key, entry, data)
+        return entry
+
+    def _fetch(self, kind: str, key: str, fetch: Callable[[], Any]) -> Any:
+        """Runs `fetch` once per key at a time; concurrent callers wait for the same result."""
+        with self._lock:
+            future = self._inflight.get((kind, key))
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[(kind, key)] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = fetch()
+            self._put(kind, key, value, time.time())
+            future.set_result(value)
+            return value
+        except BaseException as e:
+            with self._lock:
+                self._stats["errors"] += 1
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop((kind, key), None)
+
+    def _refresh(self, kind: str, key: str, fetch: Callable[[], Any]):
+        with self._lock:
+            if (kind, key) in self._inflight:
+                return
+            self._stats["refreshes"] += 1
+
+        def refresh():
+            try:
+                self._fetch(kind, key, fetch)
+            except Exception as e:
+                logger.warning(f"Background refresh of {kind} for {key} failed: {e}")
+
+        self._refresher.submit(refresh)
+
+    def get_or_fetch(self, kind: str, key: str, fetch: Callable[[], Any]) -> Any:
+        ttl, stale_ttl = self.ttls[kind]
+        now = time.time()
+
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is not None:
+                self._entries.move_to_end((kind, key))
+
+        if entry is None:
+            entry = self._load_disk(kind, key)
+            if entry is not None and now - entry.fetched_at <= ttl + stale_ttl:
+                with self._lock:
+                    self._stats["disk_hits"] += 1
+                self._put(kind, key, entry.value, entry.fetched_at)
+            else:
+                entry = None
+
+        age = now - entry.fetched_at if entry is not None else None
+        if age is not None and age <= ttl:
+            with self._lock:
+                self._stats["hits"] += 1
+            return entry.value
+        if age is not None and age <= ttl + stale_ttl:
+            with self._lock:
+                self._stats["stale_hits"] += 1
+            self._refresh(kind, key, fetch)
+            return entry.value
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return self._fetch(kind, key, fetch)
+
+    def invalidate(self, kind: str, key: str):
+        with self._lock:
+            entry = self._entries.pop((kind, key), None)
+            if entry is not None:
+                self._bytes -= entry.size
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(kind, key))
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {**self._stats, "entries": len(self._entries), "bytes": self._bytes}
+
+market_cache = TTLCache(MARKET_DATA_TTLS, max_entries=MARKET_CACHE_MAX_ENTRIES,
+                        max_bytes=MARKET_CACHE_MAX_BYTES, disk_dir=MARKET_CACHE_DIR)
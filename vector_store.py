@@ -0,0 +1,358 @@
+import os
+import json
+import hashlib
+import threading
+import contextlib
+from typing import Any, Dict, Iterator, List, Optional
+
+import numpy as np
+
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.schema import BaseNode
+from llama_index.core.vector_stores.types import (BasePydanticVectorStore, FilterCondition, FilterOperator,
+                                                  MetadataFilters, VectorStoreQuery, VectorStoreQueryResult)
+from llama_index.core.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+
+from phi.utils.log import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows, writers are not coordinated between processes
+    fcntl = None
+
+# memory keeps indexes in the session as before, mmap keeps each ticker's annual reports in a shared store on disk
+VECTOR_STORE = os.environ.get('FICO_VECTOR_STORE', "memory")
+VECTOR_STORE_DIR = os.environ.get('FICO_VECTOR_STORE_DIR', os.path.join('data', 'vectors'))
+# Below this many vectors queries scan all of them, above it they go through the IVF index
+IVF_MIN_ROWS = int(os.environ.get('FICO_VECTOR_IVF_MIN_ROWS', 4096))
+# Inverted lists searched per query
+IVF_NPROBE = int(os.environ.get('FICO_VECTOR_NPROBE', 16))
+
+_KMEANS_ITERATIONS = 10
+_ASSIGN_CHUNK_ROWS = 65536
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.where(norms > 0, norms, 1)
+
+def _kmeans(sample: np.ndarray, nlist: int, seed: int = 0) -> np.ndarray:
+    """Spherical k-means centroids of normalized vectors"""
+    rng = np.random.default_rng(seed)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+    for _ in range(_KMEANS_ITERATIONS):
+        assignments = np.argmax(sample @ centroids.T, axis=1)
+        order = np.argsort(assignments, kind='stable')
+        counts = np.bincount(assignments, minlength=nlist)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums = sample[rng.choice(len(sample), nlist)]
+        # Empty lists restart from a random vector
+        sums[counts > 0] = np.add.reduceat(sample[order], starts[counts > 0])
+        centroids = _normalize(sums)
+    return centroids
+
+def _assign(vectors: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), _ASSIGN_CHUNK_ROWS):
+        chunk = np.asarray(vectors[start:start + _ASSIGN_CHUNK_ROWS])
+        assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+    return assignments
+
+class MmapVectorStore(BasePydanticVectorStore):
+    """Append-only vector store kept on disk, with embeddings in a memory-mapped array.
+
+    Embeddings are appended to `embeddings.f32`, nodes to `nodes.jsonl` and the row
+    count is published last in `meta.json`, so any number of processes can open the
+    same directory read-only and share the embeddings through the page cache. Nodes
+    are not held in memory, only the byte offset of each line, and are read for the
+    results of a query. Once a
+    store grows past `IVF_MIN_ROWS` vectors, queries only scan the `IVF_NPROBE`
+    k-means lists nearest to the query; new vectors join their nearest list and the
+    lists are retrained when the store has doubled since the last training. Deleted
+    rows are tombstoned. One process writes at a time (file lock).
+    """
+
+    stores_text: bool = True
+    flat_metadata: bool = False
+    path: str
+    read_only: bool = False
+
+    _lock: Any = PrivateAttr()
+    _meta: Dict[str, Any] = PrivateAttr()
+    _meta_stamp: Any = PrivateAttr()
+    _embeddings: Optional[np.ndarray] = PrivateAttr()
+    _node_offsets: np.ndarray = PrivateAttr()
+    _alive: np.ndarray = PrivateAttr()
+    _centroids: Optional[np.ndarray] = PrivateAttr()
+    _list_rows: Optional[np.ndarray] = PrivateAttr()
+    _list_bounds: Optional[np.ndarray] = PrivateAttr()
+
+    def __init__(self, path: str, read_only: bool = False, **kwargs: Any):
+        super().__init__(path=path, read_only=read_only, **kwargs)
+        if not read_only:
+            os.makedirs(path, exist_ok=True)
+        self._lock = threading.RLock()
+        self._meta = {"dim": None, "count": 0, "trained_count": 0, "nlist": 0, "deleted": [], "sources": {}}
+        self._meta_stamp = None
+        self._embeddings = None
+        # Byte offset of every row's line in nodes.jsonl, followed by the end of the last one
+        self._node_offsets = np.zeros(1, dtype=np.int64)
+        self._alive = np.ones(0, dtype=bool)
+        self._centroids = None
+        self._list_rows = None
+        self._list_bounds = None
+        self._refresh()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "MmapVectorStore"
+
+    @property
+    def client(self) -> Any:
+        return None
+
+    def _file(self, name: str) -> str:
+        return os.path.join(self.path, name)
+
+    @contextlib.contextmanager
+    def _write_lock(self):
+        if self.read_only:
+            raise PermissionError(f"Vector store {self.path} is open read-only")
+        with self._lock, open(self._file('.lock'), 'a') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                # Another process may have written since our last look
+                self._refresh()
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _refresh(self):
+        """Maps whatever other writers have published since the last call"""
+        with self._lock:
+            try:
+                stat = os.stat(self._file('meta.json'))
+            except FileNotFoundError:
+                return
+            stamp = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if stamp == self._meta_stamp:
+                return
+            with open(self._file('meta.json')) as f:
+                meta = json.load(f)
+            self._load(meta)
+            self._meta_stamp = stamp
+
+    def _load(self, meta: Dict[str, Any]):
+        count, dim = meta["count"], meta["dim"]
+        self._embeddings = (np.memmap(self._file('embeddings.f32'), dtype=np.float32, mode='r', shape=(count, dim))
+                            if count else None)
+
+        # nodes.jsonl is append-only, scan only the rows added since the last load
+        rows = len(self._node_offsets) - 1
+        if rows < count:
+            end = int(self._node_offsets[-1])
+            offsets = []
+            with open(self._file('nodes.jsonl'), 'rb') as f:
+                f.seek(end)
+                while rows + len(offsets) < count:
+                    line = f.readline()
+                    if not line.endswith(b"\n"):
+                        break
+                    end += len(line)
+                    offsets.append(end)
+            self._node_offsets = np.concatenate([self._node_offsets, np.asarray(offsets, dtype=np.int64)])
+
+        self._alive = np.ones(count, dtype=bool)
+        deleted = np.asarray(meta["deleted"], dtype=np.int64)
+        self._alive[deleted[deleted < count]] = False
+
+        if meta["nlist"] and count >= IVF_MIN_ROWS:
+            self._centroids = np.fromfile(self._file('centroids.f32'), dtype=np.float32).reshape(meta["nlist"], dim)
+            assignments = np.memmap(self._file('assignments.i32'), dtype=np.int32, mode='r', shape=(count,))
+            self._list_rows = np.argsort(assignments, kind='stable').astype(np.int64)
+            self._list_bounds = np.searchsorted(assignments[self._list_rows], np.arange(meta["nlist"] + 1))
+        else:
+            self._centroids = self._list_rows = self._list_bounds = None
+        self._meta = meta
+
+    def _publish(self, meta: Dict[str, Any]):
+        tmp_path = self._file(f"meta.json.{os.getpid()}.tmp")
+        with open(tmp_path, 'w') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._file('meta.json'))
+        self._refresh()
+
+    def _train(self, meta: Dict[str, Any]):
+        embeddings = np.memmap(self._file('embeddings.f32'), dtype=np.float32, mode='r', shape=(meta["count"], meta["dim"]))
+        nlist = int(min(4096, max(16, np.sqrt(meta["count"]))))
+        rng = np.random.default_rng(meta["count"])
+        sample_rows = np.sort(rng.choice(meta["count"], min(meta["count"], 256 * nlist), replace=False))
+        centroids = _kmeans(np.asarray(embeddings[sample_rows]), nlist).astype(np.float32)
+        assignments = _assign(embeddings, centroids)
+
+        for name, array in (('centroids.f32', centroids), ('assignments.i32', assignments)):
+            tmp_path = self._file(f"{name}.{os.getpid()}.tmp")
+            array.tofile(tmp_path)
+            os.replace(tmp_path, self._file(name))
+        meta["nlist"] = nlist
+        meta["trained_count"] = meta["count"]
+        logger.debug(f"Trained {nlist} IVF lists over {meta['count']} vectors in {self.path}")
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        if not nodes:
+            return []
+        vectors = _normalize(np.asarray([node.get_embedding() for node in nodes], dtype=np.float32))
+        with self._write_lock():
+            meta = json.loads(json.dumps(self._meta))
+            if meta["dim"] is None:
+                meta["dim"] = int(vectors.shape[1])
+            elif meta["dim"] != vectors.shape[1]:
+                raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store ({meta['dim']})")
+
+            # Truncate leftovers of a writer that died before publishing
+            count = meta["count"]
+            with open(self._file('embeddings.f32'), 'ab') as f:
+                f.truncate(count * meta["dim"] * 4)
+                f.write(vectors.tobytes())
+            with open(self._file('nodes.jsonl'), 'ab') as f:
+                f.truncate(int(self._node_offsets[-1]))
+                for node in nodes:
+                    # The embedding lives in embeddings.f32, leave it out of the (slow) node serialization
+                    stored = node.copy(update={"embedding": None})
+                    f.write(json.dumps(node_to_metadata_dict(stored, remove_text=False, flat_metadata=False)).encode() + b"\n")
+            meta["count"] = count + len(nodes)
+
+            if meta["count"] >= IVF_MIN_ROWS and meta["count"] >= 2 * meta["trained_count"]:
+                self._train(meta)
+            elif meta["nlist"]:
+                with open(self._file('assignments.i32'), 'ab') as f:
+                    f.truncate(count * 4)
+                    f.write(_assign(vectors, self._centroids).tobytes())
+            self._publish(meta)
+        return [node.node_id for node in nodes]
+
+    def _read_nodes(self, rows, offsets: np.ndarray) -> Iterator[dict]:
+        """The stored nodes of `rows`, read from nodes.jsonl one at a time"""
+        with open(self._file('nodes.jsonl'), 'rb') as f:
+            for row in rows:
+                f.seek(offsets[row])
+                yield json.loads(f.read(offsets[row + 1] - offsets[row]))
+
+    def _delete_rows(self, predicate):
+        with self._write_lock():
+            alive_rows = np.flatnonzero(self._alive)
+            rows = [int(row) for row, node in zip(alive_rows, self._read_nodes(alive_rows, self._node_offsets))
+                    if predicate(node)]
+            if rows:
+                meta = json.loads(json.dumps(self._meta))
+                meta["deleted"] = sorted(set(meta["deleted"]) | set(rows))
+                self._publish(meta)
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self._delete_rows(lambda node: node.get("ref_doc_id", node.get("doc_id")) == ref_doc_id)
+
+    def delete_where(self, key: str, value: Any):
+        """Deletes the nodes whose metadata `key` equals `value`"""
+        self._delete_rows(lambda node: node.get(key) == value)
+
+    def sources(self) -> Dict[str, str]:
+        """Completely added sources (e.g. a PDF) and their summaries"""
+        self._refresh()
+        return dict(self._meta["sources"])
+
+    def add_source(self, source: str, summary: str):
+        with self._write_lock():
+            meta = json.loads(json.dumps(self._meta))
+            meta["sources"][source] = summary
+            self._publish(meta)
+
+    def size(self) -> int:
+        """Number of vectors, excluding deleted ones"""
+        self._refresh()
+        return int(self._alive.sum())
+
+    def _matches(self, node: dict, query: VectorStoreQuery) -> bool:
+        if query.doc_ids and node.get("ref_doc_id", node.get("doc_id")) not in query.doc_ids:
+            return False
+        if query.node_ids and node.get("id_") not in query.node_ids:
+            node_content = json.loads(node.get("_node_content", "{}"))
+            if node_content.get("id_") not in query.node_ids:
+                return False
+        if query.filters is not None:
+            return self._matches_filters(node, query.filters)
+        return True
+
+    def _matches_filters(self, node: dict, filters: MetadataFilters) -> bool:
+        results = []
+        for metadata_filter in filters.filters:
+            if isinstance(metadata_filter, MetadataFilters):
+                results.append(self._matches_filters(node, metadata_filter))
+            elif metadata_filter.operator == FilterOperator.EQ:
+                results.append(node.get(metadata_filter.key) == metadata_filter.value)
+            elif metadata_filter.operator == FilterOperator.NE:
+                results.append(node.get(metadata_filter.key) != metadata_filter.value)
+            elif metadata_filter.operator == FilterOperator.IN:
+                results.append(node.get(metadata_filter.key) in metadata_filter.value)
+            else:
+                raise NotImplementedError(f"Filter operator {metadata_filter.operator} is not supported")
+        return all(results) if filters.condition != FilterCondition.OR else any(results)
+
+    def _candidates(self, embedding: np.ndarray) -> np.ndarray:
+        if self._centroids is None:
+            return np.arange(len(self._alive))
+        probes = np.argsort(self._centroids @ embedding)[::-1][:IVF_NPROBE]
+        rows = np.concatenate([self._list_rows[self._list_bounds[p]:self._list_bounds[p + 1]] for p in probes])
+        # Sorted rows read the memory map front to back
+        return np.sort(rows)
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        self._refresh()
+        with self._lock:
+            embeddings, offsets, alive = self._embeddings, self._node_offsets, self._alive
+            embedding = np.asarray(query.query_embedding, dtype=np.float32)
+            embedding = embedding / (np.linalg.norm(embedding) or 1)
+            candidates = self._candidates(embedding)
+
+        if embeddings is None or not len(candidates):
+            return VectorStoreQueryResult(nodes=[], similarities=[], ids=[])
+        candidates = candidates[alive[candidates]]
+        scores = np.asarray(embeddings[candidates]) @ embedding
+
+        result_nodes, similarities, ids = [], [], []
+        # VectorStoreIndex passes the (empty) node ids of its own index struct, which means no restriction
+        filtered = query.filters is not None or bool(query.doc_ids) or bool(query.node_ids)
+        if filtered or len(scores) <= query.similarity_top_k:
+            order = np.argsort(-scores)
+        else:
+            top = np.argpartition(-scores, query.similarity_top_k)[:query.similarity_top_k]
+            order = top[np.argsort(-scores[top])]
+        for i, node_dict in zip(order, self._read_nodes(candidates[order], offsets)):
+            if filtered and not self._matches(node_dict, query):
+                continue
+            node = metadata_dict_to_node(node_dict)
+            result_nodes.append(node)
+            similarities.append(float(scores[i]))
+            ids.append(node.node_id)
+            if len(result_nodes) >= query.similarity_top_k:
+                break
+        return VectorStoreQueryResult(nodes=result_nodes, similarities=similarities, ids=ids)
+
+    def memory_bytes(self) -> int:
+        """Bytes held in this process, excluding the memory-mapped embeddings"""
+        return (self._node_offsets.nbytes + self._alive.nbytes
+                + sum(array.nbytes for array in (self._centroids, self._list_rows, self._list_bounds) if array is not None))
+
+_stores: Dict[str, MmapVectorStore] = {}
+_stores_lock = threading.Lock()
+
+def open_vector_store(ticker: str, collection: str, embed_model: str, read_only: bool = False) -> MmapVectorStore:
+    """The process-wide store of a ticker's collection for an embedding model"""
+    model_dir = hashlib.sha256(embed_model.encode()).hexdigest()[:16]
+    path = os.path.join(VECTOR_STORE_DIR, model_dir, ticker.lower().replace(".", "_"), collection)
+    with _stores_lock:
+        store = _stores.get(path)
+        if store is None or (store.read_only and not read_only):
+            store = MmapVectorStore(path, read_only=read_only)
+            _stores[path] = store
+        return store